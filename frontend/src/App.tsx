@@ -1,4 +1,4 @@
-import { useState, useEffect, useCallback } from 'react';
+import { useState, useEffect, useCallback, useRef } from 'react';
 import { NavBar } from './components/NavBar';
 import { MenuScreen } from './components/MenuScreen';
 import { SizeScreen } from './components/SizeScreen';
@@ -7,7 +7,15 @@ import { ProfileScreen } from './components/ProfileScreen';
 import { CartModal, type PaymentMethod } from './components/CartModal';
 import { AuthModal } from './components/AuthModal';
 import { useTelegram } from './hooks/useTelegram';
-import { fetchMenu, fetchSupplements, createOrder, createInAppPayment, getMe, setStoredToken } from './api';
+import {
+  fetchBootstrap,
+  chargeSavedCard,
+  createOrder,
+  createInAppPayment,
+  getMe,
+  newIdempotencyKey,
+  setStoredToken,
+} from './api';
 import type { AuthUser } from './api';
 import type {
   MenuItem,
@@ -20,6 +28,32 @@ import type {
 import { getTypeList } from './types';
 
 const ORDERS_STORAGE_KEY = 'orders';
+const MENU_CACHE_KEY = 'menu_cache';
+
+/** Меню и добавки из прошлого открытия: с версиями отправляются в /api/bootstrap */
+interface MenuCache {
+  versions: { menu: string; supplements: string };
+  menu: MenuGroup;
+  supplements: SupplementCategory[];
+}
+
+function loadMenuCache(): MenuCache | null {
+  try {
+    const raw = localStorage.getItem(MENU_CACHE_KEY);
+    if (raw) return JSON.parse(raw);
+  } catch {
+    // ignore
+  }
+  return null;
+}
+
+function saveMenuCache(cache: MenuCache) {
+  try {
+    localStorage.setItem(MENU_CACHE_KEY, JSON.stringify(cache));
+  } catch {
+    // ignore
+  }
+}
 
 function loadOrdersFromStorage(): SavedOrder[] {
   try {
@@ -74,10 +108,19 @@ export default function App() {
       setMenuLoading(true);
       setMenuError(null);
       try {
-        const group = await fetchMenu();
-        if (!cancelled) setMenuGroup(group);
-        const supps = await fetchSupplements();
-        if (!cancelled) setSupplementsData(supps);
+        const cached = loadMenuCache();
+        const boot = await fetchBootstrap(cached?.versions);
+        const group = boot.menu ?? cached?.menu;
+        const supps = boot.supplements ?? cached?.supplements ?? [];
+        if (!group) throw new Error('Ошибка загрузки меню');
+        if (boot.menu || boot.supplements) {
+          saveMenuCache({ versions: boot.versions, menu: group, supplements: supps });
+        }
+        if (!cancelled) {
+          setMenuGroup(group);
+          setSupplementsData(supps);
+          if (boot.user) setSiteUser(boot.user);
+        }
       } catch (e) {
         if (!cancelled) setMenuError(e instanceof Error ? e.message : 'Ошибка загрузки');
       } finally {
@@ -89,13 +132,6 @@ export default function App() {
     };
   }, []);
 
-  useEffect(() => {
-    (async () => {
-      const res = await getMe();
-      if (res.success && res.user) setSiteUser(res.user);
-    })();
-  }, []);
-
   useEffect(() => {
     const params = new URLSearchParams(window.location.search);
     const success = params.get('payment_success');
@@ -282,6 +318,17 @@ export default function App() {
     setCart((c) => c.filter((_, i) => i !== index));
   }, []);
 
+  // Ключ идемпотентности текущего оформления: повтор той же корзины (двойное нажатие,
+  // повтор после ошибки сети) отправляется с тем же ключом, и сервер не создаст второй заказ
+  const checkoutKeyRef = useRef<{ body: string; key: string } | null>(null);
+  const checkoutKey = useCallback((kind: string, payload: unknown) => {
+    const body = kind + JSON.stringify(payload);
+    if (checkoutKeyRef.current?.body !== body) {
+      checkoutKeyRef.current = { body, key: newIdempotencyKey() };
+    }
+    return checkoutKeyRef.current.key;
+  }, []);
+
   const checkout = useCallback(() => {
     if (cart.length === 0) {
       showAlert('Корзина пуста');
@@ -312,16 +359,80 @@ export default function App() {
       telegramUserId: currentUser?.id,
     };
 
+    const completeOrder = (orderId: string, paid: boolean) => {
+      const savedOrder: SavedOrder = {
+        id: orderId,
+        date: new Date().toLocaleString('ru-RU'),
+        total,
+        items: [...cart],
+      };
+      setOrders((o) => {
+        const next = [savedOrder, ...o];
+        saveOrdersToStorage(next);
+        return next;
+      });
+      if (canSendToBot) {
+        sendData({
+          action: 'order_created',
+          order_id: orderId,
+          total,
+          paid,
+        });
+      }
+      setCart([]);
+      setCartOpen(false);
+      setScreenHistory([]);
+      setScreen('menu');
+      showAlert(`✅ Заказ #${orderId} успешно сформирован!\n💰 Сумма: ${total.toFixed(2)} ₽`);
+    };
+
+    if (paymentMethod === 'online' && siteUser?.saved_payment_method_id) {
+      showConfirm(`Оплатить ${total.toFixed(2)} ₽ привязанной картой?`, (confirmed) => {
+        if (!confirmed) return;
+        (async () => {
+          try {
+            const result = await chargeSavedCard(
+              baseOrderPayload,
+              checkoutKey('saved', baseOrderPayload)
+            );
+            if (result.success && result.order_id != null) {
+              checkoutKeyRef.current = null;
+              completeOrder(result.order_id, true);
+              return;
+            }
+            if (result.pending && result.return_url) {
+              // Деньги списаны, заказ доводит страница возврата (как после оплаты по ссылке)
+              checkoutKeyRef.current = null;
+              setCart([]);
+              window.location.href = result.return_url;
+              return;
+            }
+            if (result.card_unlinked) {
+              setSiteUser((u) => (u ? { ...u, saved_payment_method_id: null } : u));
+            }
+            showAlert(result.error || 'Не удалось оплатить картой');
+          } catch (e) {
+            showAlert('Ошибка: ' + (e instanceof Error ? e.message : 'Сеть'));
+          }
+        })();
+      });
+      return;
+    }
+
     if (paymentMethod === 'online') {
       showConfirm('Оформить заказ с оплатой картой?', (confirmed) => {
         if (!confirmed) return;
         (async () => {
           try {
-            const result = await createInAppPayment(baseOrderPayload);
+            const result = await createInAppPayment(
+              baseOrderPayload,
+              checkoutKey('inapp', baseOrderPayload)
+            );
             if (!result.success) {
               showAlert(result.error || 'Не удалось создать платёж');
               return;
             }
+            checkoutKeyRef.current = null;
             const url = result.confirmation_url;
             if (!url) {
               showAlert('Ошибка: нет ссылки на оплату');
@@ -350,34 +461,10 @@ export default function App() {
             ...baseOrderPayload,
             paidValue: 0,
           };
-          const result = await createOrder(orderData);
+          const result = await createOrder(orderData, checkoutKey('order', orderData));
           if (result.success && result.order_id != null) {
-            const savedOrder: SavedOrder = {
-              id: result.order_id,
-              date: new Date().toLocaleString('ru-RU'),
-              total,
-              items: [...cart],
-            };
-            setOrders((o) => {
-              const next = [savedOrder, ...o];
-              saveOrdersToStorage(next);
-              return next;
-            });
-            if (canSendToBot) {
-              sendData({
-                action: 'order_created',
-                order_id: result.order_id,
-                total,
-                paid: false,
-              });
-            }
-            setCart([]);
-            setCartOpen(false);
-            setScreenHistory([]);
-            setScreen('menu');
-            showAlert(
-              `✅ Заказ #${result.order_id} успешно сформирован!\n💰 Сумма: ${total.toFixed(2)} ₽`
-            );
+            checkoutKeyRef.current = null;
+            completeOrder(result.order_id, false);
           } else {
             showAlert('Ошибка: ' + (result.error || 'Неизвестная ошибка'));
           }
@@ -400,6 +487,8 @@ export default function App() {
     openLink,
     getTelegramUser,
     canSendToBot,
+    checkoutKey,
+    siteUser,
   ]);
 
   const showProfile = useCallback(() => goTo('profile'), [goTo]);
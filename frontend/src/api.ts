@@ -83,6 +83,35 @@ export async function fetchMenu(): Promise<MenuGroup> {
   return data.data;
 }
 
+export interface BootstrapVersions {
+  menu: string;
+  supplements: string;
+}
+
+export interface BootstrapResult {
+  success: boolean;
+  versions: BootstrapVersions;
+  /** Нет в ответе, если у клиента уже актуальная версия */
+  menu?: MenuGroup;
+  supplements?: SupplementCategory[];
+  user: AuthUser | null;
+  error?: string;
+}
+
+/** Меню, добавки и пользователь одним запросом. have — версии из локального кеша. */
+export async function fetchBootstrap(have?: Partial<BootstrapVersions>): Promise<BootstrapResult> {
+  const params = new URLSearchParams();
+  if (have?.menu) params.set('menu_version', have.menu);
+  if (have?.supplements) params.set('supplements_version', have.supplements);
+  const query = params.toString();
+  const res = await fetch(`${API_BASE}/bootstrap${query ? `?${query}` : ''}`, {
+    headers: authHeaders(),
+  });
+  const data = await res.json();
+  if (!data.success) throw new Error(data.error || 'Ошибка загрузки меню');
+  return data;
+}
+
 export async function fetchSupplements(): Promise<SupplementCategory[]> {
   const res = await fetch(`${API_BASE}/supplements`);
   const data = await res.json();
@@ -114,10 +143,25 @@ export interface CreateOrderResult {
   error?: string;
 }
 
-export async function createOrder(payload: CreateOrderPayload): Promise<CreateOrderResult> {
+/** Новый ключ для заголовка Idempotency-Key: один на одно оформление корзины. */
+export function newIdempotencyKey(): string {
+  if (typeof crypto !== 'undefined' && typeof crypto.randomUUID === 'function') {
+    return crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
+function idempotencyHeaders(key?: string): Record<string, string> {
+  return key ? { 'Idempotency-Key': key } : {};
+}
+
+export async function createOrder(
+  payload: CreateOrderPayload,
+  idempotencyKey?: string
+): Promise<CreateOrderResult> {
   const res = await fetch(`${API_BASE}/order`, {
     method: 'POST',
-    headers: { 'Content-Type': 'application/json', ...authHeaders() },
+    headers: { 'Content-Type': 'application/json', ...authHeaders(), ...idempotencyHeaders(idempotencyKey) },
     body: JSON.stringify(payload),
   });
   return res.json();
@@ -144,11 +188,39 @@ export interface CreateInAppPaymentResult {
 }
 
 export async function createInAppPayment(
-  payload: PreparePaymentPayload
+  payload: PreparePaymentPayload,
+  idempotencyKey?: string
 ): Promise<CreateInAppPaymentResult> {
   const res = await fetch(`${API_BASE}/payment/create-inapp`, {
     method: 'POST',
-    headers: { 'Content-Type': 'application/json', ...authHeaders() },
+    headers: { 'Content-Type': 'application/json', ...authHeaders(), ...idempotencyHeaders(idempotencyKey) },
+    body: JSON.stringify(payload),
+  });
+  return res.json();
+}
+
+export interface ChargeSavedCardResult {
+  success: boolean;
+  order_id?: string;
+  status?: string;
+  total?: number;
+  payment_token?: string;
+  /** Оплата ещё обрабатывается или заказ не успел создаться — перейти на return_url */
+  pending?: boolean;
+  return_url?: string;
+  /** ЮKassa отозвала разрешение на списания, карта отвязана */
+  card_unlinked?: boolean;
+  error?: string;
+}
+
+/** Оплатить корзину привязанной картой без перехода на страницу оплаты. */
+export async function chargeSavedCard(
+  payload: PreparePaymentPayload,
+  idempotencyKey?: string
+): Promise<ChargeSavedCardResult> {
+  const res = await fetch(`${API_BASE}/payment/charge-saved`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', ...authHeaders(), ...idempotencyHeaders(idempotencyKey) },
     body: JSON.stringify(payload),
   });
   return res.json();
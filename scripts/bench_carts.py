@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк хранения корзин: размер базы и сериализация корзины на одно оформление заказа.
+
+Синтетическое меню (как в bench_menu.py) и CHECKOUTS оформлений: корзина из 1–4 позиций
+с размером и иногда добавкой, популярные позиции встречаются чаще. Оформление — ожидающий
+платёж и заказ по нему. Сравниваются две базы с одной схемой (database.db.init_db):
+  items_json — как раньше: JSON корзины в pending_payments и ещё раз в orders;
+  carts      — корзина один раз в carts (компактно, guid по словарю меню), в строках cart_hash.
+Размер — файла базы после VACUUM и по таблицам (dbstat); время — только сериализации
+(запись платежа, чтение корзины при создании заказа, запись заказа), без ввода-вывода.
+Использование:
+  python scripts/bench_carts.py
+  CHECKOUTS=200000 ITEMS=150 python scripts/bench_carts.py
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from random import Random
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+SRC_DIR = ROOT_DIR / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from bench_menu import synthetic_menu  # noqa: E402
+from database import carts, db  # noqa: E402
+from ytimes import MenuSnapshot  # noqa: E402
+
+CHECKOUTS = int(os.getenv("CHECKOUTS", "50000"))
+ITEMS = int(os.getenv("ITEMS", "80"))
+TIMED = min(CHECKOUTS, 20000)
+
+
+def synthetic_carts(snapshot: MenuSnapshot, count: int, seed: int = 1) -> list[list[dict]]:
+    """Корзины в том виде, в каком их присылает фронтенд."""
+    rnd = Random(seed)
+    supplements = [s for c in snapshot.supplement_categories for s in c.items]
+    out = []
+    for _ in range(count):
+        cart = []
+        for _ in range(rnd.choice((1, 1, 1, 2, 2, 3, 4))):
+            # Популярные позиции — в начале меню
+            item = snapshot.items[int(len(snapshot.items) * rnd.random() ** 3)]
+            size = rnd.choice(item.types)
+            extra = {rnd.choice(supplements).guid: 1} if rnd.random() < 0.3 else {}
+            cart.append({
+                "menuItemGuid": item.guid,
+                "menuTypeGuid": size.guid,
+                "supplementList": extra,
+                "priceWithDiscount": size.price + 50 * len(extra),
+                "quantity": rnd.choice((1, 1, 1, 2)),
+            })
+        out.append(cart)
+    return out
+
+
+def _init(path: Path, snapshot: MenuSnapshot | None = None) -> None:
+    db.DB_PATH = path
+    asyncio.run(db.init_db())
+    if snapshot is not None:
+        asyncio.run(db.register_cart_guids(snapshot.guids()))
+
+
+def _rows(cart_list: list[list[dict]]):
+    start = datetime(2026, 1, 1)
+    for i, cart in enumerate(cart_list):
+        created = (start + timedelta(minutes=7 * i)).isoformat()
+        total = sum(item["priceWithDiscount"] * item["quantity"] for item in cart)
+        yield uuid.uuid4().hex, str(uuid.uuid4()), created, total, cart
+
+
+def write_items_json(path: Path, cart_list: list[list[dict]]) -> float:
+    started = time.perf_counter()
+    with sqlite3.connect(path) as conn:
+        for token, order_guid, created, total, cart in _rows(cart_list):
+            conn.execute(
+                "INSERT INTO pending_payments (payment_token, telegram_id, items_json, total, created_at, state, order_guid) "
+                "VALUES (?, 1, ?, ?, ?, 'fulfilled', ?)",
+                (token, json.dumps(cart), total, created, order_guid),
+            )
+            conn.execute(
+                "INSERT INTO orders (user_telegram_id, items_json, total_price, status, ytimes_order_id, created_at) "
+                "VALUES (1, ?, ?, 'CREATED', ?, ?)",
+                (json.dumps(cart), total, order_guid, created),
+            )
+    return time.perf_counter() - started
+
+
+def write_carts(path: Path, cart_list: list[list[dict]]) -> float:
+    started = time.perf_counter()
+    with sqlite3.connect(path) as conn:
+        for token, order_guid, created, total, cart in _rows(cart_list):
+            cart_hash, data = carts.encode(cart)
+            conn.execute("INSERT OR IGNORE INTO carts (cart_hash, data) VALUES (?, ?)", (cart_hash, data))
+            conn.execute(
+                "INSERT INTO pending_payments (payment_token, telegram_id, items_json, cart_hash, total, created_at, state, order_guid) "
+                "VALUES (?, 1, '', ?, ?, ?, 'fulfilled', ?)",
+                (token, cart_hash, total, created, order_guid),
+            )
+            conn.execute(
+                "INSERT INTO orders (user_telegram_id, items_json, cart_hash, total_price, status, ytimes_order_id, created_at) "
+                "VALUES (1, '', ?, ?, 'CREATED', ?, ?)",
+                (cart_hash, total, order_guid, created),
+            )
+    return time.perf_counter() - started
+
+
+def sizes(path: Path) -> tuple[int, dict[str, int]]:
+    """Размер файла после VACUUM и байты по таблицам (с их индексами)."""
+    with sqlite3.connect(path) as conn:
+        conn.execute("VACUUM")
+        by_table = dict(conn.execute(
+            """SELECT coalesce(m.tbl_name, s.name), SUM(s.pgsize) FROM dbstat s
+               LEFT JOIN sqlite_schema m ON m.name = s.name GROUP BY 1"""
+        ).fetchall())
+    return path.stat().st_size, by_table
+
+
+def serialize_items_json(cart: list[dict]) -> None:
+    stored = json.dumps(cart)  # create_pending_payment
+    items = json.loads(stored)  # order_service: pending["items_json"]
+    json.dumps(items)  # complete_pending_payment: items_json заказа
+
+
+def serialize_carts(cart: list[dict]) -> None:
+    _, data = carts.encode(cart)  # create_pending_payment; заказ берёт cart_hash платежа
+    carts.decode(data)  # get_pending_payment
+
+
+def _per_checkout_us(fn, cart_list: list[list[dict]]) -> float:
+    started = time.perf_counter()
+    for cart in cart_list:
+        fn(cart)
+    return (time.perf_counter() - started) / len(cart_list) * 1e6
+
+
+def main() -> None:
+    group, supplements = synthetic_menu(ITEMS)
+    snapshot = MenuSnapshot.from_ytimes(group, supplements)
+    cart_list = synthetic_carts(snapshot, CHECKOUTS)
+    tmp = Path(tempfile.mkdtemp(prefix="bench_carts_"))
+    old_path, new_path = tmp / "items_json.db", tmp / "carts.db"
+    _init(old_path)
+    _init(new_path, snapshot)
+    print(f"Меню: {len(snapshot.items)} позиций, словарь guid: {carts.dictionary_size()}; оформлений: {CHECKOUTS}")
+
+    old_write = write_items_json(old_path, cart_list)
+    new_write = write_carts(new_path, cart_list)
+    old_size, old_tables = sizes(old_path)
+    new_size, new_tables = sizes(new_path)
+    unique = len({carts.encode(cart)[0] for cart in cart_list})
+    json_bytes = sum(len(json.dumps(cart)) for cart in cart_list) / CHECKOUTS
+    packed_bytes = sum(len(carts.encode(cart)[1]) for cart in cart_list) / CHECKOUTS
+    print(f"Корзина: JSON {json_bytes:.0f} Б, компактно {packed_bytes:.0f} Б; разных корзин {unique} ({unique / CHECKOUTS:.0%})")
+
+    print(f"\n{'':<22}{'items_json':>14}{'carts':>14}")
+    print(f"{'файл базы, КБ':<22}{old_size // 1024:>14}{new_size // 1024:>14}   (в {old_size / new_size:.1f} раза меньше)")
+    for table in ("orders", "pending_payments", "carts", "cart_guids"):
+        print(f"{'  ' + table + ', КБ':<22}{old_tables.get(table, 0) // 1024:>14}{new_tables.get(table, 0) // 1024:>14}")
+    print(f"{'запись, с':<22}{old_write:>14.2f}{new_write:>14.2f}")
+
+    sample = cart_list[:TIMED]
+    old_us = min(_per_checkout_us(serialize_items_json, sample) for _ in range(3))
+    new_us = min(_per_checkout_us(serialize_carts, sample) for _ in range(3))
+    print(f"{'сериализация, мкс':<22}{old_us:>14.1f}{new_us:>14.1f}   (на одно оформление)")
+    print(f"\nБазы: {tmp}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк групповой фиксации записей (database.write_batch): всплеск вебхуков статуса.
+
+На временной SQLite создаются ORDERS заказов, затем CONCURRENCY задач одновременно
+обновляют их статусы (update_order_status) — сначала каждая запись своей транзакцией,
+затем через общую пачку (DB_GROUP_COMMIT). Печатаются записи в секунду, задержки и
+средний размер пачки; проверяется, что все статусы записаны.
+Использование:
+  python scripts/bench_group_commit.py
+  ORDERS=2000 CONCURRENCY=200 python scripts/bench_group_commit.py
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+SRC_DIR = ROOT_DIR / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from database import db, write_batch  # noqa: E402
+
+ORDERS = int(os.getenv("ORDERS", "1000"))
+CONCURRENCY = int(os.getenv("CONCURRENCY", "100"))
+
+
+async def _burst(status: str) -> list[float]:
+    """Все заказы получают status; CONCURRENCY обновлений в полёте одновременно."""
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies: list[float] = []
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await db.update_order_status(f"order-{i}", status)
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(i) for i in range(ORDERS)))
+    return latencies
+
+
+def _check(status: str) -> int:
+    with sqlite3.connect(db.DB_PATH) as conn:
+        return conn.execute("SELECT COUNT(*) FROM orders WHERE status = ?", (status,)).fetchone()[0]
+
+
+async def run() -> bool:
+    db.DB_PATH = Path(tempfile.mkdtemp(prefix="bench_group_commit_")) / "bot.db"
+    await db.init_db()
+    for i in range(ORDERS):
+        await db.create_order(user_telegram_id=0, ytimes_order_guid=f"order-{i}", total_price=100.0)
+
+    ok = True
+    rates = {}
+    for label, enabled, status in (("по одной", False, "ACCEPTED"), ("пачками", True, "CANCELLED")):
+        write_batch.ENABLED = enabled
+        started = time.perf_counter()
+        latencies = await _burst(status)
+        elapsed = time.perf_counter() - started
+        rates[label] = ORDERS / elapsed
+        ordered = sorted(latencies)
+        p95 = ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+        print(
+            f"{label}: {rates[label]:.0f} записей/с, медиана {statistics.median(ordered) * 1000:.1f} мс, "
+            f"p95 {p95 * 1000:.1f} мс"
+        )
+        written = _check(status)
+        if written != ORDERS:
+            print(f"  ❌ записано {written} из {ORDERS}")
+            ok = False
+    print(f"Пачки: {write_batch.group_commit_stats()}")
+    await write_batch.close_group_commit()
+    print(f"Ускорение: в {rates['пачками'] / rates['по одной']:.1f} раза")
+    return ok
+
+
+def main() -> None:
+    ok = asyncio.run(run())
+    print("✅ Все статусы записаны." if ok else "❌ Проверка не прошла.")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки меню: память снимка, размер и разбор ответа /api/menu, поиск.
+
+Данные: api_menu_data.json (сохраняет scripts/check_api_response.py), если файл есть,
+иначе синтетическое меню, похожее по структуре на ответ YTimes.
+Использование:
+  python scripts/bench_menu.py
+  ITEMS=300 python scripts/bench_menu.py      # размер синтетического меню
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+from random import Random
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+SRC_DIR = ROOT_DIR / "src"
+DATA_FILE = ROOT_DIR / "api_menu_data.json"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from webapp.menu_payload import MenuPayloads, dumps, parse_fields  # noqa: E402
+from webapp.menu_search import MenuSearchIndex  # noqa: E402
+from ytimes import MenuSnapshot, deep_sizeof  # noqa: E402
+
+ITEMS = int(os.getenv("ITEMS", "80"))
+REPEAT = int(os.getenv("REPEAT", "200"))
+
+_DRINKS = ["Латте", "Капучино", "Американо", "Раф", "Флэт уайт", "Эспрессо", "Какао", "Матча латте", "Мокко", "Чай"]
+_SYRUPS = ["ваниль", "карамель", "кокос", "лесной орех", "солёная карамель", "лаванда"]
+
+
+def synthetic_menu(items: int = ITEMS, seed: int = 1) -> tuple[dict, list]:
+    """Группа меню и добавки со всеми «лишними» полями, как их отдаёт YTimes."""
+    rnd = Random(seed)
+
+    def guid() -> str:
+        return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+    categories = [
+        {
+            "guid": guid(),
+            "name": f"Добавки {c + 1}",
+            "description": "Категория добавок " * 4,
+            "itemList": [
+                {
+                    "guid": guid(),
+                    "name": f"Сироп {s}",
+                    "defaultPrice": 50,
+                    "description": "Сироп " * 10,
+                    "unit": {"name": "мл", "code": 1},
+                    "barcode": str(rnd.randint(10**12, 10**13)),
+                }
+                for s in _SYRUPS
+            ],
+        }
+        for c in range(6)
+    ]
+    item_list = []
+    for i in range(items):
+        item_list.append({
+            "guid": guid(),
+            "name": f"{rnd.choice(_DRINKS)} {i + 1}",
+            "price": None,
+            "description": "Описание напитка " * 10,
+            "recipe": "Эспрессо, молоко, сироп. " * 8,
+            "imageUrl": f"https://example.com/img/{guid()}.jpg",
+            "typeList": [
+                {
+                    "guid": guid(),
+                    "name": volume,
+                    "price": price,
+                    "isTogo": True,
+                    "recipe": "Рецепт размера " * 3,
+                    "nutrition": {"kcal": 120, "protein": 4.1, "fat": 5.2, "carbs": 12.3},
+                }
+                for volume, price in (("250 мл", 190), ("350 мл", 240), ("450 мл", 290))
+            ],
+            "supplementCategoryToFreeCount": {c["guid"]: 0 for c in categories[:4]},
+            "tagList": [{"name": "hot"}],
+            "archived": False,
+        })
+    group = {
+        "guid": guid(),
+        "name": "Меню ( онлайн заказы )",
+        "description": "Меню для онлайн заказов",
+        "itemList": item_list,
+        "goodsList": [{"guid": guid(), "name": "Вода", "price": 100, "description": "Вода " * 10}],
+    }
+    return group, categories
+
+
+def load_menu() -> tuple[dict, list, str]:
+    if DATA_FILE.exists():
+        data = json.loads(DATA_FILE.read_text(encoding="utf-8"))
+        groups = data.get("menu_items") or []
+        if groups:
+            return groups[0], data.get("supplements") or [], str(DATA_FILE.name)
+    group, supps = synthetic_menu()
+    return group, supps, f"синтетическое меню, {ITEMS} позиций"
+
+
+def timed(fn, repeat: int = REPEAT) -> float:
+    """Среднее время вызова, мкс."""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def bench_snapshot(group: dict, supps: list) -> MenuSnapshot:
+    print("\n1. Память снимка меню")
+    snapshot = MenuSnapshot.from_ytimes(group, supps)
+    raw = deep_sizeof(group) + deep_sizeof(supps)
+    model = snapshot.footprint()
+    print(f"  исходный JSON (dict):   {raw / 1024:8.1f} КБ")
+    print(f"  MenuSnapshot:           {model / 1024:8.1f} КБ  (в {raw / model:.1f} раза меньше)")
+    return snapshot
+
+
+def bench_payload(group: dict, snapshot: MenuSnapshot) -> None:
+    print("\n2. Ответ /api/menu: размер и разбор на клиенте (json.loads)")
+    payloads = MenuPayloads(snapshot)
+    variants = [
+        ("старый (группа YTimes целиком)", dumps({"success": True, "data": group})),
+        ("проекция по умолчанию", payloads.menu()),
+        ("fields=guid,name", payloads.menu(parse_fields("guid,name"))),
+    ]
+    base = len(variants[0][1])
+    for name, body in variants:
+        parse_us = timed(lambda: json.loads(body))
+        print(f"  {name:32} {len(body) / 1024:8.1f} КБ ({len(body) / base:6.1%})  разбор {parse_us:8.1f} мкс")
+    old_us = timed(lambda: dumps({"success": True, "data": group}))
+    new_us = timed(lambda: payloads.menu())
+    print(f"  сериализация на запрос: было {old_us:.1f} мкс, стало {new_us:.2f} мкс (готовые байты)")
+
+
+def bench_search(snapshot: MenuSnapshot) -> None:
+    print("\n3. Поиск /api/menu/search")
+    started = time.perf_counter()
+    index = MenuSearchIndex(snapshot)
+    build_ms = (time.perf_counter() - started) * 1000
+    print(f"  построение индекса: {build_ms:.1f} мс, память {deep_sizeof(index) / 1024:.1f} КБ")
+    for query in ("латте", "latte", "капуч", "cappuccino", "350", "сироп карамель", "нет такого"):
+        found = index.search(query)
+        us = timed(lambda: index.search(query), repeat=REPEAT * 5)
+        print(f"  {query!r:18} позиций {len(found['items']):3}, добавок {len(found['supplements']):3}  {us:7.1f} мкс")
+
+
+def main() -> None:
+    group, supps, source = load_menu()
+    print(f"Данные: {source}")
+    snapshot = bench_snapshot(group, supps)
+    bench_payload(group, snapshot)
+    bench_search(snapshot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Выгрузка заказов и ожидающих платежей в CSV или JSON Lines с отчётом о продажах.
+
+Строки читаются из базы порциями (database.iter_orders / iter_pending_payments) и сразу
+пишутся в файл, поэтому память не зависит от числа заказов. Заказ раскрывается по
+позициям корзины: одна строка на позицию. В том же проходе считаются
+выручка по дням и по часам (UTC, без отменённых заказов) и топ позиций.
+--since-last выгружает только новое с прошлого запуска с тем же --state: последний
+выгруженный order_id (или created_at+payment_token) хранится в data/export_state.json.
+Статусы заказов — на момент выгрузки; отмена уже выгруженного заказа в следующий
+инкремент не попадёт.
+Использование:
+  python scripts/export_orders.py --from 2026-10-01 --to 2026-10-31 -o orders.csv --report
+  python scripts/export_orders.py --format jsonl --since-last -o orders-new.jsonl
+  python scripts/export_orders.py --what pending --format jsonl -o pending.jsonl
+  DATABASE_URL=postgresql://... python scripts/export_orders.py --report -o /dev/null
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import csv
+import json
+import sys
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from pathlib import Path
+from typing import AsyncIterator, Iterator, TextIO
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+SRC_DIR = ROOT_DIR / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+import database  # noqa: E402
+
+STATE_FILE = ROOT_DIR / "data" / "export_state.json"
+TOP_ITEMS = 10
+
+ORDER_FIELDS = [
+    "order_id", "ytimes_order_id", "created_at", "updated_at", "status", "user_telegram_id", "total_price",
+    "item_index", "menu_item_guid", "menu_type_guid", "quantity", "price", "line_total", "supplements",
+]
+PENDING_FIELDS = [
+    "payment_token", "created_at", "updated_at", "state", "total", "telegram_id", "site_user_id",
+    "link_card_only", "yookassa_payment_id", "order_guid", "last_error", "comment", "client_json", "items_json",
+]
+
+
+def order_lines(order: dict) -> Iterator[dict]:
+    """Строки выгрузки одного заказа: по одной на позицию (заказ без позиций — одна строка)."""
+    base = {k: order.get(k) for k in ORDER_FIELDS[:7]}
+    items = order.get("items")
+    if not isinstance(items, list) or not items:
+        yield {**base, "item_index": None}
+        return
+    for index, item in enumerate(items):
+        quantity = item.get("quantity", 1)
+        price = item.get("priceWithDiscount", 0)
+        yield {
+            **base,
+            "item_index": index,
+            "menu_item_guid": item.get("menuItemGuid"),
+            "menu_type_guid": item.get("menuTypeGuid"),
+            "quantity": quantity,
+            "price": price,
+            "line_total": round(price * quantity, 2),
+            "supplements": json.dumps(item.get("supplementList") or {}, ensure_ascii=False, sort_keys=True),
+        }
+
+
+class Report:
+    """Выручка по дням и часам и топ позиций — считаются по ходу выгрузки."""
+
+    def __init__(self) -> None:
+        self.orders = 0
+        self.cancelled = 0
+        self.revenue = 0.0
+        self.by_day: dict[str, list] = defaultdict(lambda: [0, 0.0])
+        self.by_hour: dict[str, list] = defaultdict(lambda: [0, 0.0])
+        self.item_quantity: Counter[str] = Counter()
+        self.item_revenue: Counter[str] = Counter()
+
+    def add_order(self, order: dict) -> None:
+        if order.get("status") == "CANCELLED":
+            self.cancelled += 1
+            return
+        created = order.get("created_at") or ""
+        total = float(order.get("total_price") or 0)
+        self.orders += 1
+        self.revenue += total
+        for bucket in (self.by_day[created[:10]], self.by_hour[created[:13]]):
+            bucket[0] += 1
+            bucket[1] += total
+
+    def add_line(self, line: dict) -> None:
+        if line.get("status") == "CANCELLED" or not line.get("menu_item_guid"):
+            return
+        key = line["menu_item_guid"]
+        self.item_quantity[key] += line["quantity"] or 0
+        self.item_revenue[key] += line["line_total"] or 0
+
+    def print(self, out: TextIO) -> None:
+        print(f"\nЗаказов: {self.orders} на {self.revenue:.2f} ₽, отменено: {self.cancelled}", file=out)
+        print("\nВыручка по дням (UTC):", file=out)
+        for day in sorted(self.by_day):
+            n, total = self.by_day[day]
+            print(f"  {day}  {n:6d} заказов  {total:12.2f} ₽", file=out)
+        print("\nВыручка по часам (UTC):", file=out)
+        for hour in sorted(self.by_hour):
+            n, total = self.by_hour[hour]
+            print(f"  {hour.replace('T', ' ')}:00  {n:6d} заказов  {total:12.2f} ₽", file=out)
+        print(f"\nТоп-{TOP_ITEMS} позиций по количеству:", file=out)
+        for guid, quantity in self.item_quantity.most_common(TOP_ITEMS):
+            print(f"  {guid}  {quantity:6d} шт.  {self.item_revenue[guid]:12.2f} ₽", file=out)
+
+
+class Writer:
+    """CSV с заголовком или JSON Lines."""
+
+    def __init__(self, out: TextIO, fmt: str, fields: list[str]) -> None:
+        self.out = out
+        self.rows = 0
+        self._csv = csv.DictWriter(out, fieldnames=fields, extrasaction="ignore") if fmt == "csv" else None
+        if self._csv is not None:
+            self._csv.writeheader()
+
+    def write(self, row: dict) -> None:
+        if self._csv is not None:
+            self._csv.writerow(row)
+        else:
+            self.out.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self.rows += 1
+
+
+def _load_state(path: Path) -> dict:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(path: Path, state: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.replace(path)
+
+
+async def export_orders(rows: AsyncIterator[dict], writer: Writer, report: Report | None) -> int | None:
+    """Выгрузить заказы; возвращает последний order_id (для --since-last)."""
+    last_id = None
+    async for order in rows:
+        if report is not None:
+            report.add_order(order)
+        for line in order_lines(order):
+            writer.write(line)
+            if report is not None:
+                report.add_line(line)
+        last_id = order["order_id"]
+    return last_id
+
+
+async def export_pending(rows: AsyncIterator[dict], writer: Writer) -> list[str] | None:
+    """Выгрузить ожидающие платежи; возвращает [created_at, payment_token] последнего."""
+    last = None
+    async for pending in rows:
+        writer.write({**pending, "items_json": json.dumps(pending["items"], ensure_ascii=False)})
+        last = [pending["created_at"], pending["payment_token"]]
+    return last
+
+
+def _period(args: argparse.Namespace) -> tuple[str, str]:
+    since = args.date_from.isoformat() if args.date_from else ""
+    # --to включительно: до начала следующего дня
+    until = (args.date_to + timedelta(days=1)).isoformat() if args.date_to else "9999"
+    return since, until
+
+
+async def run(args: argparse.Namespace, out: TextIO) -> None:
+    since, until = _period(args)
+    state = _load_state(args.state) if args.since_last else {}
+    report = Report() if args.report and args.what == "orders" else None
+    await database.init_db()
+    try:
+        if args.what == "orders":
+            writer = Writer(out, args.format, ORDER_FIELDS)
+            rows = database.iter_orders(since, until, after_id=state.get("orders", 0), chunk_size=args.chunk_size)
+            last = await export_orders(rows, writer, report)
+        else:
+            writer = Writer(out, args.format, PENDING_FIELDS)
+            after = tuple(state.get("pending") or ("", ""))
+            rows = database.iter_pending_payments(since, until, after=after, chunk_size=args.chunk_size)
+            last = await export_pending(rows, writer)
+    finally:
+        await database.close_db()
+    out.flush()
+    if args.since_last and last is not None:
+        _save_state(args.state, {**state, args.what: last})
+    print(f"✅ Выгружено строк: {writer.rows}", file=sys.stderr)
+    if report is not None:
+        report.print(sys.stderr)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Выгрузка заказов и ожидающих платежей (CSV / JSON Lines).")
+    parser.add_argument("--what", choices=("orders", "pending"), default="orders", help="Что выгружать")
+    parser.add_argument("--from", dest="date_from", type=date.fromisoformat, help="С даты (UTC), ГГГГ-ММ-ДД")
+    parser.add_argument("--to", dest="date_to", type=date.fromisoformat, help="По дату включительно (UTC)")
+    parser.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    parser.add_argument("-o", "--output", type=Path, help="Файл (по умолчанию stdout)")
+    parser.add_argument("--since-last", action="store_true", help="Только новое с прошлой выгрузки")
+    parser.add_argument("--state", type=Path, default=STATE_FILE, help="Файл состояния для --since-last")
+    parser.add_argument("--report", action="store_true", help="Выручка по дням/часам и топ позиций (в stderr)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Строк за одно обращение к базе")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.output is None:
+        asyncio.run(run(args, sys.stdout))
+        return
+    with open(args.output, "w", encoding="utf-8", newline="") as out:
+        asyncio.run(run(args, out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Локальный фейковый сервер ЮKassa и проверка клиента webapp.yookassa_client.
+
+Сервер понимает POST /v3/payments (с Idempotence-Key, как настоящий: повтор с тем же
+ключом возвращает тот же платёж) и GET /v3/payments/{id}. Часть ответов специально
+ломается: 500 после создания платежа, 202 «в обработке», задержка дольше таймаута клиента.
+
+Использование:
+  python scripts/fake_yookassa.py                  # проверка клиента под сбоями
+  FAIL_RATE=0.5 PAYMENTS=50 python scripts/fake_yookassa.py
+  python scripts/fake_yookassa.py serve            # только сервер (PORT, по умолчанию 8765)
+    затем в .env: YOOKASSA_API_URL=http://127.0.0.1:8765/v3, YOOKASSA_SHOP_ID/SECRET_KEY — любые
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from random import Random
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+SRC_DIR = ROOT_DIR / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+import uvicorn  # noqa: E402
+from fastapi import FastAPI, Header, Request  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+
+from webapp.yookassa_client import YooKassaClient  # noqa: E402
+
+PORT = int(os.getenv("PORT", "8765"))
+FAIL_RATE = float(os.getenv("FAIL_RATE", "0.3"))
+PAYMENTS = int(os.getenv("PAYMENTS", "30"))
+CALLS = int(os.getenv("CALLS", "3"))  # параллельных вызовов create_payment на один payment_token
+CONCURRENCY = int(os.getenv("CONCURRENCY", "16"))  # одновременных запросов (не больше пула клиента)
+CLIENT_TIMEOUT = 1.0
+
+
+def make_app(fail_rate: float = 0.0, seed: int = 1) -> FastAPI:
+    app = FastAPI(title="Fake YooKassa")
+    rnd = Random(seed)
+    app.state.payments = {}  # id -> платёж
+    app.state.by_key = {}  # Idempotence-Key -> id
+    app.state.requests = Counter()
+
+    @app.post("/v3/payments")
+    async def create_payment(request: Request, idempotence_key: str | None = Header(None)):
+        app.state.requests["create"] += 1
+        if not idempotence_key:
+            return JSONResponse({"type": "error", "code": "invalid_request", "description": "Idempotence-Key required"}, 400)
+        body = await request.json()
+        if float(body.get("amount", {}).get("value") or 0) <= 0:
+            return JSONResponse({"type": "error", "code": "invalid_request", "parameter": "amount"}, 400)
+        roll = rnd.random()
+        if roll < fail_rate / 3:
+            # Клиент не дождётся ответа, а платёж всё равно будет создан
+            await asyncio.sleep(CLIENT_TIMEOUT * 1.5)
+        elif roll < fail_rate * 2 / 3:
+            return JSONResponse({"type": "processing", "retry_after": 50}, 202)
+        payment_id = app.state.by_key.get(idempotence_key)
+        if payment_id is None:
+            payment_id = str(uuid.uuid4())
+            app.state.by_key[idempotence_key] = payment_id
+            payment = {
+                "id": payment_id,
+                "status": "pending",
+                "amount": body["amount"],
+                "metadata": body.get("metadata") or {},
+            }
+            method_id = body.get("payment_method_id")
+            if method_id:
+                # Списание с сохранённой карты: без подтверждения, сразу финальный статус
+                payment["payment_method"] = {"id": method_id, "saved": True}
+                if method_id == "revoked":
+                    payment["status"] = "canceled"
+                    payment["cancellation_details"] = {"party": "yoo_money", "reason": "permission_revoked"}
+                else:
+                    payment["status"] = "succeeded"
+            else:
+                payment["confirmation"] = {"type": "redirect", "confirmation_url": f"http://127.0.0.1:{PORT}/pay/{payment_id}"}
+                payment["payment_method"] = {"id": payment_id, "saved": bool(body.get("save_payment_method"))}
+            app.state.payments[payment_id] = payment
+        if fail_rate / 3 * 2 <= roll < fail_rate:
+            return JSONResponse({"type": "error", "code": "internal_server_error"}, 500)
+        return app.state.payments[payment_id]
+
+    @app.get("/v3/payments/{payment_id}")
+    async def get_payment(payment_id: str):
+        app.state.requests["get"] += 1
+        payment = app.state.payments.get(payment_id)
+        if not payment:
+            return JSONResponse({"type": "error", "code": "not_found"}, 404)
+        # Как будто пользователь оплатил
+        return {**payment, "status": "succeeded"}
+
+    return app
+
+
+def _serve(app: FastAPI, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def check(app: FastAPI) -> bool:
+    client = YooKassaClient(
+        "shop", "secret", base_url=f"http://127.0.0.1:{PORT}/v3", timeout=CLIENT_TIMEOUT, max_attempts=6, backoff=0.05
+    )
+    tokens = [uuid.uuid4().hex for _ in range(PAYMENTS)]
+    limit = asyncio.Semaphore(CONCURRENCY)
+
+    async def create(token: str) -> str | None:
+        async with limit:
+            resp = await client.create_payment(
+                payment_token=token, amount_rub=100.0, description="Тест", return_url="http://localhost/return"
+            )
+        return resp["id"] if resp else None
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(create(t) for t in tokens for _ in range(CALLS)))
+    elapsed = time.perf_counter() - started
+    ok = True
+    by_token: dict[str, set] = {}
+    for i, payment_id in enumerate(results):
+        by_token.setdefault(tokens[i // CALLS], set()).add(payment_id)
+    failed = sum(1 for r in results if r is None)
+    split = [t for t, ids in by_token.items() if len(ids - {None}) > 1]
+    created = len(app.state.payments)
+    print(f"create_payment: {len(results)} вызовов за {elapsed:.2f} с, запросов к серверу {app.state.requests['create']}")
+    print(f"  платежей на сервере: {created} (ожидается {PAYMENTS}), неудачных вызовов: {failed}")
+    if split or created > PAYMENTS:
+        print(f"  ОШИБКА: на один payment_token создано несколько платежей: {split[:5]}")
+        ok = False
+
+    some_id = next(iter(app.state.payments), None)
+    if some_id:
+        payment = await client.get_payment(some_id)
+        ok = ok and bool(payment and payment["status"] == "succeeded")
+    # Списание с сохранённой карты
+    charged = await client.charge_saved_method(
+        payment_token="charge-1", payment_method_id="pm-1", amount_rub=250.0, description="Повтор заказа"
+    )
+    again = await client.charge_saved_method(
+        payment_token="charge-1", payment_method_id="pm-1", amount_rub=250.0, description="Повтор заказа"
+    )
+    revoked = await client.charge_saved_method(
+        payment_token="charge-2", payment_method_id="revoked", amount_rub=250.0, description="Повтор заказа"
+    )
+    if not charged or charged.get("status") != "succeeded" or not again or again["id"] != charged["id"]:
+        print(f"  ОШИБКА: списание с сохранённой карты: {charged} / {again}")
+        ok = False
+    if not revoked or revoked.get("status") != "canceled":
+        print(f"  ОШИБКА: отозванная карта должна дать canceled: {revoked}")
+        ok = False
+    # 4xx не повторяется
+    before = app.state.requests["create"]
+    bad = await client.create_payment(payment_token="bad", amount_rub=0, description="", return_url="")
+    if bad is not None or app.state.requests["create"] - before != 1:
+        print("  ОШИБКА: 400 должен вернуться без повторов")
+        ok = False
+    print("Метрики клиента:")
+    for op, s in client.stats().items():
+        print(f"  {op:15} {s}")
+    await client.aclose()
+    return ok
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        uvicorn.run(make_app(FAIL_RATE), host="127.0.0.1", port=PORT)
+        return
+    app = make_app(FAIL_RATE)
+    server = _serve(app, PORT)
+    try:
+        ok = asyncio.run(check(app))
+    finally:
+        server.should_exit = True
+    print("OK" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
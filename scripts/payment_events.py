@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Запросы к журналу событий оплаты (data/payment_events.db, см. webapp.payment_events).
+
+Команды:
+  funnel    — число событий каждого типа за период (--by-day — по дням UTC);
+  count     — число одного события за период;
+  timeline  — все события одного платежа по payment_token;
+  import    — перенести старый data/payment.log (JSON-строки) в хранилище;
+  bench     — заполнить временную базу синтетическими событиями за несколько месяцев
+              и замерить время запросов.
+Использование:
+  python scripts/payment_events.py funnel --hours 1
+  python scripts/payment_events.py funnel --days 30 --by-day
+  python scripts/payment_events.py count create_inapp_yookassa_fail --hours 1
+  python scripts/payment_events.py timeline 3f2a...
+  python scripts/payment_events.py import data/payment.log
+  python scripts/payment_events.py bench --events 2000000
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import closing
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+SRC_DIR = ROOT_DIR / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+from webapp import payment_events  # noqa: E402
+
+# Типичный путь платежа в приложении (для bench)
+_FLOW = [
+    "create_inapp_pending_created",
+    "create_inapp_ok",
+    "return_start",
+    "return_pending_found",
+    "return_yookassa_succeeded",
+    "return_order_start",
+    "return_order_ok",
+    "return_success",
+]
+
+
+def _since_ms(args: argparse.Namespace) -> int:
+    seconds = args.hours * 3600 if args.hours is not None else args.days * 86400
+    return int((time.time() - seconds) * 1000)
+
+
+def cmd_funnel(args: argparse.Namespace) -> None:
+    with closing(payment_events.connect(args.db)) as conn:
+        counts = payment_events.funnel(conn, _since_ms(args), by_day=args.by_day)
+    if args.by_day:
+        for day, events in counts.items():
+            print(day)
+            for event, n in events.items():
+                print(f"  {event:<40} {n}")
+    else:
+        for event, n in counts.items():
+            print(f"{event:<40} {n}")
+    if not counts:
+        print("Событий за период нет.")
+
+
+def cmd_count(args: argparse.Namespace) -> None:
+    with closing(payment_events.connect(args.db)) as conn:
+        print(payment_events.count(conn, args.event, _since_ms(args)))
+
+
+def cmd_timeline(args: argparse.Namespace) -> None:
+    with closing(payment_events.connect(args.db)) as conn:
+        events = payment_events.timeline(conn, args.payment_token)
+    if not events:
+        print("События не найдены.")
+        raise SystemExit(1)
+    for item in events:
+        at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(item["ts"] / 1000))
+        extra = {k: v for k, v in item.items() if k not in ("event", "ts", "payment_token")}
+        print(f"{at}  {item['event']:<32} {json.dumps(extra, ensure_ascii=False)}")
+
+
+def cmd_import(args: argparse.Namespace) -> None:
+    imported = skipped = 0
+    batch: list[dict] = []
+    with closing(payment_events.connect(args.db)) as conn, open(args.file, encoding="utf-8") as f:
+        for line in f:
+            try:
+                batch.append(json.loads(line))
+            except ValueError:
+                skipped += 1
+                continue
+            if len(batch) >= 5000:
+                imported += payment_events.insert_many(conn, batch)
+                batch.clear()
+        imported += payment_events.insert_many(conn, batch)
+    print(f"✅ Перенесено событий: {imported}" + (f", пропущено битых строк: {skipped}" if skipped else ""))
+
+
+def _timed(name: str, fn, *args) -> None:
+    started = time.perf_counter()
+    result = fn(*args)
+    ms = (time.perf_counter() - started) * 1000
+    size = len(result) if isinstance(result, (list, dict)) else result
+    print(f"  {name:<42} {ms:8.1f} мс  ({size})")
+
+
+def cmd_bench(args: argparse.Namespace) -> None:
+    path = Path(tempfile.mkdtemp(prefix="bench_payment_events_")) / "payment_events.db"
+    now_ms = int(time.time() * 1000)
+    span_ms = args.days * 86_400_000
+    rng = random.Random(1)
+    conn = payment_events.connect(path)
+    started = time.perf_counter()
+    tokens: list[str] = []
+    written = 0
+    while written < args.events:
+        batch = []
+        for _ in range(min(10_000, (args.events - written) // len(_FLOW) + 1)):
+            token = uuid.uuid4().hex
+            ts = now_ms - rng.randrange(span_ms)
+            # Примерно каждый десятый платёж обрывается на ЮKassa
+            steps = _FLOW if rng.random() > 0.1 else _FLOW[:1] + ["create_inapp_yookassa_fail"]
+            for i, event in enumerate(steps):
+                batch.append({"event": event, "ts": ts + i * 1500, "payment_token": token, "total": 350})
+            tokens.append(token)
+        written += payment_events.insert_many(conn, batch)
+    print(f"Записано {written} событий за {args.days} дн. за {time.perf_counter() - started:.1f} с ({path})")
+    hour_ago = now_ms - 3_600_000
+    token = tokens[len(tokens) // 2]
+    _timed("funnel за час", payment_events.funnel, conn, hour_ago)
+    _timed("funnel за сутки", payment_events.funnel, conn, now_ms - 86_400_000)
+    _timed("count create_inapp_yookassa_fail за час", payment_events.count, conn, "create_inapp_yookassa_fail", hour_ago)
+    _timed("count create_inapp_yookassa_fail за 30 дн.", payment_events.count, conn, "create_inapp_yookassa_fail", now_ms - 30 * 86_400_000)
+    _timed("timeline одного платежа", payment_events.timeline, conn, token)
+    _timed("prune (хранение 30 дн.)", payment_events.prune, conn, 30)
+    conn.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Запросы к журналу событий оплаты.")
+    parser.add_argument("--db", type=Path, default=payment_events.EVENTS_DB, help="Файл хранилища событий")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def period(p: argparse.ArgumentParser) -> None:
+        p.add_argument("--hours", type=float, help="За последние N часов")
+        p.add_argument("--days", type=float, default=1, help="За последние N дней (если не задано --hours)")
+
+    p = sub.add_parser("funnel", help="Число событий каждого типа за период")
+    period(p)
+    p.add_argument("--by-day", action="store_true", help="Разбить по дням (UTC)")
+    p.set_defaults(fn=cmd_funnel)
+    p = sub.add_parser("count", help="Число одного события за период")
+    p.add_argument("event")
+    period(p)
+    p.set_defaults(fn=cmd_count)
+    p = sub.add_parser("timeline", help="События одного платежа")
+    p.add_argument("payment_token")
+    p.set_defaults(fn=cmd_timeline)
+    p = sub.add_parser("import", help="Перенести payment.log в хранилище")
+    p.add_argument("file", type=Path)
+    p.set_defaults(fn=cmd_import)
+    p = sub.add_parser("bench", help="Замер запросов на синтетических данных")
+    p.add_argument("--events", type=int, default=1_000_000)
+    p.add_argument("--days", type=int, default=180)
+    p.set_defaults(fn=cmd_bench)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -44,15 +44,15 @@ def test_menu():
     """Проверка /api/menu (без авторизации)."""
     print("\n2. API меню")
     try:
-        r = httpx.get(f"{BASE_URL}/api/menu", timeout=TIMEOUT)
+        r = httpx.get(f"{BASE_URL}/api/menu", params={"fields": "guid,name"}, timeout=TIMEOUT)
         if r.status_code != 200:
             return fail("GET /api/menu", f"status={r.status_code} body={r.text[:200]}")
         data = r.json()
         if "error" in data:
             return fail("GET /api/menu", data["error"])
-        groups = data.get("menu_groups") or []
-        items = data.get("menu_items") or []
-        ok("GET /api/menu", r.status_code, f"групп: {len(groups)}, меню: {len(items)}")
+        group = data.get("data") or {}
+        items = group.get("itemList") or []
+        ok("GET /api/menu", r.status_code, f"группа: {group.get('name')}, позиций: {len(items)}")
         return True
     except Exception as e:
         return fail("GET /api/menu", str(e))
@@ -68,7 +68,8 @@ def test_supplements():
         data = r.json()
         if "error" in data:
             return fail("GET /api/supplements", data["error"])
-        count = len(data) if isinstance(data, list) else 0
+        categories = data.get("data") or []
+        count = len(categories) if isinstance(categories, list) else 0
         ok("GET /api/supplements", r.status_code, f"записей: {count}")
         return True
     except Exception as e:
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Нагрузочная проверка допуска запросов: путь заказа перегружен, меню и /health отвечают.
+
+Приложение запускается в uvicorn на временной БД, YTimes подменён медленным фейком
+(create_order спит YTIMES_DELAY секунд). Одновременно отправляется ORDERS запросов
+POST /api/order и в это же время измеряются задержки GET /api/menu и /health.
+Проверяется: лишние заказы получают 503 с Retry-After быстро, меню отвечает без задержек.
+Монитор event loop (LOOP_MONITOR) включён: в конце печатаются задержка loop и места блокировок.
+Использование:
+  python scripts/stress_admission.py
+  ORDERS=200 YTIMES_DELAY=3 python scripts/stress_admission.py
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+SRC_DIR = ROOT_DIR / "src"
+for path in (str(ROOT_DIR), str(SRC_DIR)):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+
+from bench_menu import synthetic_menu  # noqa: E402
+
+PORT = int(os.getenv("PORT", "8767"))
+ORDERS = int(os.getenv("ORDERS", "100"))
+YTIMES_DELAY = float(os.getenv("YTIMES_DELAY", "2"))
+MENU_PROBES = int(os.getenv("MENU_PROBES", "50"))
+os.environ.setdefault("LOOP_MONITOR", "1")
+
+
+class SlowYTimes:
+    """Заменитель YTimesAPIClient: меню сразу, заказ — с задержкой кассы."""
+
+    default_shop_guid = "shop"
+
+    def __init__(self) -> None:
+        group, supplements = synthetic_menu()
+        self._menu = [group]
+        self._supplements = supplements
+        self.orders = 0
+
+    def get_menu_items(self) -> list:
+        return self._menu
+
+    def get_supplements(self) -> list:
+        return self._supplements
+
+    def create_order(self, *, order_guid: str, **kwargs) -> dict:
+        time.sleep(YTIMES_DELAY)
+        self.orders += 1
+        return {"guid": order_guid, "status": "CREATED"}
+
+
+def _start_app():
+    from database import db
+    db.DB_PATH = Path(tempfile.mkdtemp(prefix="stress_admission_")) / "bot.db"
+    import webapp.payment_log as payment_log
+    payment_log.log = lambda event, **kwargs: None
+    from webapp import app as webapp
+    webapp.payment_log = payment_log.log
+    fake = SlowYTimes()
+    webapp.YTimesAPIClient.from_env = staticmethod(lambda: fake)
+    server = uvicorn.Server(uvicorn.Config(webapp.app, host="127.0.0.1", port=PORT, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, fake
+
+
+async def _order(client: httpx.AsyncClient, i: int) -> tuple[int, float, str | None]:
+    body = {
+        "items": [{"menuItemGuid": f"item{i}", "priceWithDiscount": 100, "quantity": 1, "supplementList": {}}],
+        "client": {"name": "Нагрузка", "phone": "79990000000"},
+    }
+    started = time.perf_counter()
+    r = await client.post("/api/order", json=body)
+    return r.status_code, time.perf_counter() - started, r.headers.get("retry-after")
+
+
+async def _probe(client: httpx.AsyncClient, path: str) -> list[float]:
+    latencies = []
+    for _ in range(MENU_PROBES):
+        started = time.perf_counter()
+        r = await client.get(path)
+        r.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(YTIMES_DELAY / MENU_PROBES)
+    return latencies
+
+
+def _ms(values: list[float]) -> str:
+    ordered = sorted(values)
+    p95 = ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+    return f"медиана {statistics.median(ordered) * 1000:.1f} мс, p95 {p95 * 1000:.1f} мс"
+
+
+async def run() -> bool:
+    limits = httpx.Limits(max_connections=ORDERS + 10)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", timeout=60.0, limits=limits) as client:
+        orders = asyncio.gather(*(_order(client, i) for i in range(ORDERS)))
+        menu, health = await asyncio.gather(_probe(client, "/api/menu"), _probe(client, "/health"))
+        results = await orders
+        final_health = (await client.get("/health")).json()
+    stats = final_health.get("admission", {})
+    loop_stats = final_health.get("event_loop")
+    codes = Counter(code for code, _, _ in results)
+    shed = [latency for code, latency, _ in results if code == 503]
+    missing_retry_after = sum(1 for code, _, ra in results if code == 503 and not ra)
+    print(f"Заказов: {ORDERS}, ответы: {dict(codes)}")
+    if shed:
+        print(f"  503: {_ms(shed)}, без Retry-After: {missing_retry_after}")
+    print(f"  /api/menu во время нагрузки: {_ms(menu)}")
+    print(f"  /health во время нагрузки:   {_ms(health)}")
+    print(f"  admission: {stats.get('order')}")
+    if loop_stats:
+        print(
+            f"  event loop: p99 {loop_stats['p99_ms']} мс, max {loop_stats['max_ms']} мс, "
+            f"остановок > {loop_stats['threshold_ms']} мс: {loop_stats['stalls']} {loop_stats['top_sites'] or ''}"
+        )
+    ok = codes[200] > 0 and missing_retry_after == 0 and max(menu) < YTIMES_DELAY / 2
+    if shed:
+        ok = ok and max(shed) < 3.0 + YTIMES_DELAY
+    return ok
+
+
+def main() -> None:
+    server, fake = _start_app()
+    try:
+        ok = asyncio.run(run())
+    finally:
+        server.should_exit = True
+    print(f"Заказов дошло до YTimes: {fake.orders}")
+    print("✅ Меню отвечает, лишние заказы отклонены с Retry-After." if ok else "❌ Проверка не прошла.")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
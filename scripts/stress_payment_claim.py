@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Стресс-проверка захвата ожидающих платежей: ровно один заказ на платёж.
+
+Несколько процессов (как воркеры uvicorn) параллельно вызывают create_order_from_payment
+для одних и тех же payment_token на общей временной SQLite. YTimes подменён фейком,
+который считает вызовы. Проверяется: на каждый платёж — один вызов YTimes и одна строка в orders.
+Использование:
+  python scripts/stress_payment_claim.py
+  WORKERS=8 PAYMENTS=50 CALLS=6 python scripts/stress_payment_claim.py
+"""
+
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+SRC_DIR = ROOT_DIR / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+WORKERS = int(os.getenv("WORKERS", "4"))
+PAYMENTS = int(os.getenv("PAYMENTS", "20"))
+CALLS = int(os.getenv("CALLS", "4"))  # параллельных вызовов на платёж в каждом процессе
+
+
+class FakeYTimes:
+    """Заменитель YTimesAPIClient: медленный create_order, считает вызовы."""
+
+    default_shop_guid = "shop"
+
+    def __init__(self) -> None:
+        self.calls: Counter[str] = Counter()
+
+    def create_order(self, *, order_guid: str, **kwargs) -> dict:
+        time.sleep(0.05)
+        self.calls[order_guid] += 1
+        return {"guid": order_guid, "status": "CREATED"}
+
+
+def _worker(db_path: str, tokens: list[str]) -> dict:
+    from database import db
+    db.DB_PATH = Path(db_path)
+    import webapp.payment_log as payment_log
+    payment_log.log = lambda event, **kwargs: None
+    import webapp.order_service as order_service
+    order_service.payment_log = payment_log.log
+
+    fake = FakeYTimes()
+
+    async def one(token: str) -> str:
+        try:
+            result = await order_service.create_order_from_payment(fake, token)
+            return "ok" if not result["replayed"] else "replayed"
+        except order_service.OrderFromPaymentError as e:
+            return e.reason
+
+    async def run() -> Counter:
+        outcomes = await asyncio.gather(*(one(t) for t in tokens for _ in range(CALLS)))
+        return Counter(outcomes)
+
+    outcomes = asyncio.run(run())
+    return {"calls": dict(fake.calls), "outcomes": dict(outcomes)}
+
+
+async def _prepare(db_path: str, tokens: list[str]) -> None:
+    from database import db
+    db.DB_PATH = Path(db_path)
+    await db.init_db()
+    items = [{"menuItemGuid": "item", "priceWithDiscount": 100, "quantity": 1}]
+    for token in tokens:
+        await db.create_pending_payment(token, 1, items, 100.0)
+
+
+def main() -> None:
+    tmp = tempfile.mkdtemp(prefix="stress_claim_")
+    db_path = os.path.join(tmp, "bot.db")
+    tokens = [f"token{i:04d}" for i in range(PAYMENTS)]
+    asyncio.run(_prepare(db_path, tokens))
+    print(f"Процессов: {WORKERS}, платежей: {PAYMENTS}, вызовов на платёж в процессе: {CALLS}")
+
+    started = time.perf_counter()
+    with multiprocessing.Pool(WORKERS) as pool:
+        results = pool.starmap(_worker, [(db_path, tokens)] * WORKERS)
+    elapsed = time.perf_counter() - started
+
+    calls: Counter[str] = Counter()
+    outcomes: Counter[str] = Counter()
+    for r in results:
+        calls.update(r["calls"])
+        outcomes.update(r["outcomes"])
+    with sqlite3.connect(db_path) as conn:
+        orders = Counter(row[0] for row in conn.execute("SELECT ytimes_order_id FROM orders"))
+        states = Counter(row[0] for row in conn.execute("SELECT state FROM pending_payments"))
+
+    print(f"Время: {elapsed:.2f} с, исходы вызовов: {dict(outcomes)}")
+    print(f"Состояния платежей: {dict(states)}")
+    dup_calls = {g: n for g, n in calls.items() if n != 1}
+    dup_orders = {g: n for g, n in orders.items() if n != 1}
+    ok = len(calls) == PAYMENTS and len(orders) == PAYMENTS and not dup_calls and not dup_orders
+    if ok:
+        print(f"✅ Ровно один заказ на каждый из {PAYMENTS} платежей.")
+    else:
+        print(f"❌ Вызовов YTimes: {len(calls)}, заказов: {len(orders)}, дубли: {dup_calls or dup_orders}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
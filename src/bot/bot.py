@@ -26,7 +26,7 @@ if str(SRC_DIR) not in sys.path:
 # Загружаем переменные окружения
 load_dotenv(ROOT_DIR / ".env")
 
-from bot.handlers import router
+from bot.handlers import close_backend_client, router
 from database import init_db
 
 
@@ -69,7 +69,10 @@ async def main() -> None:
 
     # Запуск polling
     print("Бот запущен...")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await close_backend_client()
 
 
 if __name__ == "__main__":
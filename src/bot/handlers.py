@@ -7,7 +7,9 @@
 
 from __future__ import annotations
 
+import asyncio
 import os
+from collections import OrderedDict
 from typing import TYPE_CHECKING
 
 import httpx
@@ -45,6 +47,109 @@ def _bot_secret() -> str:
     return os.getenv("BOT_INTERNAL_SECRET", "").strip()
 
 
+# Как бот создаёт заказ после оплаты: "http" — через backend (POST /api/order-from-payment),
+# "inprocess" — напрямую через order_service (бот и web на одном хосте и с общей БД).
+BOT_ORDER_MODE = os.getenv("BOT_ORDER_MODE", "http").strip().lower()
+
+# Повторы запроса к backend: сетевые ошибки, таймауты и 5xx (эндпоинт идемпотентен по payment_token)
+_BACKEND_RETRIES = 3
+_BACKEND_RETRY_DELAY = 0.5  # секунд, удваивается с каждой попыткой
+_BACKEND_MAX_RETRY_AFTER = 10.0  # дольше Retry-After не ждём: пользователь ждёт ответа в чате
+
+# Деньги уже списаны, а заказ ещё создаётся (409 — платёж у другого обработчика, backend недоступен)
+_ORDER_PENDING = {
+    "success": False,
+    "pending": True,
+    "error": "Оплата получена, заказ ещё обрабатывается. Если подтверждение не придёт "
+    "в течение нескольких минут, напишите в поддержку.",
+}
+
+_backend_client: httpx.AsyncClient | None = None
+_ytimes_client = None
+
+# Уже обработанные оплаты (telegram_payment_charge_id): повторная доставка апдейта не создаёт второй заказ
+_HANDLED_PAYMENTS_MAX = 1000
+_handled_payments: OrderedDict[str, bool] = OrderedDict()
+
+
+def _get_backend_client() -> httpx.AsyncClient:
+    """Общий пул соединений к backend (создаётся при первом вызове)."""
+    global _backend_client
+    if _backend_client is None:
+        _backend_client = httpx.AsyncClient(
+            base_url=_backend_url(),
+            timeout=15.0,
+            transport=httpx.AsyncHTTPTransport(retries=1),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
+    return _backend_client
+
+
+async def close_backend_client() -> None:
+    """Закрыть пул соединений к backend (при остановке бота)."""
+    global _backend_client
+    if _backend_client is not None:
+        await _backend_client.aclose()
+        _backend_client = None
+
+
+async def _order_from_payment_http(payment_token: str, chat_id: int) -> dict:
+    """Создать заказ через backend. Возвращает тело ответа или {"success": False, ...}."""
+    secret = _bot_secret()
+    if not secret:
+        return {"success": False, "error": "Ошибка настройки. Заказ не создан. Обратитесь в поддержку."}
+    client = _get_backend_client()
+    delay = _BACKEND_RETRY_DELAY
+    for attempt in range(1, _BACKEND_RETRIES + 1):
+        try:
+            r = await client.post(
+                "/api/order-from-payment",
+                headers={"X-Bot-Secret": secret},
+                json={"payment_token": payment_token, "telegram_id": chat_id},
+            )
+        except httpx.HTTPError as e:
+            print(f"order-from-payment: попытка {attempt}, ошибка сети: {e}")
+            r = None
+        if r is not None and r.status_code < 500:
+            if r.status_code == 200:
+                return r.json()
+            if r.status_code == 409:
+                return _ORDER_PENDING
+            try:
+                return {"success": False, "error": r.json().get("error")}
+            except (ValueError, AttributeError):
+                return {"success": False, "error": None}
+        if attempt < _BACKEND_RETRIES:
+            # 503 с Retry-After: backend перегружен или касса отключена автоматом защиты
+            retry_after = r.headers.get("retry-after") if r is not None and r.status_code == 503 else None
+            await asyncio.sleep(min(float(retry_after), _BACKEND_MAX_RETRY_AFTER) if retry_after and retry_after.isdigit() else delay)
+            delay *= 2
+    return _ORDER_PENDING
+
+
+async def _order_from_payment_inprocess(payment_token: str, chat_id: int) -> dict:
+    """Создать заказ напрямую, без HTTP к backend."""
+    global _ytimes_client
+    from webapp.order_service import OrderFromPaymentError, create_order_from_payment
+    from ytimes import YTimesAPIClient, YTimesAPIError
+
+    try:
+        if _ytimes_client is None:
+            _ytimes_client = YTimesAPIClient.from_env()
+        return await create_order_from_payment(_ytimes_client, payment_token, telegram_id=chat_id)
+    except OrderFromPaymentError as e:
+        if e.status_code == 409:
+            return _ORDER_PENDING
+        return {"success": False, "error": str(e)}
+    except YTimesAPIError as e:
+        print(f"order-from-payment (inprocess): {e}")
+        return {"success": False, "error": None}
+    except Exception as e:
+        # Настройка YTimes, ошибка БД и т.п.: ответить пользователю и дать Telegram повторить апдейт
+        print(f"order-from-payment (inprocess): {type(e).__name__}: {e}")
+        return {"success": False, "error": None}
+
+
 class SuccessfulPaymentFilter(Filter):
     """Фильтр только для сообщений с successful_payment."""
 
@@ -113,28 +218,35 @@ async def handle_pre_checkout(pre_checkout_query: PreCheckoutQuery) -> None:
 @router.message(SuccessfulPaymentFilter())
 async def handle_successful_payment(message: Message) -> None:
     """После успешной оплаты: создать заказ на backend и уведомить пользователя."""
-    payload = message.successful_payment.invoice_payload
-    total = message.successful_payment.total_amount / 100  # копейки -> рубли
-    secret = _bot_secret()
-    if not secret:
-        await message.answer("❌ Ошибка настройки. Заказ не создан. Обратитесь в поддержку.")
+    payment = message.successful_payment
+    payload = payment.invoice_payload
+    total = payment.total_amount / 100  # копейки -> рубли
+    charge_id = payment.telegram_payment_charge_id or payload
+    if charge_id in _handled_payments:
         return
-    base = _backend_url()
+    _handled_payments[charge_id] = True
+    while len(_handled_payments) > _HANDLED_PAYMENTS_MAX:
+        _handled_payments.popitem(last=False)
     chat_id = message.chat.id
-    async with httpx.AsyncClient(timeout=15.0) as client:
-        r = await client.post(
-            f"{base}/api/order-from-payment",
-            headers={"X-Bot-Secret": secret, "Content-Type": "application/json"},
-            json={"payment_token": payload, "telegram_id": chat_id},
-        )
-    if r.status_code != 200:
-        await message.answer(
-            "❌ Оплата прошла, но не удалось создать заказ. Деньги не списаны. Обратитесь в поддержку."
-        )
-        return
-    body = r.json()
+    try:
+        if BOT_ORDER_MODE == "inprocess":
+            body = await _order_from_payment_inprocess(payload, chat_id)
+        else:
+            body = await _order_from_payment_http(payload, chat_id)
+    except Exception as e:
+        # Иначе charge_id остался бы в _handled_payments и повторная доставка была бы пропущена
+        print(f"order-from-payment: {type(e).__name__}: {e}")
+        body = {"success": False, "error": None}
     if not body.get("success"):
-        await message.answer("❌ " + (body.get("error") or "Заказ не создан."))
+        # Разрешаем повторную обработку: заказ не создан
+        _handled_payments.pop(charge_id, None)
+        error = body.get("error")
+        if body.get("pending"):
+            await message.answer("⏳ " + error)
+        elif error:
+            await message.answer("❌ " + error)
+        else:
+            await message.answer("❌ Оплата прошла, но заказ пока не создан. Обратитесь в поддержку.")
         return
     order_id = body.get("order_id", "")
     await message.answer(
@@ -144,4 +256,3 @@ async def handle_successful_payment(message: Message) -> None:
         f"💳 Оплачено онлайн\n\n"
         "Спасибо за заказ!"
     )
-
@@ -1,40 +1,94 @@
-"""Модуль работы с базой данных."""
+"""Модуль работы с базой данных.
+
+Бэкенд выбирается при импорте: PostgreSQL (database.postgres), если DATABASE_URL задан как
+postgresql://..., иначе SQLite-файл (database.db). Оба модуля реализуют одинаковый набор
+функций из __all__ с одинаковыми сигнатурами и результатами. Время запросов по фазам
+(query_stats) пока снимается только для SQLite.
+"""
+
+import os
 
 from . import db
-from .db import (
-    init_db,
-    get_user,
-    create_user,
-    update_user_phone,
-    create_order,
-    get_order_by_ytimes_guid,
-    update_order_status,
-    create_pending_payment,
-    get_pending_payment,
-    delete_pending_payment,
-    set_pending_yookassa_id,
-    create_site_user,
-    get_site_user_by_phone,
-    get_site_user_by_id,
-    update_site_user_saved_payment_method,
-)
+from .query_timing import query_stats
+from .write_batch import group_commit_stats
+
+_url = os.getenv("DATABASE_URL", "").strip()
+BACKEND = "postgres" if _url.startswith(("postgres://", "postgresql://")) else "sqlite"
+
+if BACKEND == "postgres":
+    from . import postgres as backend
+else:
+    backend = db
+
+init_db = backend.init_db
+close_db = backend.close_db
+get_user = backend.get_user
+create_user = backend.create_user
+update_user_phone = backend.update_user_phone
+register_cart_guids = backend.register_cart_guids
+create_order = backend.create_order
+get_order_by_ytimes_guid = backend.get_order_by_ytimes_guid
+update_order_status = backend.update_order_status
+iter_orders = backend.iter_orders
+rebuild_sales_aggregates = backend.rebuild_sales_aggregates
+get_sales_dashboard = backend.get_sales_dashboard
+create_pending_payment = backend.create_pending_payment
+get_pending_payment = backend.get_pending_payment
+delete_pending_payment = backend.delete_pending_payment
+iter_pending_payments = backend.iter_pending_payments
+set_pending_yookassa_id = backend.set_pending_yookassa_id
+claim_pending_payment = backend.claim_pending_payment
+complete_pending_payment = backend.complete_pending_payment
+fail_pending_payment = backend.fail_pending_payment
+create_site_user = backend.create_site_user
+get_site_user_by_phone = backend.get_site_user_by_phone
+get_site_user_by_id = backend.get_site_user_by_id
+update_site_user_saved_payment_method = backend.update_site_user_saved_payment_method
+clear_site_user_saved_payment_method = backend.clear_site_user_saved_payment_method
+reserve_idempotency_key = backend.reserve_idempotency_key
+save_idempotent_response = backend.save_idempotent_response
+release_idempotency_key = backend.release_idempotency_key
+prune_idempotency_keys = backend.prune_idempotency_keys
+reserve_menu_refresh = backend.reserve_menu_refresh
+release_menu_refresh = backend.release_menu_refresh
+count_menu_refreshes = backend.count_menu_refreshes
 
 __all__ = [
     "db",
+    "BACKEND",
+    "backend",
     "init_db",
+    "close_db",
     "get_user",
     "create_user",
     "update_user_phone",
+    "register_cart_guids",
     "create_order",
     "get_order_by_ytimes_guid",
     "update_order_status",
+    "iter_orders",
+    "rebuild_sales_aggregates",
+    "get_sales_dashboard",
     "create_pending_payment",
     "get_pending_payment",
     "delete_pending_payment",
+    "iter_pending_payments",
     "set_pending_yookassa_id",
+    "claim_pending_payment",
+    "complete_pending_payment",
+    "fail_pending_payment",
     "create_site_user",
     "get_site_user_by_phone",
     "get_site_user_by_id",
     "update_site_user_saved_payment_method",
+    "clear_site_user_saved_payment_method",
+    "reserve_idempotency_key",
+    "save_idempotent_response",
+    "release_idempotency_key",
+    "prune_idempotency_keys",
+    "reserve_menu_refresh",
+    "release_menu_refresh",
+    "count_menu_refreshes",
+    "group_commit_stats",
+    "query_stats",
 ]
-
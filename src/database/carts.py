@@ -0,0 +1,108 @@
+"""Корзины заказов и ожидающих платежей: хранятся один раз, по хэшу содержимого.
+
+Корзина (список позиций из запроса) кодируется компактно: позиция — массив
+[позиция, размер, количество, цена, [добавка, количество, ...]], guid заменены номерами
+из словаря cart_guids. Словарь пополняется при обновлении меню (register_cart_guids),
+поэтому guid, которого в меню не было, остаётся строкой; позиция другой формы (лишние
+поля, не строковый guid) хранится объектом как есть. Кодировка — JSON: триггеры сводок
+продаж читают корзины прямо в SQL.
+
+Ключ строки carts — sha256 корзины в каноническом JSON (ключи по алфавиту, без пробелов),
+а не закодированной: хэш не зависит от состояния словаря, и одна и та же корзина до и
+после пополнения словаря (или в другом процессе) — одна строка. Заказ по оплате ссылается
+на ту же строку, что и ожидающий платёж. Словарь только
+пополняется, номера не переиспользуются; копия в памяти процесса (_ids/_guids) дочитывается
+из базы, если встретился незнакомый номер.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import Any, Iterable
+
+# Порядок полей позиции в компактной записи
+_FIELDS = ("menuItemGuid", "menuTypeGuid", "quantity", "priceWithDiscount", "supplementList")
+_KEYS = frozenset(_FIELDS)
+
+_ids: dict[str, int] = {}
+_guids: dict[int, str] = {}
+
+
+def remember(rows: Iterable[tuple[int, str]]) -> None:
+    """Добавить в копию словаря строки (id, guid) из cart_guids."""
+    for guid_id, guid in rows:
+        _ids[guid] = guid_id
+        _guids[guid_id] = guid
+
+
+def unknown(guids: Iterable[str]) -> list[str]:
+    """guid, которых ещё нет в словаре (без повторов, в исходном порядке)."""
+    return [g for g in dict.fromkeys(guids) if g and g not in _ids]
+
+
+def dictionary_size() -> int:
+    return len(_ids)
+
+
+def _pack_guid(guid: str) -> int | str:
+    return _ids.get(guid, guid)
+
+
+def _unpack_guid(value: int | str) -> str:
+    # KeyError — номер из чужого процесса, словарь надо дочитать
+    return _guids[value] if isinstance(value, int) else value
+
+
+def _pack(item: Any) -> Any:
+    if type(item) is not dict:
+        raise ValueError("Позиция корзины должна быть объектом")
+    if item.keys() != _KEYS:
+        return item
+    guid, type_guid, quantity, price, supplements = (item[k] for k in _FIELDS)
+    if not (isinstance(guid, str) and isinstance(type_guid, str) and type(supplements) is dict):
+        return item
+    flat: list = []
+    for supplement, count in supplements.items():
+        flat += (_pack_guid(supplement), count)
+    return [_pack_guid(guid), _pack_guid(type_guid), quantity, price, flat]
+
+
+def _unpack(row: Any) -> Any:
+    if type(row) is dict:
+        return row
+    guid, type_guid, quantity, price, flat = row
+    return {
+        "menuItemGuid": _unpack_guid(guid),
+        "menuTypeGuid": _unpack_guid(type_guid),
+        "supplementList": {_unpack_guid(flat[i]): flat[i + 1] for i in range(0, len(flat), 2)},
+        "priceWithDiscount": price,
+        "quantity": quantity,
+    }
+
+
+def encode(items: list) -> tuple[str, str]:
+    """Корзина -> (cart_hash, data) для строки carts. ValueError, если это не список объектов."""
+    if not isinstance(items, list):
+        raise ValueError("Корзина должна быть списком позиций")
+    packed = [_pack(item) for item in items]
+    data = json.dumps(packed, ensure_ascii=False, separators=(",", ":"))
+    canonical = json.dumps(items, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:32], data
+
+
+def decode(data: str) -> list:
+    """data из carts -> корзина в исходном виде. KeyError, если номера guid нет в копии словаря."""
+    return [_unpack(row) for row in json.loads(data)]
+
+
+def with_items(row: Any) -> dict:
+    """Строка заказа/платежа с cart_data (data из carts) и items_json -> dict с items вместо них.
+
+    cart_data нет — строка записана до carts, корзина в items_json. KeyError — как у decode.
+    """
+    out = dict(row)
+    data = out.pop("cart_data", None)
+    items_json = out.pop("items_json")
+    out["items"] = json.loads(items_json or "[]") if data is None else decode(data)
+    return out
@@ -3,21 +3,121 @@
 from __future__ import annotations
 
 import aiosqlite
-from datetime import datetime
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional
+from typing import AsyncIterator, Iterable, Optional
 
+from . import carts, query_timing, write_batch
 from .models import User, Order, CartItem
 
 
 DB_PATH = Path(__file__).resolve().parents[3] / "data" / "bot.db"
 
+# Сводки продаж: по часам и дням (UTC, по created_at заказа) и по позициям за день.
+# Обновляются триггерами на orders — в той же транзакции, что и запись заказа или смена
+# статуса, при любом способе записи (create_order, complete_pending_payment, DB_GROUP_COMMIT).
+# Отменённый заказ (CANCELLED) вычитается из выручки и попадает в cancelled.
+_SALES_TABLES = [
+    """CREATE TABLE IF NOT EXISTS sales_hourly (
+        hour TEXT PRIMARY KEY,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        cancelled INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS sales_daily (
+        day TEXT PRIMARY KEY,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        cancelled INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID""",
+    """CREATE TABLE IF NOT EXISTS sales_items (
+        day TEXT NOT NULL,
+        menu_item_guid TEXT NOT NULL,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, menu_item_guid)
+    ) WITHOUT ROWID""",
+]
+
+
+
+def _cart(row: str) -> dict[str, str]:
+    """SQL позиций корзины заказа row (orders, NEW, OLD): источник и выражения guid/quantity/line.
+
+    Корзина берётся из carts по cart_hash (позиции — массивы, см. carts), у заказов,
+    записанных до carts, — из items_json (позиции — объекты). Битый JSON — пустая корзина,
+    элемент другого вида — guid NULL. json_extract только внутри CASE по типу элемента:
+    к строке он применился бы как к JSON и упал бы вместе с заказом.
+    """
+
+    def field(key: str, index: int) -> str:
+        return (
+            f"CASE cart.type WHEN 'object' THEN json_extract(cart.value, '$.{key}') "
+            f"WHEN 'array' THEN json_extract(cart.value, '$[{index}]') END"
+        )
+
+    guid = (
+        "CASE cart.type WHEN 'object' THEN json_extract(cart.value, '$.menuItemGuid') "
+        "WHEN 'array' THEN CASE json_type(cart.value, '$[0]') "
+        "WHEN 'integer' THEN (SELECT guid FROM cart_guids WHERE id = json_extract(cart.value, '$[0]')) "
+        "WHEN 'text' THEN json_extract(cart.value, '$[0]') END END"
+    )
+    items = (
+        f"CASE WHEN {row}.cart_hash IS NOT NULL THEN (SELECT data FROM carts WHERE cart_hash = {row}.cart_hash) "
+        f"WHEN json_valid({row}.items_json) THEN {row}.items_json ELSE '[]' END"
+    )
+    quantity = f"coalesce({field('quantity', 2)}, 1)"
+    return {
+        "source": f"json_each({items}) AS cart",
+        "guid": guid,
+        "quantity": quantity,
+        "line": f"coalesce({field('priceWithDiscount', 3)}, 0) * {quantity}",
+    }
+
+
+def _sales_trigger(name: str, event: str, when: str, row: str, sign: int, cancelled: int) -> str:
+    """Триггер, прибавляющий заказ row к сводкам со знаком sign (и cancelled к отменам)."""
+    cart = _cart(row)
+    items = f"""
+        INSERT INTO sales_items (day, menu_item_guid, quantity, revenue)
+            SELECT substr({row}.created_at, 1, 10), {cart["guid"]}, {sign} * {cart["quantity"]}, {sign} * {cart["line"]}
+            FROM {cart["source"]}
+            WHERE {cart["guid"]} IS NOT NULL
+            ON CONFLICT (day, menu_item_guid) DO UPDATE SET
+                quantity = quantity + excluded.quantity, revenue = revenue + excluded.revenue;""" if sign else ""
+    totals = "".join(
+        f"""
+        INSERT INTO {table} ({key}, orders, revenue, cancelled)
+            VALUES (substr({row}.created_at, 1, {length}), {sign}, {sign} * {row}.total_price, {cancelled})
+            ON CONFLICT ({key}) DO UPDATE SET orders = orders + excluded.orders,
+                revenue = revenue + excluded.revenue, cancelled = cancelled + excluded.cancelled;"""
+        for table, key, length in (("sales_hourly", "hour", 13), ("sales_daily", "day", 10))
+    )
+    return f"""CREATE TRIGGER {name} AFTER {event} ON orders
+        WHEN {when}
+        BEGIN{totals}{items}
+        END"""
+
+
+# (имя, событие, условие, строка, знак, отмены); триггеры пересоздаются в init_db —
+# после обновления всегда действует текущее определение
+_SALES_TRIGGERS = [
+    ("trg_sales_order_created", "INSERT", "NEW.status != 'CANCELLED'", "NEW", 1, 0),
+    ("trg_sales_order_created_cancelled", "INSERT", "NEW.status = 'CANCELLED'", "NEW", 0, 1),
+    ("trg_sales_order_cancelled", "UPDATE OF status", "NEW.status = 'CANCELLED' AND OLD.status != 'CANCELLED'", "OLD", -1, 1),
+    ("trg_sales_order_restored", "UPDATE OF status", "OLD.status = 'CANCELLED' AND NEW.status != 'CANCELLED'", "OLD", 1, -1),
+]
+
 
 async def init_db() -> None:
     """Инициализировать базу данных."""
     DB_PATH.parent.mkdir(exist_ok=True)
 
     async with aiosqlite.connect(DB_PATH) as db:
+        # WAL: чтения не блокируют запись — важно, когда платёж обрабатывают несколько воркеров
+        await db.execute("PRAGMA journal_mode=WAL")
         # Таблица пользователей
         await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -58,7 +158,13 @@ async def init_db() -> None:
                 created_at TEXT NOT NULL,
                 yookassa_payment_id TEXT,
                 site_user_id INTEGER,
-                link_card_only INTEGER NOT NULL DEFAULT 0
+                link_card_only INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL DEFAULT 'pending',
+                claim_owner TEXT,
+                claimed_until REAL,
+                order_guid TEXT,
+                last_error TEXT,
+                updated_at TEXT
             )
         """)
         try:
@@ -73,6 +179,19 @@ async def init_db() -> None:
             await db.execute("ALTER TABLE pending_payments ADD COLUMN link_card_only INTEGER NOT NULL DEFAULT 0")
         except Exception:
             pass
+        # Состояние оплаты: pending -> claimed (обработчик взял с арендой claimed_until) -> fulfilled / failed
+        for column in (
+            "state TEXT NOT NULL DEFAULT 'pending'",
+            "claim_owner TEXT",
+            "claimed_until REAL",
+            "order_guid TEXT",
+            "last_error TEXT",
+            "updated_at TEXT",
+        ):
+            try:
+                await db.execute(f"ALTER TABLE pending_payments ADD COLUMN {column}")
+            except Exception:
+                pass
         # Пользователи сайта (телефон + пароль)
         await db.execute("""
             CREATE TABLE IF NOT EXISTS site_users (
@@ -88,61 +207,224 @@ async def init_db() -> None:
             await db.execute("ALTER TABLE site_users ADD COLUMN saved_payment_method_id TEXT")
         except Exception:
             pass
+        # Поиск заказа по guid YTimes: вебхук статуса и GET /api/order/{guid}/status
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_orders_ytimes_order_id ON orders(ytimes_order_id)"
+        )
+        # Ключи идемпотентности (заголовок Idempotency-Key) и сохранённые ответы.
+        # status_code IS NULL — запрос ещё выполняется; expires_at — аренда или срок хранения ответа
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                request_hash TEXT NOT NULL,
+                status_code INTEGER,
+                response_body BLOB,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (scope, key)
+            ) WITHOUT ROWID
+        """)
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)"
+        )
+        # Обновления меню из YTimes за последний час: квота общая для всех процессов и реплик
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS menu_refreshes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                at REAL NOT NULL
+            )
+        """)
+        # Корзины по хэшу содержимого и словарь guid для их компактной записи (см. carts).
+        # Заказы и платежи ссылаются на корзину через cart_hash; у старых строк корзина в items_json
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS carts (
+                cart_hash TEXT PRIMARY KEY,
+                data TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS cart_guids (
+                id INTEGER PRIMARY KEY,
+                guid TEXT NOT NULL UNIQUE
+            )
+        """)
+        for table in ("orders", "pending_payments"):
+            try:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN cart_hash TEXT")
+            except Exception:
+                pass
+        for statement in _SALES_TABLES:
+            await db.execute(statement)
+        await db.commit()
+        # Триггеры пересоздаются одной транзакцией: заказ не может попасть между DROP и CREATE
+        await db.execute("BEGIN IMMEDIATE")
+        for name, *definition in _SALES_TRIGGERS:
+            await db.execute(f"DROP TRIGGER IF EXISTS {name}")
+            await db.execute(_sales_trigger(name, *definition))
         await db.commit()
+        await _load_cart_guids(db, "init_db")
+
+
+# Все запросы ниже идут через эти помощники: время каждой фазы копится в query_timing
+# под именем функции, медленные запросы попадают в лог с планом (см. query_timing).
+
+
+def _timed(query: str, phase: str, started: float, sql: str | None = None, params: tuple = ()) -> None:
+    seconds = time.perf_counter() - started
+    query_timing.record(query, phase, seconds)
+    query_timing.check_slow(DB_PATH, query, phase, seconds, sql, params)
+
+
+@asynccontextmanager
+async def _connect(query: str) -> AsyncIterator[aiosqlite.Connection]:
+    """Соединение для запроса query; время открытия учитывается как acquire."""
+    started = time.perf_counter()
+    async with aiosqlite.connect(DB_PATH) as db:
+        _timed(query, "acquire", started)
+        yield db
+
+
+async def _execute(db: aiosqlite.Connection, query: str, sql: str, params: tuple = ()) -> aiosqlite.Cursor:
+    started = time.perf_counter()
+    cursor = await db.execute(sql, params)
+    _timed(query, "execute", started, sql, params)
+    return cursor
+
+
+async def _fetchone(db: aiosqlite.Connection, query: str, sql: str, params: tuple = ()) -> Optional[aiosqlite.Row]:
+    started = time.perf_counter()
+    db.row_factory = aiosqlite.Row
+    async with db.execute(sql, params) as cursor:
+        row = await cursor.fetchone()
+    _timed(query, "execute", started, sql, params)
+    return row
+
+
+async def _fetchall(db: aiosqlite.Connection, query: str, sql: str, params: tuple = ()) -> list[aiosqlite.Row]:
+    started = time.perf_counter()
+    db.row_factory = aiosqlite.Row
+    async with db.execute(sql, params) as cursor:
+        rows = await cursor.fetchall()
+    _timed(query, "execute", started, sql, params)
+    return list(rows)
+
+
+async def _commit(db: aiosqlite.Connection, query: str) -> None:
+    started = time.perf_counter()
+    await db.commit()
+    _timed(query, "commit", started)
+
+
+async def _read_one(query: str, sql: str, params: tuple = ()) -> Optional[aiosqlite.Row]:
+    """Одна строка (или None) отдельным соединением."""
+    async with _connect(query) as db:
+        return await _fetchone(db, query, sql, params)
+
+
+async def _write(query: str, sql: str, params: tuple = ()) -> int:
+    """Один оператор записи в своей транзакции или в общей пачке (DB_GROUP_COMMIT=1). Возвращает rowcount."""
+    return await _write_many(query, [(sql, params)])
+
+
+async def _write_many(query: str, statements: list[tuple[str, tuple]]) -> int:
+    """Операторы одной записи в одной транзакции (или в общей пачке). Возвращает rowcount последнего."""
+    if write_batch.ENABLED:
+        started = time.perf_counter()
+        rowcount = await write_batch.submit_many(DB_PATH, statements)
+        _timed(query, "batched", started)
+        return rowcount
+    async with _connect(query) as db:
+        for sql, params in statements:
+            cursor = await _execute(db, query, sql, params)
+        await _commit(db, query)
+        return cursor.rowcount
+
+
+# Корзины: одна строка carts на одинаковое содержимое, заказы и платежи хранят cart_hash
+
+
+def _store_cart(items: list) -> tuple[str, tuple[str, tuple]]:
+    """cart_hash корзины и оператор, сохраняющий её (если такой ещё нет)."""
+    cart_hash, data = carts.encode(items)
+    return cart_hash, ("INSERT OR IGNORE INTO carts (cart_hash, data) VALUES (?, ?)", (cart_hash, data))
+
+
+async def _load_cart_guids(db: aiosqlite.Connection, query: str) -> None:
+    rows = await _fetchall(db, query, "SELECT id, guid FROM cart_guids")
+    carts.remember((row["id"], row["guid"]) for row in rows)
+
+
+async def _with_items(db: aiosqlite.Connection, query: str, row: aiosqlite.Row) -> dict:
+    """Строка заказа/платежа (items_json, cart_data) -> dict с корзиной items."""
+    try:
+        return carts.with_items(row)
+    except KeyError:
+        # Номер guid добавил другой процесс после нашей загрузки словаря
+        await _load_cart_guids(db, query)
+        return carts.with_items(row)
+
+
+async def register_cart_guids(guids: Iterable[str]) -> int:
+    """Добавить guid меню в словарь корзин (после обновления меню). Возвращает число новых."""
+    new = carts.unknown(guids)
+    if not new:
+        return 0
+    query = "register_cart_guids"
+    async with _connect(query) as db:
+        started = time.perf_counter()
+        await db.executemany("INSERT OR IGNORE INTO cart_guids (guid) VALUES (?)", [(g,) for g in new])
+        _timed(query, "execute", started)
+        await _commit(db, query)
+        await _load_cart_guids(db, query)
+    return len(new)
+
+
+async def close_db() -> None:
+    """Зафиксировать очередь групповых записей (при остановке приложения)."""
+    await write_batch.close_group_commit()
 
 
 async def get_user(telegram_id: int) -> Optional[User]:
     """Получить пользователя по Telegram ID."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT * FROM users WHERE telegram_id = ?", (telegram_id,)
-        ) as cursor:
-            row = await cursor.fetchone()
-            if not row:
-                return None
-            return User(
-                telegram_id=row["telegram_id"],
-                first_name=row["first_name"],
-                last_name=row["last_name"],
-                username=row["username"],
-                phone=row["phone"],
-                created_at=datetime.fromisoformat(row["created_at"]) if row["created_at"] else None,
-                is_active=bool(row["is_active"]),
-            )
+    row = await _read_one("get_user", "SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
+    if not row:
+        return None
+    return User(
+        telegram_id=row["telegram_id"],
+        first_name=row["first_name"],
+        last_name=row["last_name"],
+        username=row["username"],
+        phone=row["phone"],
+        created_at=datetime.fromisoformat(row["created_at"]) if row["created_at"] else None,
+        is_active=bool(row["is_active"]),
+    )
 
 
 async def create_user(user: User) -> User:
     """Создать нового пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        now = datetime.utcnow().isoformat()
-        await db.execute(
-            """INSERT OR REPLACE INTO users 
-               (telegram_id, first_name, last_name, username, phone, created_at, is_active)
-               VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (
-                user.telegram_id,
-                user.first_name,
-                user.last_name,
-                user.username,
-                user.phone,
-                now,
-                1 if user.is_active else 0,
-            ),
-        )
-        await db.commit()
-        user.created_at = datetime.fromisoformat(now)
-        return user
+    now = datetime.utcnow().isoformat()
+    await _write(
+        "create_user",
+        """INSERT OR REPLACE INTO users
+           (telegram_id, first_name, last_name, username, phone, created_at, is_active)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (
+            user.telegram_id,
+            user.first_name,
+            user.last_name,
+            user.username,
+            user.phone,
+            now,
+            1 if user.is_active else 0,
+        ),
+    )
+    user.created_at = datetime.fromisoformat(now)
+    return user
 
 
 async def update_user_phone(telegram_id: int, phone: str) -> None:
     """Обновить телефон пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE users SET phone = ? WHERE telegram_id = ?",
-            (phone, telegram_id),
-        )
-        await db.commit()
+    await _write("update_user_phone", "UPDATE users SET phone = ? WHERE telegram_id = ?", (phone, telegram_id))
 
 
 async def create_order(
@@ -150,49 +432,152 @@ async def create_order(
     ytimes_order_guid: str,
     total_price: float,
     status: str = "CREATED",
-    items_json: str = "[]",
+    items: list | None = None,
 ) -> None:
-    """Сохранить заказ после создания в YTimes."""
+    """Сохранить заказ после создания в YTimes (корзина — в carts, в заказе её cart_hash)."""
     now = datetime.utcnow().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            """INSERT INTO orders
-               (user_telegram_id, items_json, total_price, status, ytimes_order_id, created_at)
-               VALUES (?, ?, ?, ?, ?, ?)""",
-            (user_telegram_id, items_json, total_price, status, ytimes_order_guid, now),
-        )
-        await db.commit()
+    cart_hash, store_cart = _store_cart(items or [])
+    await _write_many(
+        "create_order",
+        [
+            store_cart,
+            (
+                """INSERT INTO orders
+                   (user_telegram_id, items_json, cart_hash, total_price, status, ytimes_order_id, created_at)
+                   VALUES (?, '', ?, ?, ?, ?, ?)""",
+                (user_telegram_id, cart_hash, total_price, status, ytimes_order_guid, now),
+            ),
+        ],
+    )
 
 
 async def get_order_by_ytimes_guid(ytimes_guid: str) -> Optional[dict]:
     """Найти заказ по YTimes guid (для вебхука). Возвращает dict с user_telegram_id, status и др."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT order_id, user_telegram_id, total_price, status, ytimes_order_id, created_at FROM orders WHERE ytimes_order_id = ?",
-            (ytimes_guid,),
-        ) as cursor:
-            row = await cursor.fetchone()
-            if not row:
-                return None
-            return dict(row)
+    row = await _read_one(
+        "get_order_by_ytimes_guid",
+        "SELECT order_id, user_telegram_id, total_price, status, ytimes_order_id, created_at FROM orders WHERE ytimes_order_id = ?",
+        (ytimes_guid,),
+    )
+    return dict(row) if row else None
 
 
 async def update_order_status(ytimes_guid: str, status: str) -> None:
     """Обновить статус заказа (ACCEPTED/CANCELLED) после вебхука."""
     now = datetime.utcnow().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE orders SET status = ?, updated_at = ? WHERE ytimes_order_id = ?",
-            (status, now, ytimes_guid),
+    await _write(
+        "update_order_status",
+        "UPDATE orders SET status = ?, updated_at = ? WHERE ytimes_order_id = ?",
+        (status, now, ytimes_guid),
+    )
+
+
+async def iter_orders(
+    since: str = "",
+    until: str = "9999",
+    after_id: int = 0,
+    chunk_size: int = 1000,
+) -> AsyncIterator[dict]:
+    """Заказы с order_id > after_id и created_at в [since, until) по возрастанию order_id.
+
+    Читаются порциями по chunk_size (продолжение по последнему order_id): соединение не
+    держится между порциями, память не зависит от размера таблицы.
+    """
+    while True:
+        async with _connect("iter_orders") as db:
+            rows = await _fetchall(
+                db,
+                "iter_orders",
+                """SELECT o.order_id, o.user_telegram_id, o.items_json, c.data AS cart_data, o.total_price, o.status,
+                          o.ytimes_order_id, o.created_at, o.updated_at
+                   FROM orders o LEFT JOIN carts c ON c.cart_hash = o.cart_hash
+                   WHERE o.order_id > ? AND o.created_at >= ? AND o.created_at < ?
+                   ORDER BY o.order_id LIMIT ?""",
+                (after_id, since, until, chunk_size),
+            )
+            orders = [await _with_items(db, "iter_orders", row) for row in rows]
+        for order in orders:
+            yield order
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1]["order_id"]
+
+
+async def rebuild_sales_aggregates() -> int:
+    """Пересчитать сводки продаж по всей таблице orders (история до появления сводок).
+
+    Всё в одной транзакции: первая же операция (DELETE) берёт блокировку записи, поэтому
+    новые заказы ждут окончания пересчёта и не теряются и не учитываются дважды.
+    Возвращает число учтённых (не отменённых) заказов.
+    """
+    query = "rebuild_sales_aggregates"
+    async with _connect(query) as db:
+        for table in ("sales_hourly", "sales_daily", "sales_items"):
+            await _execute(db, query, f"DELETE FROM {table}")
+        for table, key, length in (("sales_hourly", "hour", 13), ("sales_daily", "day", 10)):
+            await _execute(
+                db,
+                query,
+                f"""INSERT INTO {table} ({key}, orders, revenue, cancelled)
+                    SELECT substr(created_at, 1, {length}),
+                           SUM(status != 'CANCELLED'),
+                           SUM(CASE WHEN status != 'CANCELLED' THEN total_price ELSE 0 END),
+                           SUM(status = 'CANCELLED')
+                    FROM orders GROUP BY 1""",
+            )
+        cart = _cart("orders")
+        await _execute(
+            db,
+            query,
+            f"""INSERT INTO sales_items (day, menu_item_guid, quantity, revenue)
+               SELECT substr(orders.created_at, 1, 10), {cart["guid"]}, SUM({cart["quantity"]}), SUM({cart["line"]})
+               FROM orders, {cart["source"]}
+               WHERE orders.status != 'CANCELLED' AND {cart["guid"]} IS NOT NULL
+               GROUP BY 1, 2""",
         )
-        await db.commit()
+        row = await _fetchone(db, query, "SELECT coalesce(SUM(orders), 0) AS orders FROM sales_daily")
+        await _commit(db, query)
+        return row["orders"]
+
+
+async def get_sales_dashboard(day: str, days: int = 7, top: int = 10) -> dict:
+    """Сводка продаж за день day (ГГГГ-ММ-ДД, UTC) только по таблицам сводок.
+
+    totals — итоги дня, hourly — по часам, top_items — позиции по количеству,
+    daily — итоги за days дней по day включительно. Время не зависит от числа заказов.
+    """
+    query = "get_sales_dashboard"
+    start = (datetime.fromisoformat(day) - timedelta(days=days - 1)).date().isoformat()
+    async with _connect(query) as db:
+        daily = await _fetchall(
+            db, query,
+            "SELECT day, orders, revenue, cancelled FROM sales_daily WHERE day >= ? AND day <= ? ORDER BY day",
+            (start, day),
+        )
+        hourly = await _fetchall(
+            db, query,
+            "SELECT hour, orders, revenue, cancelled FROM sales_hourly WHERE hour >= ? AND hour <= ? ORDER BY hour",
+            (day + "T00", day + "T23"),
+        )
+        items = await _fetchall(
+            db, query,
+            """SELECT menu_item_guid, quantity, revenue FROM sales_items
+               WHERE day = ? AND quantity > 0 ORDER BY quantity DESC, revenue DESC LIMIT ?""",
+            (day, top),
+        )
+    daily_rows = [dict(r) for r in daily]
+    totals = next((r for r in daily_rows if r["day"] == day), {"day": day, "orders": 0, "revenue": 0.0, "cancelled": 0})
+    return {
+        "totals": totals,
+        "hourly": [dict(r) for r in hourly],
+        "top_items": [dict(r) for r in items],
+        "daily": daily_rows,
+    }
 
 
 async def create_pending_payment(
     payment_token: str,
     telegram_id: int,
-    items_json: str,
+    items: list,
     total: float,
     client_json: str = "{}",
     comment: str = "",
@@ -201,58 +586,173 @@ async def create_pending_payment(
 ) -> None:
     """Сохранить ожидающий платёж (корзина для ЮKassa / Telegram Invoice). link_card_only=True — только привязка карты, заказ не создаём."""
     now = datetime.utcnow().isoformat()
-    async with aiosqlite.connect(DB_PATH) as conn:
-        await conn.execute(
-            """INSERT INTO pending_payments
-               (payment_token, telegram_id, items_json, total, client_json, comment, created_at, site_user_id, link_card_only)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (payment_token, telegram_id, items_json, total, client_json, comment or "", now, site_user_id, 1 if link_card_only else 0),
-        )
-        await conn.commit()
+    cart_hash, store_cart = _store_cart(items)
+    await _write_many(
+        "create_pending_payment",
+        [
+            store_cart,
+            (
+                """INSERT INTO pending_payments
+                   (payment_token, telegram_id, items_json, cart_hash, total, client_json, comment, created_at,
+                    site_user_id, link_card_only)
+                   VALUES (?, ?, '', ?, ?, ?, ?, ?, ?, ?)""",
+                (payment_token, telegram_id, cart_hash, total, client_json, comment or "", now, site_user_id,
+                 1 if link_card_only else 0),
+            ),
+        ],
+    )
 
 
 async def get_pending_payment(payment_token: str) -> Optional[dict]:
-    """Получить ожидающий платёж по токену. Для вызова из бота."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT payment_token, telegram_id, items_json, total, client_json, comment, yookassa_payment_id, site_user_id, link_card_only FROM pending_payments WHERE payment_token = ?",
+    """Получить ожидающий платёж по токену (корзина — список items). Для вызова из бота."""
+    query = "get_pending_payment"
+    async with _connect(query) as db:
+        row = await _fetchone(
+            db,
+            query,
+            """SELECT p.payment_token, p.telegram_id, p.items_json, c.data AS cart_data, p.total, p.client_json, p.comment,
+                      p.yookassa_payment_id, p.site_user_id, p.link_card_only, p.state, p.order_guid
+               FROM pending_payments p LEFT JOIN carts c ON c.cart_hash = p.cart_hash
+               WHERE p.payment_token = ?""",
             (payment_token,),
-        ) as cursor:
-            row = await cursor.fetchone()
-            if not row:
-                return None
-            return dict(row)
+        )
+        return await _with_items(db, query, row) if row else None
 
 
 async def set_pending_yookassa_id(payment_token: str, yookassa_payment_id: str) -> None:
     """Сохранить id платежа ЮKassa для ожидающего платежа."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE pending_payments SET yookassa_payment_id = ? WHERE payment_token = ?",
-            (yookassa_payment_id, payment_token),
+    await _write(
+        "set_pending_yookassa_id",
+        "UPDATE pending_payments SET yookassa_payment_id = ? WHERE payment_token = ?",
+        (yookassa_payment_id, payment_token),
+    )
+
+
+async def claim_pending_payment(payment_token: str, claim_owner: str, lease_seconds: float) -> Optional[dict]:
+    """Захватить платёж для создания заказа одним условным UPDATE.
+
+    Успешно, если платёж в состоянии pending/failed или аренда другого обработчика истекла.
+    Возвращает строку платежа (как get_pending_payment) или None, если захватить не удалось.
+    """
+    now = time.time()
+    async with _connect("claim_pending_payment") as db:
+        cursor = await _execute(
+            db,
+            "claim_pending_payment",
+            """UPDATE pending_payments
+               SET state = 'claimed', claim_owner = ?, claimed_until = ?, updated_at = ?
+               WHERE payment_token = ?
+                 AND (state IN ('pending', 'failed') OR (state = 'claimed' AND claimed_until < ?))""",
+            (claim_owner, now + lease_seconds, datetime.utcnow().isoformat(), payment_token, now),
         )
-        await db.commit()
+        await _commit(db, "claim_pending_payment")
+        if cursor.rowcount != 1:
+            return None
+    return await get_pending_payment(payment_token)
+
+
+async def complete_pending_payment(
+    payment_token: str,
+    claim_owner: str,
+    *,
+    ytimes_order_guid: str | None = None,
+    user_telegram_id: int = 0,
+    total_price: float = 0.0,
+    status: str = "CREATED",
+) -> bool:
+    """Перевести захваченный платёж в fulfilled и (если задан ytimes_order_guid) сохранить заказ — в одной транзакции.
+
+    Заказ ссылается на корзину платежа (тот же cart_hash), корзина заново не сохраняется.
+    False, если платёж уже не принадлежит claim_owner (аренда истекла и платёж захвачен другим).
+    """
+    now = datetime.utcnow().isoformat()
+    async with _connect("complete_pending_payment") as db:
+        cursor = await _execute(
+            db,
+            "complete_pending_payment",
+            """UPDATE pending_payments
+               SET state = 'fulfilled', order_guid = ?, claimed_until = NULL, last_error = NULL, updated_at = ?
+               WHERE payment_token = ? AND state = 'claimed' AND claim_owner = ?""",
+            (ytimes_order_guid, now, payment_token, claim_owner),
+        )
+        if cursor.rowcount != 1:
+            await db.rollback()
+            return False
+        if ytimes_order_guid:
+            await _execute(
+                db,
+                "complete_pending_payment",
+                """INSERT INTO orders
+                   (user_telegram_id, items_json, cart_hash, total_price, status, ytimes_order_id, created_at)
+                   SELECT ?, items_json, cart_hash, ?, ?, ?, ? FROM pending_payments WHERE payment_token = ?""",
+                (user_telegram_id, total_price, status, ytimes_order_guid, now, payment_token),
+            )
+        await _commit(db, "complete_pending_payment")
+        return True
+
+
+async def fail_pending_payment(payment_token: str, claim_owner: str, error: str) -> None:
+    """Отметить неудачную попытку (failed): платёж можно захватить повторно."""
+    await _write(
+        "fail_pending_payment",
+        """UPDATE pending_payments
+           SET state = 'failed', claimed_until = NULL, last_error = ?, updated_at = ?
+           WHERE payment_token = ? AND state = 'claimed' AND claim_owner = ?""",
+        (error[:500], datetime.utcnow().isoformat(), payment_token, claim_owner),
+    )
 
 
 async def delete_pending_payment(payment_token: str) -> None:
     """Удалить ожидающий платёж после создания заказа."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM pending_payments WHERE payment_token = ?", (payment_token,))
-        await db.commit()
+    await _write("delete_pending_payment", "DELETE FROM pending_payments WHERE payment_token = ?", (payment_token,))
+
+
+async def iter_pending_payments(
+    since: str = "",
+    until: str = "9999",
+    after: tuple[str, str] = ("", ""),
+    chunk_size: int = 1000,
+) -> AsyncIterator[dict]:
+    """Ожидающие платежи с created_at в [since, until) по (created_at, payment_token) после after.
+
+    Порциями по chunk_size, как iter_orders.
+    """
+    after_created, after_token = after
+    while True:
+        async with _connect("iter_pending_payments") as db:
+            rows = await _fetchall(
+                db,
+                "iter_pending_payments",
+                """SELECT p.payment_token, p.telegram_id, p.items_json, c.data AS cart_data, p.total, p.client_json,
+                          p.comment, p.created_at, p.yookassa_payment_id, p.site_user_id, p.link_card_only, p.state,
+                          p.order_guid, p.last_error, p.updated_at
+                   FROM pending_payments p LEFT JOIN carts c ON c.cart_hash = p.cart_hash
+                   WHERE (p.created_at > ? OR (p.created_at = ? AND p.payment_token > ?))
+                     AND p.created_at >= ? AND p.created_at < ?
+                   ORDER BY p.created_at, p.payment_token LIMIT ?""",
+                (after_created, after_created, after_token, since, until, chunk_size),
+            )
+            pending = [await _with_items(db, "iter_pending_payments", row) for row in rows]
+        for row in pending:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        after_created, after_token = rows[-1]["created_at"], rows[-1]["payment_token"]
 
 
 async def create_site_user(phone: str, password_hash: str, name: str | None = None) -> dict | None:
     """Создать пользователя сайта. Возвращает dict с id, phone, name, created_at или None если телефон занят."""
     now = datetime.utcnow().isoformat()
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
-            cursor = await db.execute(
+        async with _connect("create_site_user") as db:
+            cursor = await _execute(
+                db,
+                "create_site_user",
                 """INSERT INTO site_users (phone, password_hash, name, created_at)
                    VALUES (?, ?, ?, ?)""",
                 (phone.strip(), password_hash, (name or "").strip() or None, now),
             )
-            await db.commit()
+            await _commit(db, "create_site_user")
             return {"id": cursor.lastrowid, "phone": phone.strip(), "name": (name or "").strip() or None, "created_at": now}
     except aiosqlite.IntegrityError:
         return None
@@ -260,34 +760,138 @@ async def create_site_user(phone: str, password_hash: str, name: str | None = No
 
 async def get_site_user_by_phone(phone: str) -> dict | None:
     """Получить пользователя сайта по телефону (включая password_hash для проверки)."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT id, phone, password_hash, name, created_at FROM site_users WHERE phone = ?",
-            (phone.strip(),),
-        ) as cursor:
-            row = await cursor.fetchone()
-            return dict(row) if row else None
+    row = await _read_one(
+        "get_site_user_by_phone",
+        "SELECT id, phone, password_hash, name, created_at FROM site_users WHERE phone = ?",
+        (phone.strip(),),
+    )
+    return dict(row) if row else None
 
 
 async def get_site_user_by_id(user_id: int) -> dict | None:
     """Получить пользователя сайта по id (без password_hash для ответов API)."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        async with db.execute(
-            "SELECT id, phone, name, created_at, saved_payment_method_id FROM site_users WHERE id = ?",
-            (user_id,),
-        ) as cursor:
-            row = await cursor.fetchone()
-            return dict(row) if row else None
+    row = await _read_one(
+        "get_site_user_by_id",
+        "SELECT id, phone, name, created_at, saved_payment_method_id FROM site_users WHERE id = ?",
+        (user_id,),
+    )
+    return dict(row) if row else None
 
 
 async def update_site_user_saved_payment_method(site_user_id: int, payment_method_id: str) -> None:
     """Привязать сохранённый способ оплаты ЮKassa к аккаунту пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "UPDATE site_users SET saved_payment_method_id = ? WHERE id = ?",
-            (payment_method_id.strip(), site_user_id),
+    await _write(
+        "update_site_user_saved_payment_method",
+        "UPDATE site_users SET saved_payment_method_id = ? WHERE id = ?",
+        (payment_method_id.strip(), site_user_id),
+    )
+
+
+async def clear_site_user_saved_payment_method(site_user_id: int) -> None:
+    """Отвязать сохранённый способ оплаты (ЮKassa отозвала разрешение на списания)."""
+    await _write(
+        "clear_site_user_saved_payment_method",
+        "UPDATE site_users SET saved_payment_method_id = NULL WHERE id = ?",
+        (site_user_id,),
+    )
+
+
+async def reserve_idempotency_key(
+    scope: str, key: str, request_hash: str, lease_seconds: float
+) -> Optional[dict]:
+    """Занять ключ идемпотентности под выполняемый запрос.
+
+    None — ключ занят этим вызовом (новый или с истёкшим сроком). Иначе — существующая
+    запись {request_hash, status_code, response_body}: готовый ответ или запрос в работе.
+    """
+    now = time.time()
+    async with _connect("reserve_idempotency_key") as db:
+        cursor = await _execute(
+            db,
+            "reserve_idempotency_key",
+            """INSERT INTO idempotency_keys (scope, key, request_hash, status_code, response_body, expires_at)
+               VALUES (?, ?, ?, NULL, NULL, ?)
+               ON CONFLICT (scope, key) DO UPDATE
+               SET request_hash = excluded.request_hash, status_code = NULL,
+                   response_body = NULL, expires_at = excluded.expires_at
+               WHERE idempotency_keys.expires_at < ?""",
+            (scope, key, request_hash, now + lease_seconds, now),
         )
-        await db.commit()
+        await _commit(db, "reserve_idempotency_key")
+        if cursor.rowcount == 1:
+            return None
+        row = await _fetchone(
+            db,
+            "reserve_idempotency_key",
+            "SELECT request_hash, status_code, response_body FROM idempotency_keys WHERE scope = ? AND key = ?",
+            (scope, key),
+        )
+    if not row:
+        # Запись удалили между запросами (release) — пусть вызывающий попробует снова
+        return {"request_hash": request_hash, "status_code": None, "response_body": None}
+    return dict(row)
+
+
+async def save_idempotent_response(
+    scope: str, key: str, status_code: int, response_body: bytes, ttl_seconds: float
+) -> None:
+    """Сохранить ответ для занятого ключа на ttl_seconds."""
+    await _write(
+        "save_idempotent_response",
+        """UPDATE idempotency_keys SET status_code = ?, response_body = ?, expires_at = ?
+           WHERE scope = ? AND key = ?""",
+        (status_code, response_body, time.time() + ttl_seconds, scope, key),
+    )
+
+
+async def release_idempotency_key(scope: str, key: str) -> None:
+    """Освободить ключ без ответа (запрос упал): повтор выполнится заново."""
+    await _write(
+        "release_idempotency_key",
+        "DELETE FROM idempotency_keys WHERE scope = ? AND key = ? AND status_code IS NULL",
+        (scope, key),
+    )
+
+
+async def reserve_menu_refresh(limit: int, window: float) -> tuple[Optional[int], float]:
+    """Занять одно обновление меню в квоте limit за window секунд (общей для всех процессов).
+
+    (id записи, 0) — обновление разрешено и учтено; (None, секунд до освобождения) — квота выбрана.
+    BEGIN IMMEDIATE: подсчёт и запись идут под блокировкой записи, два процесса не займут
+    последнее место одновременно.
+    """
+    now = time.time()
+    async with _connect("reserve_menu_refresh") as db:
+        await _execute(db, "reserve_menu_refresh", "BEGIN IMMEDIATE")
+        await _execute(db, "reserve_menu_refresh", "DELETE FROM menu_refreshes WHERE at <= ?", (now - window,))
+        cursor = await _execute(
+            db,
+            "reserve_menu_refresh",
+            """INSERT INTO menu_refreshes (at)
+               SELECT ? WHERE (SELECT COUNT(*) FROM menu_refreshes) < ?""",
+            (now, limit),
+        )
+        await _commit(db, "reserve_menu_refresh")
+        if cursor.rowcount == 1:
+            return cursor.lastrowid, 0.0
+        row = await _fetchone(db, "reserve_menu_refresh", "SELECT MIN(at) FROM menu_refreshes")
+    oldest = row[0] if row and row[0] is not None else now
+    return None, max(oldest + window - now, 1.0)
+
+
+async def release_menu_refresh(refresh_id: int) -> None:
+    """Вернуть обновление в квоту: запрос до YTimes не дошёл."""
+    await _write("release_menu_refresh", "DELETE FROM menu_refreshes WHERE id = ?", (refresh_id,))
+
+
+async def count_menu_refreshes(window: float) -> int:
+    """Сколько обновлений меню учтено за последние window секунд."""
+    row = await _read_one(
+        "count_menu_refreshes", "SELECT COUNT(*) FROM menu_refreshes WHERE at > ?", (time.time() - window,)
+    )
+    return row[0] if row else 0
+
 
+async def prune_idempotency_keys() -> int:
+    """Удалить просроченные ключи. Возвращает число удалённых записей."""
+    return await _write("prune_idempotency_keys", "DELETE FROM idempotency_keys WHERE expires_at < ?", (time.time(),))
@@ -0,0 +1,751 @@
+"""Работа с базой данных PostgreSQL (asyncpg) — те же функции, что и в db.py.
+
+Используется, если задан DATABASE_URL (postgresql://...): тогда несколько контейнеров web
+и бот работают с одной базой. Соединения берутся из пула процесса (DB_POOL_MIN_SIZE /
+DB_POOL_MAX_SIZE), asyncpg подготавливает запросы и кэширует подготовленные операторы на
+каждом соединении, так что повторяющиеся запросы не разбираются сервером заново.
+
+Схема повторяет SQLite: даты хранятся ISO-строками, флаги — целыми, чтобы функции
+возвращали одинаковые значения на обоих бэкендах.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Iterable, Optional
+
+from . import carts
+from .models import User
+
+DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Ключ блокировки: init_db из нескольких контейнеров создаёт схему по очереди
+_SCHEMA_LOCK_ID = 7_305_114_402
+# Квота обновлений меню: проверка и запись под одной блокировкой во всех репликах
+_MENU_REFRESH_LOCK_ID = 7_305_114_403
+
+_pool = None
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        telegram_id BIGINT PRIMARY KEY,
+        first_name TEXT NOT NULL,
+        last_name TEXT,
+        username TEXT,
+        phone TEXT,
+        created_at TEXT NOT NULL,
+        is_active INTEGER NOT NULL DEFAULT 1
+    )
+    """,
+    # user_telegram_id = 0 у заказов с сайта, поэтому без внешнего ключа (в SQLite он не проверяется)
+    """
+    CREATE TABLE IF NOT EXISTS orders (
+        order_id BIGSERIAL PRIMARY KEY,
+        user_telegram_id BIGINT NOT NULL,
+        items_json TEXT NOT NULL,
+        total_price DOUBLE PRECISION NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        ytimes_order_id TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_orders_ytimes_order_id ON orders(ytimes_order_id)",
+    """
+    CREATE TABLE IF NOT EXISTS pending_payments (
+        payment_token TEXT PRIMARY KEY,
+        telegram_id BIGINT NOT NULL,
+        items_json TEXT NOT NULL,
+        total DOUBLE PRECISION NOT NULL,
+        client_json TEXT,
+        comment TEXT,
+        created_at TEXT NOT NULL,
+        yookassa_payment_id TEXT,
+        site_user_id BIGINT,
+        link_card_only INTEGER NOT NULL DEFAULT 0,
+        state TEXT NOT NULL DEFAULT 'pending',
+        claim_owner TEXT,
+        claimed_until DOUBLE PRECISION,
+        order_guid TEXT,
+        last_error TEXT,
+        updated_at TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS site_users (
+        id BIGSERIAL PRIMARY KEY,
+        phone TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        name TEXT,
+        created_at TEXT NOT NULL,
+        saved_payment_method_id TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        scope TEXT NOT NULL,
+        key TEXT NOT NULL,
+        request_hash TEXT NOT NULL,
+        status_code INTEGER,
+        response_body BYTEA,
+        expires_at DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (scope, key)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)",
+    # Обновления меню из YTimes за последний час (как в db.py)
+    """
+    CREATE TABLE IF NOT EXISTS menu_refreshes (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        at DOUBLE PRECISION NOT NULL
+    )
+    """,
+    # Корзины по хэшу содержимого и словарь guid (как в db.py, см. carts)
+    """
+    CREATE TABLE IF NOT EXISTS carts (
+        cart_hash TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cart_guids (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        guid TEXT NOT NULL UNIQUE
+    )
+    """,
+    "ALTER TABLE orders ADD COLUMN IF NOT EXISTS cart_hash TEXT",
+    "ALTER TABLE pending_payments ADD COLUMN IF NOT EXISTS cart_hash TEXT",
+    # Сводки продаж (как в db.py): обновляются триггером на orders в той же транзакции
+    """
+    CREATE TABLE IF NOT EXISTS sales_hourly (
+        hour TEXT PRIMARY KEY,
+        orders BIGINT NOT NULL DEFAULT 0,
+        revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+        cancelled BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        day TEXT PRIMARY KEY,
+        orders BIGINT NOT NULL DEFAULT 0,
+        revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+        cancelled BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_items (
+        day TEXT NOT NULL,
+        menu_item_guid TEXT NOT NULL,
+        quantity BIGINT NOT NULL DEFAULT 0,
+        revenue DOUBLE PRECISION NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, menu_item_guid)
+    )
+    """,
+    # Позиции корзины: массивы из carts или объекты из items_json старых заказов.
+    # Битый JSON или не массив — пустой список, а не ошибка заказа
+    """
+    CREATE OR REPLACE FUNCTION sales_cart_items(items TEXT) RETURNS TABLE (guid TEXT, quantity NUMERIC, price NUMERIC) AS $$
+    DECLARE
+        cart JSONB;
+    BEGIN
+        BEGIN
+            cart := items::jsonb;
+        EXCEPTION WHEN others THEN
+            RETURN;
+        END;
+        IF jsonb_typeof(cart) <> 'array' THEN
+            RETURN;
+        END IF;
+        RETURN QUERY
+            SELECT f.guid,
+                   CASE WHEN jsonb_typeof(f.q) = 'number' THEN (f.q #>> '{}')::numeric ELSE 1 END,
+                   CASE WHEN jsonb_typeof(f.p) = 'number' THEN (f.p #>> '{}')::numeric ELSE 0 END
+            FROM jsonb_array_elements(cart) AS e, LATERAL (
+                SELECT CASE
+                           WHEN jsonb_typeof(e) = 'object' THEN e->>'menuItemGuid'
+                           WHEN jsonb_typeof(e) <> 'array' THEN NULL
+                           WHEN jsonb_typeof(e->0) = 'string' THEN e->>0
+                           WHEN jsonb_typeof(e->0) = 'number' AND e->>0 ~ '^[0-9]{1,18}$'
+                               THEN (SELECT g.guid FROM cart_guids g WHERE g.id = (e->>0)::bigint)
+                       END AS guid,
+                       CASE jsonb_typeof(e) WHEN 'object' THEN e->'quantity' WHEN 'array' THEN e->2 END AS q,
+                       CASE jsonb_typeof(e) WHEN 'object' THEN e->'priceWithDiscount' WHEN 'array' THEN e->3 END AS p
+            ) AS f
+            WHERE f.guid IS NOT NULL;
+    END
+    $$ LANGUAGE plpgsql STABLE
+    """,
+    # Корзина заказа: из carts по cart_hash, у заказов до carts — items_json
+    """
+    CREATE OR REPLACE FUNCTION sales_order_cart(o orders) RETURNS TEXT AS $$
+        SELECT coalesce((SELECT data FROM carts WHERE cart_hash = o.cart_hash), o.items_json)
+    $$ LANGUAGE sql STABLE
+    """,
+    """
+    CREATE OR REPLACE FUNCTION sales_apply(o orders, sign INTEGER, cancelled INTEGER) RETURNS void AS $$
+    BEGIN
+        INSERT INTO sales_hourly (hour, orders, revenue, cancelled)
+            VALUES (substr(o.created_at, 1, 13), sign, sign * o.total_price, cancelled)
+            ON CONFLICT (hour) DO UPDATE SET orders = sales_hourly.orders + EXCLUDED.orders,
+                revenue = sales_hourly.revenue + EXCLUDED.revenue, cancelled = sales_hourly.cancelled + EXCLUDED.cancelled;
+        INSERT INTO sales_daily (day, orders, revenue, cancelled)
+            VALUES (substr(o.created_at, 1, 10), sign, sign * o.total_price, cancelled)
+            ON CONFLICT (day) DO UPDATE SET orders = sales_daily.orders + EXCLUDED.orders,
+                revenue = sales_daily.revenue + EXCLUDED.revenue, cancelled = sales_daily.cancelled + EXCLUDED.cancelled;
+        IF sign <> 0 THEN
+            INSERT INTO sales_items (day, menu_item_guid, quantity, revenue)
+                SELECT substr(o.created_at, 1, 10), c.guid, sign * SUM(c.quantity), sign * SUM(c.price * c.quantity)
+                FROM sales_cart_items(sales_order_cart(o)) AS c GROUP BY c.guid
+                ON CONFLICT (day, menu_item_guid) DO UPDATE SET quantity = sales_items.quantity + EXCLUDED.quantity,
+                    revenue = sales_items.revenue + EXCLUDED.revenue;
+        END IF;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION sales_on_order() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            IF NEW.status = 'CANCELLED' THEN
+                PERFORM sales_apply(NEW, 0, 1);
+            ELSE
+                PERFORM sales_apply(NEW, 1, 0);
+            END IF;
+        ELSIF NEW.status = 'CANCELLED' AND OLD.status <> 'CANCELLED' THEN
+            PERFORM sales_apply(OLD, -1, 1);
+        ELSIF OLD.status = 'CANCELLED' AND NEW.status <> 'CANCELLED' THEN
+            PERFORM sales_apply(OLD, 1, -1);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS trg_sales_on_order ON orders",
+    """
+    CREATE TRIGGER trg_sales_on_order AFTER INSERT OR UPDATE OF status ON orders
+        FOR EACH ROW EXECUTE FUNCTION sales_on_order()
+    """,
+]
+
+
+async def _get_pool():
+    global _pool
+    if _pool is None:
+        import asyncpg
+
+        _pool = await asyncpg.create_pool(DATABASE_URL, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE)
+    return _pool
+
+
+def _rowcount(status: str) -> int:
+    """Число строк из статуса команды asyncpg: 'UPDATE 1', 'INSERT 0 1', 'DELETE 3'."""
+    try:
+        return int(status.rsplit(" ", 1)[-1])
+    except (ValueError, IndexError):
+        return 0
+
+
+async def close_db() -> None:
+    """Закрыть пул соединений (при остановке приложения)."""
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+async def init_db() -> None:
+    """Создать таблицы и индексы, если их нет."""
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _SCHEMA_LOCK_ID)
+            for statement in _SCHEMA:
+                await conn.execute(statement)
+        await _load_cart_guids(conn)
+
+
+# Корзины: одна строка carts на одинаковое содержимое, заказы и платежи хранят cart_hash (см. carts)
+
+
+async def _store_cart(conn, items: list) -> str:
+    """Сохранить корзину (если такой ещё нет) в транзакции conn. Возвращает cart_hash."""
+    cart_hash, data = carts.encode(items)
+    await conn.execute(
+        "INSERT INTO carts (cart_hash, data) VALUES ($1, $2) ON CONFLICT (cart_hash) DO NOTHING", cart_hash, data
+    )
+    return cart_hash
+
+
+async def _load_cart_guids(conn) -> None:
+    carts.remember((row["id"], row["guid"]) for row in await conn.fetch("SELECT id, guid FROM cart_guids"))
+
+
+async def _with_items(conn, row) -> dict:
+    """Строка заказа/платежа (items_json, cart_data) -> dict с корзиной items."""
+    try:
+        return carts.with_items(row)
+    except KeyError:
+        # Номер guid добавил другой процесс после нашей загрузки словаря
+        await _load_cart_guids(conn)
+        return carts.with_items(row)
+
+
+async def register_cart_guids(guids: Iterable[str]) -> int:
+    """Добавить guid меню в словарь корзин (после обновления меню). Возвращает число новых."""
+    new = carts.unknown(guids)
+    if not new:
+        return 0
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "INSERT INTO cart_guids (guid) SELECT unnest($1::text[]) ON CONFLICT (guid) DO NOTHING", new
+        )
+        await _load_cart_guids(conn)
+    return len(new)
+
+
+async def get_user(telegram_id: int) -> Optional[User]:
+    """Получить пользователя по Telegram ID."""
+    pool = await _get_pool()
+    row = await pool.fetchrow("SELECT * FROM users WHERE telegram_id = $1", telegram_id)
+    if not row:
+        return None
+    return User(
+        telegram_id=row["telegram_id"],
+        first_name=row["first_name"],
+        last_name=row["last_name"],
+        username=row["username"],
+        phone=row["phone"],
+        created_at=datetime.fromisoformat(row["created_at"]) if row["created_at"] else None,
+        is_active=bool(row["is_active"]),
+    )
+
+
+async def create_user(user: User) -> User:
+    """Создать нового пользователя (или перезаписать существующего, как INSERT OR REPLACE)."""
+    now = datetime.utcnow().isoformat()
+    pool = await _get_pool()
+    await pool.execute(
+        """INSERT INTO users (telegram_id, first_name, last_name, username, phone, created_at, is_active)
+           VALUES ($1, $2, $3, $4, $5, $6, $7)
+           ON CONFLICT (telegram_id) DO UPDATE
+           SET first_name = excluded.first_name, last_name = excluded.last_name, username = excluded.username,
+               phone = excluded.phone, created_at = excluded.created_at, is_active = excluded.is_active""",
+        user.telegram_id,
+        user.first_name,
+        user.last_name,
+        user.username,
+        user.phone,
+        now,
+        1 if user.is_active else 0,
+    )
+    user.created_at = datetime.fromisoformat(now)
+    return user
+
+
+async def update_user_phone(telegram_id: int, phone: str) -> None:
+    """Обновить телефон пользователя."""
+    pool = await _get_pool()
+    await pool.execute("UPDATE users SET phone = $1 WHERE telegram_id = $2", phone, telegram_id)
+
+
+async def create_order(
+    user_telegram_id: int,
+    ytimes_order_guid: str,
+    total_price: float,
+    status: str = "CREATED",
+    items: list | None = None,
+) -> None:
+    """Сохранить заказ после создания в YTimes (корзина — в carts, в заказе её cart_hash)."""
+    now = datetime.utcnow().isoformat()
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            cart_hash = await _store_cart(conn, items or [])
+            await conn.execute(
+                """INSERT INTO orders (user_telegram_id, items_json, cart_hash, total_price, status, ytimes_order_id, created_at)
+                   VALUES ($1, '', $2, $3, $4, $5, $6)""",
+                user_telegram_id, cart_hash, total_price, status, ytimes_order_guid, now,
+            )
+
+
+async def get_order_by_ytimes_guid(ytimes_guid: str) -> Optional[dict]:
+    """Найти заказ по YTimes guid (для вебхука). Возвращает dict с user_telegram_id, status и др."""
+    pool = await _get_pool()
+    row = await pool.fetchrow(
+        """SELECT order_id, user_telegram_id, total_price, status, ytimes_order_id, created_at
+           FROM orders WHERE ytimes_order_id = $1""",
+        ytimes_guid,
+    )
+    return dict(row) if row else None
+
+
+async def update_order_status(ytimes_guid: str, status: str) -> None:
+    """Обновить статус заказа (ACCEPTED/CANCELLED) после вебхука."""
+    pool = await _get_pool()
+    await pool.execute(
+        "UPDATE orders SET status = $1, updated_at = $2 WHERE ytimes_order_id = $3",
+        status, datetime.utcnow().isoformat(), ytimes_guid,
+    )
+
+
+async def iter_orders(
+    since: str = "",
+    until: str = "9999",
+    after_id: int = 0,
+    chunk_size: int = 1000,
+) -> AsyncIterator[dict]:
+    """Заказы с order_id > after_id и created_at в [since, until) по возрастанию order_id, порциями."""
+    pool = await _get_pool()
+    while True:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                """SELECT o.order_id, o.user_telegram_id, o.items_json, c.data AS cart_data, o.total_price, o.status,
+                          o.ytimes_order_id, o.created_at, o.updated_at
+                   FROM orders o LEFT JOIN carts c ON c.cart_hash = o.cart_hash
+                   WHERE o.order_id > $1 AND o.created_at >= $2 AND o.created_at < $3
+                   ORDER BY o.order_id LIMIT $4""",
+                after_id, since, until, chunk_size,
+            )
+            orders = [await _with_items(conn, row) for row in rows]
+        for order in orders:
+            yield order
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1]["order_id"]
+
+
+async def rebuild_sales_aggregates() -> int:
+    """Пересчитать сводки продаж по всей таблице orders (история до появления сводок).
+
+    orders блокируется от записи на время пересчёта, чтобы новые заказы не потерялись и
+    не учлись дважды. Возвращает число учтённых (не отменённых) заказов.
+    """
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("LOCK TABLE orders IN SHARE ROW EXCLUSIVE MODE")
+            await conn.execute("DELETE FROM sales_hourly")
+            await conn.execute("DELETE FROM sales_daily")
+            await conn.execute("DELETE FROM sales_items")
+            for table, key, length in (("sales_hourly", "hour", 13), ("sales_daily", "day", 10)):
+                await conn.execute(
+                    f"""INSERT INTO {table} ({key}, orders, revenue, cancelled)
+                        SELECT substr(created_at, 1, {length}),
+                               COUNT(*) FILTER (WHERE status <> 'CANCELLED'),
+                               coalesce(SUM(total_price) FILTER (WHERE status <> 'CANCELLED'), 0),
+                               COUNT(*) FILTER (WHERE status = 'CANCELLED')
+                        FROM orders GROUP BY 1"""
+                )
+            await conn.execute(
+                """INSERT INTO sales_items (day, menu_item_guid, quantity, revenue)
+                   SELECT substr(o.created_at, 1, 10), c.guid, SUM(c.quantity), SUM(c.price * c.quantity)
+                   FROM orders o, sales_cart_items(sales_order_cart(o)) AS c
+                   WHERE o.status <> 'CANCELLED'
+                   GROUP BY 1, 2"""
+            )
+            return await conn.fetchval("SELECT coalesce(SUM(orders), 0)::bigint FROM sales_daily")
+
+
+async def get_sales_dashboard(day: str, days: int = 7, top: int = 10) -> dict:
+    """Сводка продаж за день day (ГГГГ-ММ-ДД, UTC) только по таблицам сводок (см. db.py)."""
+    start = (datetime.fromisoformat(day) - timedelta(days=days - 1)).date().isoformat()
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        daily = await conn.fetch(
+            "SELECT day, orders, revenue, cancelled FROM sales_daily WHERE day >= $1 AND day <= $2 ORDER BY day",
+            start, day,
+        )
+        hourly = await conn.fetch(
+            "SELECT hour, orders, revenue, cancelled FROM sales_hourly WHERE hour >= $1 AND hour <= $2 ORDER BY hour",
+            day + "T00", day + "T23",
+        )
+        items = await conn.fetch(
+            """SELECT menu_item_guid, quantity, revenue FROM sales_items
+               WHERE day = $1 AND quantity > 0 ORDER BY quantity DESC, revenue DESC LIMIT $2""",
+            day, top,
+        )
+    daily_rows = [dict(r) for r in daily]
+    totals = next((r for r in daily_rows if r["day"] == day), {"day": day, "orders": 0, "revenue": 0.0, "cancelled": 0})
+    return {
+        "totals": totals,
+        "hourly": [dict(r) for r in hourly],
+        "top_items": [dict(r) for r in items],
+        "daily": daily_rows,
+    }
+
+
+async def create_pending_payment(
+    payment_token: str,
+    telegram_id: int,
+    items: list,
+    total: float,
+    client_json: str = "{}",
+    comment: str = "",
+    site_user_id: int | None = None,
+    link_card_only: bool = False,
+) -> None:
+    """Сохранить ожидающий платёж. link_card_only=True — только привязка карты, заказ не создаём."""
+    now = datetime.utcnow().isoformat()
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            cart_hash = await _store_cart(conn, items)
+            await conn.execute(
+                """INSERT INTO pending_payments
+                   (payment_token, telegram_id, items_json, cart_hash, total, client_json, comment, created_at,
+                    site_user_id, link_card_only)
+                   VALUES ($1, $2, '', $3, $4, $5, $6, $7, $8, $9)""",
+                payment_token, telegram_id, cart_hash, total, client_json, comment or "", now, site_user_id,
+                1 if link_card_only else 0,
+            )
+
+
+async def get_pending_payment(payment_token: str) -> Optional[dict]:
+    """Получить ожидающий платёж по токену (корзина — список items)."""
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """SELECT p.payment_token, p.telegram_id, p.items_json, c.data AS cart_data, p.total, p.client_json,
+                      p.comment, p.yookassa_payment_id, p.site_user_id, p.link_card_only, p.state, p.order_guid
+               FROM pending_payments p LEFT JOIN carts c ON c.cart_hash = p.cart_hash
+               WHERE p.payment_token = $1""",
+            payment_token,
+        )
+        return await _with_items(conn, row) if row else None
+
+
+async def set_pending_yookassa_id(payment_token: str, yookassa_payment_id: str) -> None:
+    """Сохранить id платежа ЮKassa для ожидающего платежа."""
+    pool = await _get_pool()
+    await pool.execute(
+        "UPDATE pending_payments SET yookassa_payment_id = $1 WHERE payment_token = $2",
+        yookassa_payment_id, payment_token,
+    )
+
+
+async def claim_pending_payment(payment_token: str, claim_owner: str, lease_seconds: float) -> Optional[dict]:
+    """Захватить платёж для создания заказа одним условным UPDATE (см. db.claim_pending_payment)."""
+    now = time.time()
+    pool = await _get_pool()
+    status = await pool.execute(
+        """UPDATE pending_payments
+           SET state = 'claimed', claim_owner = $1, claimed_until = $2, updated_at = $3
+           WHERE payment_token = $4
+             AND (state IN ('pending', 'failed') OR (state = 'claimed' AND claimed_until < $5))""",
+        claim_owner, now + lease_seconds, datetime.utcnow().isoformat(), payment_token, now,
+    )
+    if _rowcount(status) != 1:
+        return None
+    return await get_pending_payment(payment_token)
+
+
+async def complete_pending_payment(
+    payment_token: str,
+    claim_owner: str,
+    *,
+    ytimes_order_guid: str | None = None,
+    user_telegram_id: int = 0,
+    total_price: float = 0.0,
+    status: str = "CREATED",
+) -> bool:
+    """Перевести захваченный платёж в fulfilled и сохранить заказ — в одной транзакции.
+
+    Заказ ссылается на корзину платежа (тот же cart_hash), корзина заново не сохраняется.
+    False, если платёж уже не принадлежит claim_owner (аренда истекла и платёж захвачен другим).
+    """
+    now = datetime.utcnow().isoformat()
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            updated = await conn.execute(
+                """UPDATE pending_payments
+                   SET state = 'fulfilled', order_guid = $1, claimed_until = NULL, last_error = NULL, updated_at = $2
+                   WHERE payment_token = $3 AND state = 'claimed' AND claim_owner = $4""",
+                ytimes_order_guid, now, payment_token, claim_owner,
+            )
+            if _rowcount(updated) != 1:
+                return False
+            if ytimes_order_guid:
+                await conn.execute(
+                    """INSERT INTO orders (user_telegram_id, items_json, cart_hash, total_price, status, ytimes_order_id, created_at)
+                       SELECT $1, items_json, cart_hash, $2, $3, $4, $5 FROM pending_payments WHERE payment_token = $6""",
+                    user_telegram_id, total_price, status, ytimes_order_guid, now, payment_token,
+                )
+    return True
+
+
+async def fail_pending_payment(payment_token: str, claim_owner: str, error: str) -> None:
+    """Отметить неудачную попытку (failed): платёж можно захватить повторно."""
+    pool = await _get_pool()
+    await pool.execute(
+        """UPDATE pending_payments
+           SET state = 'failed', claimed_until = NULL, last_error = $1, updated_at = $2
+           WHERE payment_token = $3 AND state = 'claimed' AND claim_owner = $4""",
+        error[:500], datetime.utcnow().isoformat(), payment_token, claim_owner,
+    )
+
+
+async def delete_pending_payment(payment_token: str) -> None:
+    """Удалить ожидающий платёж после создания заказа."""
+    pool = await _get_pool()
+    await pool.execute("DELETE FROM pending_payments WHERE payment_token = $1", payment_token)
+
+
+async def iter_pending_payments(
+    since: str = "",
+    until: str = "9999",
+    after: tuple[str, str] = ("", ""),
+    chunk_size: int = 1000,
+) -> AsyncIterator[dict]:
+    """Ожидающие платежи с created_at в [since, until) по (created_at, payment_token) после after, порциями."""
+    pool = await _get_pool()
+    after_created, after_token = after
+    while True:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                """SELECT p.payment_token, p.telegram_id, p.items_json, c.data AS cart_data, p.total, p.client_json,
+                          p.comment, p.created_at, p.yookassa_payment_id, p.site_user_id, p.link_card_only, p.state,
+                          p.order_guid, p.last_error, p.updated_at
+                   FROM pending_payments p LEFT JOIN carts c ON c.cart_hash = p.cart_hash
+                   WHERE (p.created_at, p.payment_token) > ($1, $2) AND p.created_at >= $3 AND p.created_at < $4
+                   ORDER BY p.created_at, p.payment_token LIMIT $5""",
+                after_created, after_token, since, until, chunk_size,
+            )
+            pending = [await _with_items(conn, row) for row in rows]
+        for row in pending:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        after_created, after_token = rows[-1]["created_at"], rows[-1]["payment_token"]
+
+
+async def create_site_user(phone: str, password_hash: str, name: str | None = None) -> dict | None:
+    """Создать пользователя сайта. Возвращает dict с id, phone, name, created_at или None если телефон занят."""
+    now = datetime.utcnow().isoformat()
+    name = (name or "").strip() or None
+    pool = await _get_pool()
+    user_id = await pool.fetchval(
+        """INSERT INTO site_users (phone, password_hash, name, created_at) VALUES ($1, $2, $3, $4)
+           ON CONFLICT (phone) DO NOTHING RETURNING id""",
+        phone.strip(), password_hash, name, now,
+    )
+    if user_id is None:
+        return None
+    return {"id": user_id, "phone": phone.strip(), "name": name, "created_at": now}
+
+
+async def get_site_user_by_phone(phone: str) -> dict | None:
+    """Получить пользователя сайта по телефону (включая password_hash для проверки)."""
+    pool = await _get_pool()
+    row = await pool.fetchrow(
+        "SELECT id, phone, password_hash, name, created_at FROM site_users WHERE phone = $1", phone.strip()
+    )
+    return dict(row) if row else None
+
+
+async def get_site_user_by_id(user_id: int) -> dict | None:
+    """Получить пользователя сайта по id (без password_hash для ответов API)."""
+    pool = await _get_pool()
+    row = await pool.fetchrow(
+        "SELECT id, phone, name, created_at, saved_payment_method_id FROM site_users WHERE id = $1", user_id
+    )
+    return dict(row) if row else None
+
+
+async def update_site_user_saved_payment_method(site_user_id: int, payment_method_id: str) -> None:
+    """Привязать сохранённый способ оплаты ЮKassa к аккаунту пользователя."""
+    pool = await _get_pool()
+    await pool.execute(
+        "UPDATE site_users SET saved_payment_method_id = $1 WHERE id = $2", payment_method_id.strip(), site_user_id
+    )
+
+
+async def clear_site_user_saved_payment_method(site_user_id: int) -> None:
+    """Отвязать сохранённый способ оплаты (ЮKassa отозвала разрешение на списания)."""
+    pool = await _get_pool()
+    await pool.execute("UPDATE site_users SET saved_payment_method_id = NULL WHERE id = $1", site_user_id)
+
+
+async def reserve_idempotency_key(
+    scope: str, key: str, request_hash: str, lease_seconds: float
+) -> Optional[dict]:
+    """Занять ключ идемпотентности под выполняемый запрос (см. db.reserve_idempotency_key)."""
+    now = time.time()
+    pool = await _get_pool()
+    status = await pool.execute(
+        """INSERT INTO idempotency_keys (scope, key, request_hash, status_code, response_body, expires_at)
+           VALUES ($1, $2, $3, NULL, NULL, $4)
+           ON CONFLICT (scope, key) DO UPDATE
+           SET request_hash = excluded.request_hash, status_code = NULL,
+               response_body = NULL, expires_at = excluded.expires_at
+           WHERE idempotency_keys.expires_at < $5""",
+        scope, key, request_hash, now + lease_seconds, now,
+    )
+    if _rowcount(status) == 1:
+        return None
+    row = await pool.fetchrow(
+        "SELECT request_hash, status_code, response_body FROM idempotency_keys WHERE scope = $1 AND key = $2",
+        scope, key,
+    )
+    if not row:
+        # Запись удалили между запросами (release) — пусть вызывающий попробует снова
+        return {"request_hash": request_hash, "status_code": None, "response_body": None}
+    return dict(row)
+
+
+async def save_idempotent_response(
+    scope: str, key: str, status_code: int, response_body: bytes, ttl_seconds: float
+) -> None:
+    """Сохранить ответ для занятого ключа на ttl_seconds."""
+    pool = await _get_pool()
+    await pool.execute(
+        """UPDATE idempotency_keys SET status_code = $1, response_body = $2, expires_at = $3
+           WHERE scope = $4 AND key = $5""",
+        status_code, response_body, time.time() + ttl_seconds, scope, key,
+    )
+
+
+async def release_idempotency_key(scope: str, key: str) -> None:
+    """Освободить ключ без ответа (запрос упал): повтор выполнится заново."""
+    pool = await _get_pool()
+    await pool.execute(
+        "DELETE FROM idempotency_keys WHERE scope = $1 AND key = $2 AND status_code IS NULL", scope, key
+    )
+
+
+async def reserve_menu_refresh(limit: int, window: float) -> tuple[Optional[int], float]:
+    """Занять одно обновление меню в квоте (см. db.reserve_menu_refresh)."""
+    now = time.time()
+    pool = await _get_pool()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _MENU_REFRESH_LOCK_ID)
+            await conn.execute("DELETE FROM menu_refreshes WHERE at <= $1", now - window)
+            row = await conn.fetchrow("SELECT COUNT(*) AS used, MIN(at) AS oldest FROM menu_refreshes")
+            if row["used"] < limit:
+                return await conn.fetchval("INSERT INTO menu_refreshes (at) VALUES ($1) RETURNING id", now), 0.0
+    oldest = row["oldest"] if row["oldest"] is not None else now
+    return None, max(oldest + window - now, 1.0)
+
+
+async def release_menu_refresh(refresh_id: int) -> None:
+    """Вернуть обновление в квоту: запрос до YTimes не дошёл."""
+    pool = await _get_pool()
+    await pool.execute("DELETE FROM menu_refreshes WHERE id = $1", refresh_id)
+
+
+async def count_menu_refreshes(window: float) -> int:
+    """Сколько обновлений меню учтено за последние window секунд."""
+    pool = await _get_pool()
+    return await pool.fetchval("SELECT COUNT(*) FROM menu_refreshes WHERE at > $1", time.time() - window)
+
+
+async def prune_idempotency_keys() -> int:
+    """Удалить просроченные ключи. Возвращает число удалённых записей."""
+    pool = await _get_pool()
+    return _rowcount(await pool.execute("DELETE FROM idempotency_keys WHERE expires_at < $1", time.time()))
@@ -0,0 +1,99 @@
+"""Время запросов к SQLite по именам и журнал медленных запросов.
+
+Для каждого запроса (имя — функция db.py) отдельно копятся фазы: acquire — открытие
+соединения, execute — выполнение с выборкой строк (сюда же попадает ожидание блокировки
+записи другим соединением), commit — фиксация с fsync, batched — ожидание общей пачки
+DB_GROUP_COMMIT. Каждый запрос медленнее DB_QUERY_SLOW_MS пишется в лог, по возможности
+с EXPLAIN QUERY PLAN. План снимается в фоне на отдельном соединении, один раз на текст
+запроса; пока он снимается, повторы того же запроса пишутся без плана.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Optional
+
+import aiosqlite
+
+SLOW_MS = float(os.getenv("DB_QUERY_SLOW_MS", "100"))
+# Границы гистограммы, мс (последняя корзина — всё, что больше)
+_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+_LABELS = [f"<={b}ms" for b in _BUCKETS_MS] + [f">{_BUCKETS_MS[-1]}ms"]
+
+_stats: dict[tuple[str, str], list] = {}
+# Планы запросов по тексту SQL: EXPLAIN выполняется один раз ("" — ещё снимается)
+_plans: dict[str, str] = {}
+_slow_log: deque[dict] = deque(maxlen=100)
+# Получатель каждой фазы (query, phase, seconds) — например, трассировка веб-приложения
+on_phase: Optional[Callable[[str, str, float], None]] = None
+
+
+def record(query: str, phase: str, seconds: float) -> None:
+    """Учесть одну фазу запроса: счётчик, сумма, максимум и корзина гистограммы."""
+    entry = _stats.get((query, phase))
+    if entry is None:
+        entry = _stats[(query, phase)] = [0, 0.0, 0.0, [0] * len(_LABELS)]
+    ms = seconds * 1000
+    entry[0] += 1
+    entry[1] += ms
+    entry[2] = max(entry[2], ms)
+    index = next((i for i, bound in enumerate(_BUCKETS_MS) if ms <= bound), len(_BUCKETS_MS))
+    entry[3][index] += 1
+    if on_phase is not None:
+        on_phase(query, phase, seconds)
+
+
+def check_slow(path: Path, query: str, phase: str, seconds: float, sql: str | None = None, params: tuple = ()) -> None:
+    """Записать медленную фазу в журнал; для execute — с планом запроса."""
+    ms = seconds * 1000
+    if ms < SLOW_MS:
+        return
+    entry = {"at": round(time.time(), 3), "query": query, "phase": phase, "ms": round(ms, 1)}
+    _slow_log.append(entry)
+    plan = _plans.get(sql) if sql else None
+    if sql and plan is None and phase == "execute":
+        # До запуска задачи: повторы под блокировкой не открывают новых соединений для EXPLAIN
+        _plans[sql] = ""
+        try:
+            asyncio.get_running_loop().create_task(_explain_and_log(path, entry, sql, params))
+            return
+        except RuntimeError:
+            del _plans[sql]
+    if plan:
+        entry["plan"] = plan
+    _print_slow(entry)
+
+
+async def _explain_and_log(path: Path, entry: dict, sql: str, params: tuple) -> None:
+    try:
+        async with aiosqlite.connect(path) as db:
+            async with db.execute("EXPLAIN QUERY PLAN " + sql, params) as cursor:
+                rows = await cursor.fetchall()
+        # Строка плана: (id, parent, notused, detail)
+        _plans[sql] = "; ".join(str(row[-1]) for row in rows) or "—"
+    except Exception as e:
+        _plans[sql] = f"план недоступен: {e}"
+    entry["plan"] = _plans[sql]
+    _print_slow(entry)
+
+
+def _print_slow(entry: dict) -> None:
+    plan = f", план: {entry['plan']}" if entry.get("plan") else ""
+    print(f"[db] медленный запрос {entry['query']} ({entry['phase']}): {entry['ms']:.0f} мс{plan}")
+
+
+def query_stats() -> dict:
+    """Сводка по запросам: {имя: {фаза: count, avg_ms, max_ms, histogram}} и последние медленные."""
+    queries: dict[str, dict] = {}
+    for (query, phase), (count, total, peak, histogram) in sorted(_stats.items()):
+        queries.setdefault(query, {})[phase] = {
+            "count": count,
+            "avg_ms": round(total / count, 2),
+            "max_ms": round(peak, 2),
+            "histogram": {label: n for label, n in zip(_LABELS, histogram) if n},
+        }
+    return {"slow_ms": SLOW_MS, "queries": queries, "slow": list(_slow_log)}
@@ -0,0 +1,169 @@
+"""Групповая фиксация (group commit) простых операций записи SQLite.
+
+Без неё каждая запись — отдельное соединение, транзакция и fsync, и всплеск вебхуков или
+заказов выстраивается в очередь на диск. С DB_GROUP_COMMIT=1 записи из db.py ставятся в
+очередь одного соединения-писателя: всё, что пришло за DB_GROUP_COMMIT_WINDOW_MS, а также
+пока шла предыдущая фиксация, выполняется в одной транзакции с одним COMMIT. Вызывающий
+получает результат только после этого COMMIT — гарантия сохранности та же, что и раньше.
+
+Ошибка в операторе (нарушение UNIQUE и т. п.) в SQLite откатывает только этот оператор,
+поэтому достаётся только его вызывающему; остальные записи пачки фиксируются. Запись из
+нескольких операторов (submit_many) выполняется внутри SAVEPOINT и откатывается целиком.
+Если не удался сам COMMIT, ошибку получают все записи пачки.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sqlite3
+from pathlib import Path
+from typing import Any, Optional
+
+import aiosqlite
+
+ENABLED = os.getenv("DB_GROUP_COMMIT", "0").strip() == "1"
+WINDOW_SECONDS = float(os.getenv("DB_GROUP_COMMIT_WINDOW_MS", "2")) / 1000
+MAX_BATCH = 256
+
+
+class GroupCommitWriter:
+    """Очередь записей и фоновая задача, фиксирующая их пачками."""
+
+    def __init__(self, path: Path, *, window: float = WINDOW_SECONDS, max_batch: int = MAX_BATCH) -> None:
+        self.path = path
+        self.window = window
+        self.max_batch = max_batch
+        self.loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue[tuple[list[tuple[str, tuple]], asyncio.Future]] = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._conn: Optional[aiosqlite.Connection] = None
+        self.batches = 0
+        self.writes = 0
+        self.largest_batch = 0
+
+    async def submit(self, statements: list[tuple[str, tuple]]) -> int:
+        """Выполнить операторы одной записи в ближайшей пачке; rowcount последнего после COMMIT."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        future = self.loop.create_future()
+        self._queue.put_nowait((statements, future))
+        return await future
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._conn is None:
+            # Транзакциями управляем сами: BEGIN IMMEDIATE ... COMMIT на пачку
+            self._conn = await aiosqlite.connect(self.path, isolation_level=None)
+        return self._conn
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self.window > 0:
+                await asyncio.sleep(self.window)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._commit(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _execute(self, conn: aiosqlite.Connection, statements: list[tuple[str, tuple]]) -> int:
+        if len(statements) == 1:
+            cursor = await conn.execute(*statements[0])
+            return cursor.rowcount
+        await conn.execute("SAVEPOINT write")
+        try:
+            for sql, params in statements:
+                cursor = await conn.execute(sql, params)
+        except sqlite3.Error:
+            await conn.execute("ROLLBACK TO write")
+            await conn.execute("RELEASE write")
+            raise
+        await conn.execute("RELEASE write")
+        return cursor.rowcount
+
+    async def _commit(self, batch: list[tuple[list[tuple[str, tuple]], asyncio.Future]]) -> None:
+        results: list[Any] = []
+        try:
+            conn = await self._connection()
+            await conn.execute("BEGIN IMMEDIATE")
+            for statements, _ in batch:
+                try:
+                    results.append(await self._execute(conn, statements))
+                except sqlite3.Error as e:
+                    results.append(e)
+            await conn.execute("COMMIT")
+        except Exception as e:
+            await self._reset()
+            results = [e] * len(batch)
+        self.batches += 1
+        self.writes += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _reset(self) -> None:
+        """После сбоя COMMIT: откатить и переоткрыть соединение при следующей пачке."""
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            await conn.execute("ROLLBACK")
+        except Exception:
+            pass
+        await conn.close()
+
+    async def close(self) -> None:
+        """Дождаться фиксации всех поставленных записей и закрыть соединение."""
+        await self._queue.join()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "writes": self.writes,
+            "avg_batch": round(self.writes / self.batches, 2) if self.batches else None,
+            "largest_batch": self.largest_batch,
+            "queued": self._queue.qsize(),
+        }
+
+
+_writer: Optional[GroupCommitWriter] = None
+
+
+async def submit(path: Path, sql: str, params: tuple = ()) -> int:
+    """Записать через общий писатель процесса (создаётся при первой записи)."""
+    return await submit_many(path, [(sql, params)])
+
+
+async def submit_many(path: Path, statements: list[tuple[str, tuple]]) -> int:
+    """Несколько операторов одной записи: в одной пачке, по порядку и атомарно."""
+    global _writer
+    if _writer is None or _writer.path != path or _writer.loop is not asyncio.get_running_loop():
+        _writer = GroupCommitWriter(path)
+    return await _writer.submit(statements)
+
+
+async def close_group_commit() -> None:
+    """Зафиксировать очередь и закрыть соединение писателя (при остановке приложения)."""
+    global _writer
+    if _writer is not None:
+        writer, _writer = _writer, None
+        await writer.close()
+
+
+def group_commit_stats() -> Optional[dict]:
+    """Счётчики пачек; None, если групповая фиксация выключена или ещё не было записей."""
+    return _writer.stats() if _writer is not None else None
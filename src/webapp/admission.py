@@ -0,0 +1,189 @@
+"""Ограничение нагрузки на путь заказа: отдельный пул потоков для YTimes и допуск запросов.
+
+Синхронный клиент YTimes работает в своём ThreadPoolExecutor (YTIMES_WORKERS потоков),
+а не в общем executor по умолчанию — медленная касса не занимает потоки, нужные остальному
+приложению. Маршруты, которые ходят в YTimes, пропускаются через AdmissionLimiter: не больше
+concurrency одновременно, очередь не длиннее max_queue, ожидание в очереди не дольше
+queue_timeout. Не попавший запрос сразу получает 503 с Retry-After, вместо того чтобы висеть
+до таймаута клиента. Меню, /health и статика лимитам не подчиняются.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+from fastapi.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .tracing import KIND_CLIENT, span
+
+T = TypeVar("T")
+
+YTIMES_WORKERS = int(os.getenv("YTIMES_WORKERS", "8"))
+_ytimes_executor: ThreadPoolExecutor | None = None
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _ytimes_executor
+    if _ytimes_executor is None:
+        _ytimes_executor = ThreadPoolExecutor(max_workers=YTIMES_WORKERS, thread_name_prefix="ytimes")
+    return _ytimes_executor
+
+
+async def run_ytimes(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполнить синхронный вызов клиента YTimes в отдельном пуле потоков (спан ytimes.<метод>)."""
+    loop = asyncio.get_running_loop()
+    with span(f"ytimes.{getattr(fn, '__name__', 'call')}", KIND_CLIENT):
+        return await loop.run_in_executor(_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def shutdown_ytimes_executor() -> None:
+    global _ytimes_executor
+    if _ytimes_executor is not None:
+        _ytimes_executor.shutdown(wait=False, cancel_futures=True)
+        _ytimes_executor = None
+
+
+class Overloaded(Exception):
+    """Запрос не допущен: очередь полна или ожидание превысило бюджет."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f"retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    """Семафор с ограниченной FIFO-очередью и бюджетом ожидания."""
+
+    def __init__(self, name: str, *, concurrency: int, max_queue: int, queue_timeout: float) -> None:
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.rejected = 0
+        # Скользящее среднее времени обработки — для оценки Retry-After
+        self._service_time = 1.0
+
+    def retry_after(self) -> int:
+        backlog = len(self._waiters) + self.in_flight
+        return max(1, math.ceil(self._service_time * backlog / self.concurrency))
+
+    async def acquire(self) -> None:
+        if self.in_flight < self.concurrency and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait({waiter}, timeout=self.queue_timeout)
+        except BaseException:
+            # Клиент отключился, пока ждал: отдать слот, если он уже передан
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+                self._remove(waiter)
+            raise
+        if not waiter.done():
+            waiter.cancel()
+            self._remove(waiter)
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+        # Слот передан из release(): in_flight уже учтён
+        self.admitted += 1
+
+    def _remove(self, waiter: asyncio.Future) -> None:
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self, service_time: float | None = None) -> None:
+        if service_time is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * service_time
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_service_ms": round(self._service_time * 1000, 1),
+        }
+
+
+class AdmissionControlMiddleware:
+    """ASGI-middleware: лимиты по (метод, путь). Остальные запросы проходят без проверок."""
+
+    def __init__(self, app: ASGIApp, limiters: dict[tuple[str, str], AdmissionLimiter]) -> None:
+        self.app = app
+        self.limiters = limiters
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        limiter = self.limiters.get((scope.get("method", ""), scope.get("path", ""))) if scope["type"] == "http" else None
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await limiter.acquire()
+        except Overloaded as e:
+            response = JSONResponse(
+                {"success": False, "error": "Сервис перегружен, повторите попытку позже"},
+                status_code=503,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release(time.monotonic() - started)
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+# Маршруты, которые ждут YTimes (и ЮKassa). Оплата с возвратом со страницы ЮKassa ждёт дольше:
+# пользователь уже заплатил, и отказ ему хуже, чем лишние секунды.
+ORDER_LIMITERS: dict[tuple[str, str], AdmissionLimiter] = {
+    ("POST", "/api/order"): AdmissionLimiter(
+        "order", concurrency=_env_int("ADMISSION_ORDER_CONCURRENCY", 6), max_queue=24, queue_timeout=3.0
+    ),
+    ("POST", "/api/payment/charge-saved"): AdmissionLimiter(
+        "charge_saved", concurrency=_env_int("ADMISSION_PAYMENT_CONCURRENCY", 4), max_queue=16, queue_timeout=3.0
+    ),
+    ("POST", "/api/order-from-payment"): AdmissionLimiter(
+        "order_from_payment", concurrency=_env_int("ADMISSION_PAYMENT_CONCURRENCY", 4), max_queue=32, queue_timeout=10.0
+    ),
+    ("GET", "/api/payment/return"): AdmissionLimiter(
+        "payment_return", concurrency=_env_int("ADMISSION_PAYMENT_CONCURRENCY", 4), max_queue=32, queue_timeout=10.0
+    ),
+}
+
+
+def admission_stats() -> dict:
+    return {limiter.name: limiter.stats() for limiter in ORDER_LIMITERS.values()}
@@ -3,20 +3,23 @@
 from __future__ import annotations
 
 import asyncio
+import hashlib
+import hmac
 import json
+import math
 import os
 import re
 import sys
 import time
 import uuid
+from datetime import datetime, timezone
 from pathlib import Path
 
-import base64
 import httpx
 import jwt
 from dotenv import load_dotenv
 from fastapi import FastAPI, Header, Request
-from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from passlib.hash import bcrypt
@@ -31,24 +34,51 @@ if str(SRC_DIR) not in sys.path:
 load_dotenv(ROOT_DIR / ".env")
 
 from database import (
+    BACKEND,
+    clear_site_user_saved_payment_method,
+    close_db,
     create_order as db_create_order,
     create_pending_payment,
     create_site_user,
-    delete_pending_payment,
     get_order_by_ytimes_guid,
     get_pending_payment,
+    get_sales_dashboard,
     get_site_user_by_id,
     get_site_user_by_phone,
+    group_commit_stats,
     init_db,
+    prune_idempotency_keys,
+    query_stats,
+    register_cart_guids,
     set_pending_yookassa_id,
     update_order_status,
     update_site_user_saved_payment_method,
 )
-from ytimes import YTimesAPIClient, YTimesAPIError
-
+from database import query_timing
+from ytimes import CircuitOpenError, MenuSnapshot, YTimesAPIClient, YTimesAPIError, deep_sizeof
+from ytimes.api_client import ORDER_SAVE_PATH
+
+from .admission import ORDER_LIMITERS, AdmissionControlMiddleware, admission_stats, run_ytimes, shutdown_ytimes_executor
+from .idempotency import IDEMPOTENCY_HEADER, guid_for_request, run_idempotent
+from . import loop_monitor, menu_schedule
+from .loop_monitor import start_loop_monitor, stop_loop_monitor
+from .menu_payload import MenuFieldsError, MenuPayloads, parse_fields
+from .menu_search import MenuSearchIndex
+from .order_service import (
+    OrderFromPaymentError,
+    build_ytimes_items as _build_ytimes_items,
+    create_order_from_payment,
+)
+from .order_status import lookup_order_status, order_statuses
+from . import payment_events
 from .payment_log import log as payment_log
+from .profiler import ProfilingMiddleware, profiler
+from .tracing import TracingMiddleware, record_span, start_tracing, stop_tracing, tracing_stats
+from .static_assets import PrecompressedStaticFiles
+from .yookassa_client import close_yookassa_client, get_yookassa_client
 
 BOT_SECRET_HEADER = "X-Bot-Secret"
+ADMIN_SECRET_HEADER = "X-Admin-Secret"
 AUTH_JWT_SECRET = os.getenv("AUTH_JWT_SECRET", os.getenv("BOT_INTERNAL_SECRET", "change-me")).strip()
 AUTH_JWT_ALGORITHM = "HS256"
 AUTH_JWT_EXP_SECONDS = 30 * 24 * 3600  # 30 дней
@@ -96,12 +126,30 @@ async def _get_auth_user(authorization: str | None = Header(None)) -> dict | Non
         return None
 
 
-# Хранилище меню и добавок — заполняется только фоновой задачей раз в 20 мин (лимит YTimes 10/час)
-_MENU_REFRESH_INTERVAL = 20 * 60  # секунд
-_stored_menu: dict | None = None
-_stored_supplements: list | None = None
+# Хранилище меню и добавок — заполняется фоновой задачей (интервал и квота — menu_schedule,
+# лимит YTimes 10/час) или ручным запуском из админки.
+# Ответ YTimes разбирается в компактную модель (ytimes.menu), исходный JSON не хранится.
+_ONLINE_MENU_GROUP_NAME = "Меню ( онлайн заказы )"
+_IDEMPOTENCY_PRUNE_INTERVAL = 60 * 60  # секунд
+_menu_snapshot: MenuSnapshot | None = None
+# Готовые тела ответов для текущего снимка (строятся при обновлении)
+_menu_payloads: MenuPayloads | None = None
+# Поисковый индекс по текущему снимку
+_menu_search: MenuSearchIndex | None = None
+# Последняя попытка обновления: снимок мог остаться старым после ошибки
+_menu_status: dict = {"last_attempt_at": None, "last_error": None, "last_error_at": None, "next_refresh_at": None}
+_menu_quota = menu_schedule.RefreshQuota()
+# Идущее обновление: параллельные запуски ждут его, а не обращаются к YTimes повторно
+_menu_refresh_task: asyncio.Task | None = None
 
 app = FastAPI(title="Telegram Mini App - Заказы")
+# Лимиты на маршруты заказа/оплаты: при перегрузке YTimes — быстрый 503 с Retry-After
+app.add_middleware(AdmissionControlMiddleware, limiters=ORDER_LIMITERS)
+# Корневой спан запроса и X-Trace-Id; ожидание допуска входит в спан
+app.add_middleware(TracingMiddleware)
+if profiler is not None:
+    # Снаружи лимитов: ожидание в очереди допуска тоже попадает в профиль
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
 
 # Статические файлы (legacy)
 STATIC_DIR = ROOT_DIR / "static"
@@ -115,43 +163,139 @@ templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
 ytimes_client = None
 
 
-async def _refresh_menu_and_supplements() -> None:
-    """Один проход: загрузить меню и добавки из YTimes, сохранить в хранилище."""
-    global _stored_menu, _stored_supplements
+async def _refresh_menu_and_supplements() -> bool:
+    """Один проход: загрузить меню и добавки из YTimes, сохранить в хранилище. True — успешно."""
+    global _menu_snapshot, _menu_payloads, _menu_search
     if not ytimes_client:
-        return
+        return False
+    _menu_status["last_attempt_at"] = time.time()
     try:
-        loop = asyncio.get_event_loop()
-        menu = await loop.run_in_executor(None, ytimes_client.get_menu_items)
+        menu = await run_ytimes(ytimes_client.get_menu_items)
         target = None
         for g in menu:
-            if g.get("name") == "Меню ( онлайн заказы )":
+            if g.get("name") == _ONLINE_MENU_GROUP_NAME:
                 target = g
                 break
-        if target:
-            _stored_menu = target
-        supps = await loop.run_in_executor(None, ytimes_client.get_supplements)
-        _stored_supplements = supps
-        print("Меню и добавки обновлены из YTimes.")
+        supps = await run_ytimes(ytimes_client.get_supplements)
+        if not target:
+            print(f"Фоновое обновление меню: группа «{_ONLINE_MENU_GROUP_NAME}» не найдена, меню не изменено.")
+            _menu_status.update(last_error=f"Группа «{_ONLINE_MENU_GROUP_NAME}» не найдена", last_error_at=time.time())
+            return False
+        snapshot = MenuSnapshot.from_ytimes(target, supps)
+        raw_size = deep_sizeof(target) + deep_sizeof(supps)
+        model_size = snapshot.footprint()
+        payloads = MenuPayloads(snapshot)
+        search = MenuSearchIndex(snapshot)
+        _menu_snapshot = snapshot
+        _menu_payloads = payloads
+        _menu_search = search
+        try:
+            # guid меню — в словарь компактной записи корзин (новые позиции, размеры, добавки)
+            await register_cart_guids(snapshot.guids())
+        except Exception as e:
+            print(f"Словарь корзин не обновлён: {e}")
+        print(
+            f"Меню и добавки обновлены из YTimes (версия {snapshot.version}): позиций {len(snapshot.items)}, "
+            f"в памяти {model_size // 1024} КБ против {raw_size // 1024} КБ исходного JSON "
+            f"(в {raw_size / max(model_size, 1):.1f} раза меньше)."
+        )
+        _menu_status.update(last_error=None, last_error_at=None)
+        return True
+    except CircuitOpenError as e:
+        # Запрос до YTimes не дошёл — квоту не тратим
+        await _menu_quota.release()
+        print(f"Фоновое обновление меню: {e}")
+        _menu_status.update(last_error=str(e), last_error_at=time.time())
+        return False
     except Exception as e:
         print(f"Фоновое обновление меню: {e}")
+        _menu_status.update(last_error=str(e), last_error_at=time.time())
+        return False
+
+
+async def _refresh_menu_within_quota() -> tuple[bool, float]:
+    """Занять место в общей квоте и обновить меню. (успех, секунд до освобождения квоты — если не заняли)."""
+    wait = await _menu_quota.acquire()
+    if wait > 0:
+        return False, wait
+    return await _refresh_menu_and_supplements(), 0.0
+
+
+async def _refresh_menu_single_flight() -> tuple[bool, bool, float]:
+    """Обновить меню или присоединиться к уже идущему обновлению.
+
+    (успех, присоединились ли, секунд ожидания квоты: больше нуля — квота выбрана, YTimes не вызывался).
+    """
+    global _menu_refresh_task
+    task = _menu_refresh_task
+    if task is not None and not task.done():
+        ok, wait = await asyncio.shield(task)
+        return ok, True, wait
+    task = asyncio.create_task(_refresh_menu_within_quota())
+    _menu_refresh_task = task
+    ok, wait = await asyncio.shield(task)
+    return ok, False, wait
+
+
+def _menu_headers(payloads: MenuPayloads) -> dict[str, str]:
+    """Возраст и версия снимка; X-Menu-Stale, если последнее обновление не удалось."""
+    fetched_at = payloads.snapshot.fetched_at
+    headers = {
+        "Age": str(max(0, int(time.time() - fetched_at))),
+        "X-Menu-Version": payloads.version,
+        "X-Menu-Fetched-At": datetime.fromtimestamp(fetched_at, timezone.utc).isoformat(timespec="seconds"),
+    }
+    error_at = _menu_status["last_error_at"]
+    if error_at and error_at > fetched_at:
+        headers["X-Menu-Stale"] = "1"
+        headers["X-Menu-Last-Error-At"] = datetime.fromtimestamp(error_at, timezone.utc).isoformat(timespec="seconds")
+    return headers
+
+
+async def _idempotency_prune_loop() -> None:
+    """Фоновая задача: раз в час удалять просроченные ключи идемпотентности."""
+    while True:
+        try:
+            removed = await prune_idempotency_keys()
+            if removed:
+                print(f"Idempotency-Key: удалено просроченных ключей: {removed}")
+        except Exception as e:
+            print(f"Очистка ключей идемпотентности: {e}")
+        await asyncio.sleep(_IDEMPOTENCY_PRUNE_INTERVAL)
 
 
 async def _menu_refresh_loop() -> None:
-    """Фоновая задача: раз в 20 минут обновлять меню и добавки из YTimes."""
+    """Фоновая задача: обновлять меню и добавки из YTimes по расписанию menu_schedule."""
     while True:
-        await _refresh_menu_and_supplements()
-        await asyncio.sleep(_MENU_REFRESH_INTERVAL)
+        try:
+            ok, _, wait = await _refresh_menu_single_flight()
+        except Exception as e:
+            # Квота не прочиталась из БД — попробуем позже, как после неудачного обновления
+            print(f"Фоновое обновление меню: {e}")
+            ok, wait = False, 0.0
+        if wait > 0:
+            # Квоту выбрали ручные обновления или другие реплики
+            _menu_status["next_refresh_at"] = time.time() + wait
+            await asyncio.sleep(wait)
+            continue
+        interval = menu_schedule.next_interval(failed=not ok)
+        _menu_status["next_refresh_at"] = time.time() + interval
+        await asyncio.sleep(interval)
 
 
 @app.on_event("startup")
 async def startup():
     """Инициализация при запуске."""
     global ytimes_client
+    start_loop_monitor()
+    if start_tracing() is not None:
+        # Фазы запросов к SQLite (acquire/execute/commit) — дочерние спаны текущего запроса
+        query_timing.on_phase = lambda query, phase, seconds: record_span(f"db.{query}.{phase}", seconds)
     try:
         await init_db()
     except Exception as e:
         print(f"Ошибка инициализации БД: {e}")
+    asyncio.create_task(_idempotency_prune_loop())
     try:
         ytimes_client = YTimesAPIClient.from_env()
     except Exception as e:
@@ -160,50 +304,284 @@ async def startup():
         asyncio.create_task(_menu_refresh_loop())
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    """Закрыть пулы соединений (ЮKassa, YTimes, БД)."""
+    stop_loop_monitor()
+    if profiler is not None:
+        profiler.stop()
+    query_timing.on_phase = None
+    stop_tracing()
+    payment_events.close_payment_events()
+    await close_yookassa_client()
+    shutdown_ytimes_executor()
+    await close_db()
+
+
 @app.get("/health")
 async def health():
     """Health-check для PaaS (Railway, Render, Fly.io)."""
-    return JSONResponse({"status": "ok"})
+    body: dict = {"status": "ok", "admission": admission_stats()}
+    if ytimes_client is not None and hasattr(ytimes_client, "resilience_stats"):
+        body["ytimes"] = ytimes_client.resilience_stats()
+    yookassa = get_yookassa_client()
+    if yookassa is not None:
+        body["yookassa"] = {"latency": yookassa.stats(), "last_error_status": yookassa.last_error_status}
+    body["menu"] = await _menu_state()
+    body["order_status_cache"] = order_statuses.stats()
+    if loop_monitor.loop_monitor is not None:
+        body["event_loop"] = loop_monitor.loop_monitor.stats()
+    events = payment_events.payment_events_stats()
+    if events is not None:
+        body["payment_events"] = events
+    traces = tracing_stats()
+    if traces is not None:
+        body["tracing"] = traces
+    db_writes = group_commit_stats()
+    if db_writes is not None:
+        body["db_group_commit"] = db_writes
+    return JSONResponse(body)
+
+
+async def _menu_state() -> dict:
+    """Состояние снимка меню и расписания обновлений."""
+    try:
+        used = await _menu_quota.used()
+    except Exception:
+        # /health не должен падать из-за БД
+        used = None
+    payloads = _menu_payloads
+    now = time.time()
+    next_at = _menu_status["next_refresh_at"]
+    return {
+        "version": payloads.version if payloads else None,
+        "age_s": int(now - payloads.snapshot.fetched_at) if payloads else None,
+        "last_error": _menu_status["last_error"],
+        "refreshes_last_hour": used,
+        "refreshes_per_hour": _menu_quota.limit,
+        "next_refresh_in_s": max(0, int(next_at - now)) if next_at else None,
+        "shop_open": menu_schedule.is_open(now),
+    }
+
+
+def _require_admin_secret(x_admin_secret: str | None) -> None:
+    """Проверка секрета для служебных эндпоинтов (/api/admin/...)."""
+    secret = os.getenv("ADMIN_SECRET", "").strip()
+    if not secret:
+        raise ValueError("ADMIN_SECRET не задан")
+    if not x_admin_secret or not hmac.compare_digest(x_admin_secret, secret):
+        raise ValueError("Неверный или отсутствующий X-Admin-Secret")
+
+
+@app.get("/api/admin/loop-stalls")
+async def api_admin_loop_stalls(x_admin_secret: str | None = Header(None, alias=ADMIN_SECRET_HEADER)):
+    """Последние остановки event loop со стеками блокирующего кода (LOOP_MONITOR=1)."""
+    try:
+        _require_admin_secret(x_admin_secret)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=403)
+    monitor = loop_monitor.loop_monitor
+    if monitor is None:
+        return JSONResponse({"success": False, "error": "Монитор выключен (LOOP_MONITOR=1)"}, status_code=404)
+    return JSONResponse({"success": True, "stats": monitor.stats(), "reports": list(monitor.reports)})
+
+
+@app.get("/api/admin/db-stats")
+async def api_admin_db_stats(x_admin_secret: str | None = Header(None, alias=ADMIN_SECRET_HEADER)):
+    """Время запросов к БД по фазам (acquire/execute/commit) и последние медленные с планом."""
+    try:
+        _require_admin_secret(x_admin_secret)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=403)
+    return JSONResponse({"success": True, "backend": BACKEND, **query_stats()})
+
+
+@app.get("/api/admin/yookassa")
+async def api_admin_yookassa(x_admin_secret: str | None = Header(None, alias=ADMIN_SECRET_HEADER)):
+    """Задержки запросов к ЮKassa и последняя ошибка с телом ответа (в /health — только статус)."""
+    try:
+        _require_admin_secret(x_admin_secret)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=403)
+    yookassa = get_yookassa_client()
+    if yookassa is None:
+        return JSONResponse({"success": False, "error": "ЮKassa не настроена"}, status_code=503)
+    return JSONResponse({
+        "success": True,
+        "latency": yookassa.stats(),
+        "last_error": yookassa.last_error,
+        "last_error_status": yookassa.last_error_status,
+    })
+
+
+@app.get("/api/admin/payment-events/funnel")
+async def api_admin_payment_events_funnel(
+    hours: float = 24,
+    by_day: bool = False,
+    x_admin_secret: str | None = Header(None, alias=ADMIN_SECRET_HEADER),
+):
+    """Число событий оплаты каждого типа за последние hours часов (by_day — по дням UTC)."""
+    try:
+        _require_admin_secret(x_admin_secret)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=403)
+    since_ms = int((time.time() - hours * 3600) * 1000)
+    counts = await payment_events.run_query(payment_events.funnel, since_ms, by_day=by_day)
+    return JSONResponse({"success": True, "since_ms": since_ms, "events": counts})
+
+
+@app.get("/api/admin/payment-events/{payment_token}")
+async def api_admin_payment_events_timeline(
+    payment_token: str,
+    x_admin_secret: str | None = Header(None, alias=ADMIN_SECRET_HEADER),
+):
+    """История одного платежа: все события payment_log по payment_token."""
+    try:
+        _require_admin_secret(x_admin_secret)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=403)
+    events = await payment_events.run_query(payment_events.timeline, payment_token)
+    if not events:
+        return JSONResponse({"success": False, "error": "События не найдены"}, status_code=404)
+    return JSONResponse({"success": True, "events": events})
+
+
+@app.get("/api/admin/sales")
+async def api_admin_sales(
+    day: str | None = None,
+    days: int = 7,
+    top: int = 10,
+    x_admin_secret: str | None = Header(None, alias=ADMIN_SECRET_HEADER),
+):
+    """Сводка продаж за день (ГГГГ-ММ-ДД, UTC; по умолчанию сегодня): по часам, топ позиций, дни."""
+    try:
+        _require_admin_secret(x_admin_secret)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=403)
+    day = day or datetime.now(timezone.utc).date().isoformat()
+    try:
+        datetime.strptime(day, "%Y-%m-%d")
+    except ValueError:
+        return JSONResponse({"success": False, "error": "day должен быть в формате ГГГГ-ММ-ДД"}, status_code=400)
+    dashboard = await get_sales_dashboard(day, days=max(1, min(days, 366)), top=max(1, min(top, 100)))
+    return JSONResponse({"success": True, "day": day, **dashboard})
+
+
+@app.get("/api/admin/profiles")
+async def api_admin_profiles(x_admin_secret: str | None = Header(None, alias=ADMIN_SECRET_HEADER)):
+    """Сводка профилей по маршрутам (PROFILE_SAMPLE_RATE / PROFILE_SLOW_MS)."""
+    try:
+        _require_admin_secret(x_admin_secret)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=403)
+    if profiler is None:
+        return JSONResponse({"success": False, "error": "Профилировщик выключен"}, status_code=404)
+    return JSONResponse({"success": True, **profiler.summary()})
+
+
+@app.get("/api/admin/profiles/{name}")
+async def api_admin_profile_download(name: str, x_admin_secret: str | None = Header(None, alias=ADMIN_SECRET_HEADER)):
+    """Свёрнутые стеки маршрута для flamegraph.pl / speedscope (имя — из сводки)."""
+    try:
+        _require_admin_secret(x_admin_secret)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=403)
+    folded = profiler.folded(name) if profiler is not None else None
+    if folded is None:
+        return JSONResponse({"success": False, "error": "Профиль не найден"}, status_code=404)
+    return Response(
+        folded,
+        media_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{name}.folded"'},
+    )
+
+
+@app.post("/api/admin/menu/refresh")
+async def api_admin_menu_refresh(x_admin_secret: str | None = Header(None, alias=ADMIN_SECRET_HEADER)):
+    """Обновить меню из YTimes сейчас. Параллельные вызовы ждут одно общее обновление."""
+    try:
+        _require_admin_secret(x_admin_secret)
+    except ValueError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=403)
+    if not ytimes_client:
+        return JSONResponse({"success": False, "error": "YTimes не настроен"}, status_code=503)
+    ok, coalesced, wait = await _refresh_menu_single_flight()
+    if wait > 0:
+        return JSONResponse(
+            {"success": False, "error": "Квота обновлений меню на этот час исчерпана", "menu": await _menu_state()},
+            status_code=429,
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+    return JSONResponse(
+        {"success": ok, "coalesced": coalesced, "menu": await _menu_state()}, status_code=200 if ok else 502
+    )
 
 
 @app.get("/api/menu")
-async def get_menu():
-    """Меню отдаётся из хранилища (обновляется фоновой задачей раз в 20 мин)."""
-    if _stored_menu is not None:
-        return JSONResponse({"success": True, "data": _stored_menu})
+async def get_menu(fields: str | None = None):
+    """Меню отдаётся из хранилища (обновляется фоновой задачей, см. menu_schedule).
+
+    fields — поля позиций через запятую (guid,name,price,typeList,supplementCategoryToFreeCount).
+    """
+    try:
+        selected = parse_fields(fields)
+    except MenuFieldsError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=400)
+    payloads = _menu_payloads
+    if payloads is not None:
+        return Response(payloads.menu(selected), media_type="application/json", headers=_menu_headers(payloads))
     return JSONResponse(
         {"error": "Меню загружается, попробуйте через минуту."},
         status_code=503,
     )
 
 
+@app.get("/api/bootstrap")
+async def api_bootstrap(
+    menu_version: str = "",
+    supplements_version: str = "",
+    authorization: str | None = Header(None),
+):
+    """Всё для первого экрана одним запросом: меню, добавки, текущий пользователь и версии.
+
+    menu_version / supplements_version — версии, которые уже есть у клиента:
+    неизменённые части в ответ не попадают (клиент берёт их из своего кеша).
+    """
+    payloads = _menu_payloads
+    if payloads is None:
+        return JSONResponse(
+            {"error": "Меню загружается, попробуйте через минуту."},
+            status_code=503,
+        )
+    user = await _get_auth_user(authorization)
+    body = payloads.bootstrap(user, menu_version=menu_version, supplements_version=supplements_version)
+    return Response(body, media_type="application/json", headers={"Cache-Control": "no-store", **_menu_headers(payloads)})
+
+
+@app.get("/api/menu/search")
+async def search_menu(q: str = "", limit: int = 20):
+    """Поиск по названиям позиций, размеров и добавок (индекс строится при обновлении меню)."""
+    if _menu_search is None:
+        return JSONResponse(
+            {"error": "Меню загружается, попробуйте через минуту."},
+            status_code=503,
+        )
+    limit = max(1, min(limit, 100))
+    return JSONResponse({"success": True, "version": _menu_search.version, **_menu_search.search(q[:100], limit)})
+
+
 @app.get("/api/supplements")
 async def get_supplements():
-    """Добавки отдаются из хранилища (обновляется фоновой задачей раз в 20 мин)."""
-    if _stored_supplements is not None:
-        return JSONResponse({"success": True, "data": _stored_supplements})
+    """Добавки отдаются из хранилища (обновляется фоновой задачей, см. menu_schedule)."""
+    payloads = _menu_payloads
+    if payloads is not None:
+        return Response(payloads.supplements, media_type="application/json", headers=_menu_headers(payloads))
     return JSONResponse(
         {"error": "Данные загружаются, попробуйте через минуту."},
         status_code=503,
     )
 
 
-def _build_ytimes_items(items: list) -> list:
-    """Собрать itemList для YTimes: menuTypeGuid только если есть."""
-    out = []
-    for item in items:
-        row = {
-            "menuItemGuid": item.get("menuItemGuid"),
-            "supplementList": item.get("supplementList") or {},
-            "priceWithDiscount": float(item.get("priceWithDiscount", 0)),
-            "quantity": int(item.get("quantity", 1)),
-        }
-        if item.get("menuTypeGuid"):
-            row["menuTypeGuid"] = item["menuTypeGuid"]
-        out.append(row)
-    return out
-
-
 @app.post("/api/auth/register")
 async def api_auth_register(request: Request):
     """Регистрация: телефон + пароль, опционально имя. Защита: rate limit, пароль не менее 8 символов."""
@@ -271,17 +649,53 @@ async def api_auth_me(authorization: str | None = Header(None)):
     return JSONResponse({"success": True, "user": user})
 
 
+def _cart_price_error(items: list) -> JSONResponse | None:
+    """Сверить цены корзины с текущим снимком меню; 400, если позиция или цена разошлись.
+
+    Без снимка (меню ещё не загружено) проверка пропускается — цены проверит касса.
+    """
+    snapshot = _menu_snapshot
+    if snapshot is None:
+        return None
+    for item in items:
+        expected = snapshot.line_price(
+            str(item.get("menuItemGuid") or ""),
+            item.get("menuTypeGuid"),
+            item.get("supplementList") or {},
+        )
+        if expected is None:
+            return JSONResponse({"success": False, "error": "Позиции нет в меню, обновите меню"}, status_code=400)
+        if abs(float(item.get("priceWithDiscount", 0)) - expected) > 0.01:
+            return JSONResponse({"success": False, "error": "Цена позиции изменилась, обновите меню"}, status_code=400)
+    return None
+
+
 @app.post("/api/order")
-async def api_create_order(request: Request, authorization: str | None = Header(None)):
-    """Создать заказ и отправить на кассу YTimes."""
+async def api_create_order(
+    request: Request,
+    authorization: str | None = Header(None),
+    idempotency_key: str | None = Header(None, alias=IDEMPOTENCY_HEADER),
+):
+    """Создать заказ и отправить на кассу YTimes. Повтор с тем же Idempotency-Key получает первый ответ."""
+    # guid из ключа: если ответ потерялся, повтор отправит в YTimes тот же заказ, а не новый
+    order_guid = await guid_for_request("order", idempotency_key, request) if idempotency_key else None
+    return await run_idempotent(
+        "order", idempotency_key, request, lambda: _create_order(request, authorization, order_guid)
+    )
+
+
+async def _create_order(request: Request, authorization: str | None, order_guid: str | None) -> JSONResponse:
     try:
         data = await request.json()
         items = data.get("items", [])
         if not items:
             return JSONResponse({"success": False, "error": "Пустой заказ"}, status_code=400)
+        price_error = _cart_price_error(items)
+        if price_error is not None:
+            return price_error
 
         total = sum(item.get("priceWithDiscount", 0) * item.get("quantity", 1) for item in items)
-        order_guid = str(uuid.uuid4())
+        order_guid = order_guid or str(uuid.uuid4())
         client = data.get("client") or {}
         auth_user = await _get_auth_user(authorization)
         if auth_user:
@@ -306,18 +720,15 @@ async def api_create_order(request: Request, authorization: str | None = Header(
         shop_guid = ytimes_client.default_shop_guid
         ytimes_items = _build_ytimes_items(items)
 
-        loop = asyncio.get_event_loop()
-        created = await loop.run_in_executor(
-            None,
-            lambda: ytimes_client.create_order(
-                order_guid=order_guid,
-                shop_guid=shop_guid,
-                order_type=order_type,
-                items=ytimes_items,
-                client=client,
-                comment=comment or None,
-                paid_value=paid_value,
-            ),
+        created = await run_ytimes(
+            ytimes_client.create_order,
+            order_guid=order_guid,
+            shop_guid=shop_guid,
+            order_type=order_type,
+            items=ytimes_items,
+            client=client,
+            comment=comment or None,
+            paid_value=paid_value,
         )
 
         order_id_return = created.get("guid") or order_guid
@@ -328,8 +739,9 @@ async def api_create_order(request: Request, authorization: str | None = Header(
             ytimes_order_guid=order_id_return,
             total_price=total,
             status=status,
-            items_json=json.dumps(items),
+            items=items,
         )
+        order_statuses.put(order_id_return, status, float(total))
 
         return JSONResponse({
             "success": True,
@@ -338,6 +750,8 @@ async def api_create_order(request: Request, authorization: str | None = Header(
             "total": total,
             "message": "Заказ успешно сформирован и отправлен на кассу",
         })
+    except CircuitOpenError as e:
+        return _ytimes_unavailable(e.retry_after)
     except YTimesAPIError as e:
         return JSONResponse({"success": False, "error": str(e)}, status_code=502)
     except Exception as e:
@@ -346,6 +760,15 @@ async def api_create_order(request: Request, authorization: str | None = Header(
         return JSONResponse({"success": False, "error": str(e)}, status_code=500)
 
 
+@app.get("/api/order/{order_id}/status")
+async def api_order_status(order_id: str):
+    """Статус заказа по guid YTimes (CREATED, ACCEPTED, CANCELLED). Читается из кэша, при промахе — из БД."""
+    order = await lookup_order_status(order_id[:64])
+    if not order:
+        return JSONResponse({"success": False, "error": "Заказ не найден"}, status_code=404)
+    return JSONResponse({"success": True, **order}, headers={"Cache-Control": "no-store"})
+
+
 async def _send_telegram_message(chat_id: int, text: str) -> None:
     """Отправить сообщение пользователю через Telegram Bot API."""
     token = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -359,6 +782,15 @@ async def _send_telegram_message(chat_id: int, text: str) -> None:
             pass
 
 
+def _ytimes_unavailable(retry_after: float) -> JSONResponse:
+    """YTimes временно отключён автоматом защиты: 503 с Retry-After вместо ожидания таймаута."""
+    return JSONResponse(
+        {"success": False, "error": "Касса временно недоступна, повторите попытку позже"},
+        status_code=503,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
 def _require_bot_secret(x_bot_secret: str | None = Header(None, alias=BOT_SECRET_HEADER)) -> None:
     """Проверка секрета для эндпоинтов, вызываемых только ботом."""
     secret = os.getenv("BOT_INTERNAL_SECRET")
@@ -368,78 +800,24 @@ def _require_bot_secret(x_bot_secret: str | None = Header(None, alias=BOT_SECRET
         raise ValueError("Неверный или отсутствующий X-Bot-Secret")
 
 
-def _yookassa_auth() -> tuple[str, str] | None:
-    """Shop ID и secret_key для ЮKassa. Если не заданы — оплата в приложении недоступна."""
-    shop_id = os.getenv("YOOKASSA_SHOP_ID", "").strip()
-    secret = os.getenv("YOOKASSA_SECRET_KEY", "").strip()
-    if not shop_id or not secret:
-        return None
-    return (shop_id, secret)
-
-
-async def _yookassa_create_payment(
-    amount_rub: float,
-    description: str,
-    return_url: str,
-    metadata: dict,
-    save_payment_method: bool = False,
-) -> dict | None:
-    """Создать платёж в ЮKassa. save_payment_method=True — привязка карты для повторных списаний."""
-    creds = _yookassa_auth()
-    if not creds:
-        return None
-    shop_id, secret = creds
-    auth = base64.b64encode(f"{shop_id}:{secret}".encode()).decode()
-    value = f"{amount_rub:.2f}"
-    payload = {
-        "amount": {"value": value, "currency": "RUB"},
-        "confirmation": {"type": "redirect", "return_url": return_url},
-        "description": description[:255],
-        "capture": True,
-        "metadata": metadata,
-    }
-    if save_payment_method:
-        payload["save_payment_method"] = True
-    async with httpx.AsyncClient(timeout=15.0) as client:
-        r = await client.post(
-            "https://api.yookassa.ru/v3/payments",
-            headers={
-                "Authorization": f"Basic {auth}",
-                "Idempotence-Key": str(uuid.uuid4()),
-                "Content-Type": "application/json",
-            },
-            json=payload,
-        )
-    if r.status_code != 200:
-        return None
-    return r.json()
-
-
-async def _yookassa_get_payment(payment_id: str) -> dict | None:
-    """Получить платёж из ЮKassa по id."""
-    creds = _yookassa_auth()
-    if not creds:
-        return None
-    shop_id, secret = creds
-    auth = base64.b64encode(f"{shop_id}:{secret}".encode()).decode()
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        r = await client.get(
-            f"https://api.yookassa.ru/v3/payments/{payment_id}",
-            headers={"Authorization": f"Basic {auth}"},
-        )
-    if r.status_code != 200:
-        return None
-    return r.json()
-
-
 @app.post("/api/payment/prepare")
-async def api_payment_prepare(request: Request):
+async def api_payment_prepare(
+    request: Request,
+    idempotency_key: str | None = Header(None, alias=IDEMPOTENCY_HEADER),
+):
     """Подготовить платёж: сохранить корзину, вернуть payment_token для инвойса."""
+    return await run_idempotent("payment_prepare", idempotency_key, request, lambda: _payment_prepare(request))
+
+
+async def _payment_prepare(request: Request) -> JSONResponse:
     try:
         data = await request.json()
         items = data.get("items", [])
         if not items:
             return JSONResponse({"success": False, "error": "Пустая корзина"}, status_code=400)
+        price_error = _cart_price_error(items)
+        if price_error is not None:
+            return price_error
         total = sum(item.get("priceWithDiscount", 0) * item.get("quantity", 1) for item in items)
         telegram_id = int(data.get("telegramUserId") or 0)
         client = data.get("client") or {}
@@ -448,7 +826,7 @@ async def api_payment_prepare(request: Request):
         await create_pending_payment(
             payment_token=payment_token,
             telegram_id=telegram_id,
-            items_json=json.dumps(items),
+            items=items,
             total=total,
             client_json=json.dumps(client),
             comment=comment,
@@ -460,8 +838,18 @@ async def api_payment_prepare(request: Request):
 
 
 @app.post("/api/payment/create-inapp")
-async def api_payment_create_inapp(request: Request, authorization: str | None = Header(None)):
+async def api_payment_create_inapp(
+    request: Request,
+    authorization: str | None = Header(None),
+    idempotency_key: str | None = Header(None, alias=IDEMPOTENCY_HEADER),
+):
     """Создать платёж ЮKassa для оплаты внутри Mini App. Возвращает confirmation_url для перехода."""
+    return await run_idempotent(
+        "payment_create_inapp", idempotency_key, request, lambda: _payment_create_inapp(request, authorization)
+    )
+
+
+async def _payment_create_inapp(request: Request, authorization: str | None) -> JSONResponse:
     payment_token = None
     try:
         data = await request.json()
@@ -469,6 +857,10 @@ async def api_payment_create_inapp(request: Request, authorization: str | None =
         if not items:
             payment_log("create_inapp_reject", reason="empty_cart")
             return JSONResponse({"success": False, "error": "Пустая корзина"}, status_code=400)
+        price_error = _cart_price_error(items)
+        if price_error is not None:
+            payment_log("create_inapp_reject", reason="price_mismatch")
+            return price_error
         total = sum(item.get("priceWithDiscount", 0) * item.get("quantity", 1) for item in items)
         if total <= 0:
             payment_log("create_inapp_reject", reason="invalid_total", total=total)
@@ -487,7 +879,8 @@ async def api_payment_create_inapp(request: Request, authorization: str | None =
         if not (client.get("phone") or str(client.get("phone", "")).strip()):
             payment_log("create_inapp_reject", reason="no_phone")
             return JSONResponse({"success": False, "error": "Укажите телефон"}, status_code=400)
-        if not _yookassa_auth():
+        yookassa = get_yookassa_client()
+        if yookassa is None:
             payment_log("create_inapp_reject", reason="yookassa_not_configured")
             return JSONResponse(
                 {"success": False, "error": "Оплата в приложении не настроена (ЮKassa). Выберите «Оплата при получении» или оплату через бота."},
@@ -500,7 +893,7 @@ async def api_payment_create_inapp(request: Request, authorization: str | None =
         await create_pending_payment(
             payment_token=payment_token,
             telegram_id=telegram_id,
-            items_json=json.dumps(items),
+            items=items,
             total=total,
             client_json=json.dumps(client),
             comment=comment,
@@ -512,11 +905,11 @@ async def api_payment_create_inapp(request: Request, authorization: str | None =
             payment_log("create_inapp_reject", reason="no_webapp_url")
             return JSONResponse({"success": False, "error": "WEBAPP_URL не задан"}, status_code=500)
         return_url = f"{webapp_url}/api/payment/return?payment_token={payment_token}"
-        yookassa_resp = await _yookassa_create_payment(
+        yookassa_resp = await yookassa.create_payment(
+            payment_token=payment_token,
             amount_rub=total,
             description=f"Заказ на {total:.2f} ₽",
             return_url=return_url,
-            metadata={"payment_token": payment_token},
         )
         if not yookassa_resp or yookassa_resp.get("status") not in ("pending", "waiting_for_capture"):
             payment_log("create_inapp_yookassa_fail", payment_token=payment_token, yookassa_status=yookassa_resp.get("status") if yookassa_resp else None)
@@ -552,22 +945,25 @@ async def api_payment_return(payment_token: str):
     if not pending:
         payment_log("return_fail", payment_token=payment_token, reason="pending_not_found")
         return RedirectResponse(url=fail_url)
+    if pending.get("state") == "fulfilled":
+        # Повторное открытие ссылки возврата: заказ уже создан
+        payment_log("return_already_fulfilled", payment_token=payment_token, order_id=pending.get("order_guid"))
+        if pending.get("link_card_only"):
+            return RedirectResponse(url=f"{webapp_url}?card_linked=1" if webapp_url else "/?card_linked=1")
+        return RedirectResponse(
+            url=f"{webapp_url}?payment_success=1&order_id={pending.get('order_guid')}" if webapp_url else "/"
+        )
     payment_log("return_pending_found", payment_token=payment_token, total=pending.get("total"))
     yookassa_id = (pending.get("yookassa_payment_id") or "").strip()
     if not yookassa_id:
         payment_log("return_fail", payment_token=payment_token, reason="no_yookassa_id")
         return RedirectResponse(url=fail_url)
-    payment = await _yookassa_get_payment(yookassa_id)
+    yookassa = get_yookassa_client()
+    payment = await yookassa.get_payment(yookassa_id) if yookassa else None
     if not payment or payment.get("status") != "succeeded":
         payment_log("return_fail", payment_token=payment_token, yookassa_id=yookassa_id, yookassa_status=payment.get("status") if payment else None)
         return RedirectResponse(url=fail_url)
     payment_log("return_yookassa_succeeded", payment_token=payment_token, yookassa_id=yookassa_id)
-    link_card_only = pending.get("link_card_only")
-    items = json.loads(pending["items_json"])
-    total = float(pending["total"])
-    client = json.loads(pending["client_json"] or "{}")
-    comment = (pending["comment"] or "").strip()
-    telegram_id = int(pending.get("telegram_id") or 0)
     site_user_id = pending.get("site_user_id")
     if site_user_id:
         pm = (payment.get("payment_method") or {})
@@ -578,45 +974,21 @@ async def api_payment_return(payment_token: str):
                 payment_log("return_card_saved", payment_token=payment_token, site_user_id=int(site_user_id))
             except Exception as e:
                 payment_log("return_card_save_error", payment_token=payment_token, error=str(e))
-    if link_card_only:
-        await delete_pending_payment(payment_token)
+    try:
+        result = await create_order_from_payment(ytimes_client, payment_token, log_prefix="return_order")
+    except OrderFromPaymentError as e:
+        payment_log("return_fail", payment_token=payment_token, reason=e.reason)
+        if e.reason == "no_ytimes":
+            return RedirectResponse(url=f"{webapp_url}?payment_error=no_ytimes" if webapp_url else fail_url)
+        return RedirectResponse(url=f"{webapp_url}?payment_error=order" if webapp_url else fail_url)
+    except Exception:
+        return RedirectResponse(url=f"{webapp_url}?payment_error=order" if webapp_url else fail_url)
+    if pending.get("link_card_only"):
         payment_log("return_link_card_ok", payment_token=payment_token)
         success_url = f"{webapp_url}?card_linked=1" if webapp_url else "/?card_linked=1"
         return RedirectResponse(url=success_url)
-    if not ytimes_client:
-        payment_log("return_fail", payment_token=payment_token, reason="no_ytimes")
-        return RedirectResponse(url=f"{webapp_url}?payment_error=no_ytimes" if webapp_url else fail_url)
-    order_guid = str(uuid.uuid4())
-    shop_guid = ytimes_client.default_shop_guid
-    ytimes_items = _build_ytimes_items(items)
-    loop = asyncio.get_event_loop()
-    try:
-        created = await loop.run_in_executor(
-            None,
-            lambda: ytimes_client.create_order(
-                order_guid=order_guid,
-                shop_guid=shop_guid,
-                order_type="TOGO",
-                items=ytimes_items,
-                client=client,
-                comment=comment or None,
-                paid_value=total,
-            ),
-        )
-    except Exception as e:
-        payment_log("return_order_error", payment_token=payment_token, error=str(e))
-        return RedirectResponse(url=f"{webapp_url}?payment_error=order" if webapp_url else fail_url)
-    order_id_return = created.get("guid") or order_guid
-    status = created.get("status") or "CREATED"
-    await db_create_order(
-        user_telegram_id=telegram_id,
-        ytimes_order_guid=order_id_return,
-        total_price=total,
-        status=status,
-        items_json=json.dumps(items),
-    )
-    await delete_pending_payment(payment_token)
-    payment_log("return_success", payment_token=payment_token, order_id=order_id_return, total=total)
+    order_id_return = result["order_id"]
+    payment_log("return_success", payment_token=payment_token, order_id=order_id_return, total=result["total"])
     success_url = f"{webapp_url}?payment_success=1&order_id={order_id_return}" if webapp_url else "/"
     return RedirectResponse(url=success_url)
 
@@ -627,7 +999,8 @@ async def api_payment_link_card(request: Request, authorization: str | None = He
     auth_user = await _get_auth_user(authorization)
     if not auth_user:
         return JSONResponse({"success": False, "error": "Войдите в аккаунт"}, status_code=401)
-    if not _yookassa_auth():
+    yookassa = get_yookassa_client()
+    if yookassa is None:
         return JSONResponse({"success": False, "error": "Оплата не настроена"}, status_code=503)
     webapp_url = (os.getenv("WEBAPP_URL") or "").rstrip("/")
     if not webapp_url:
@@ -637,7 +1010,7 @@ async def api_payment_link_card(request: Request, authorization: str | None = He
     await create_pending_payment(
         payment_token=payment_token,
         telegram_id=0,
-        items_json="[]",
+        items=[],
         total=1.0,
         client_json=json.dumps(client),
         comment="Привязка карты",
@@ -645,11 +1018,11 @@ async def api_payment_link_card(request: Request, authorization: str | None = He
         link_card_only=True,
     )
     return_url = f"{webapp_url}/api/payment/return?payment_token={payment_token}"
-    yookassa_resp = await _yookassa_create_payment(
+    yookassa_resp = await yookassa.create_payment(
+        payment_token=payment_token,
         amount_rub=1.0,
         description="Привязка карты к аккаунту (1 ₽)",
         return_url=return_url,
-        metadata={"payment_token": payment_token},
         save_payment_method=True,
     )
     if not yookassa_resp or yookassa_resp.get("status") not in ("pending", "waiting_for_capture"):
@@ -665,6 +1038,133 @@ async def api_payment_link_card(request: Request, authorization: str | None = He
     return JSONResponse({"success": True, "confirmation_url": confirmation_url})
 
 
+@app.post("/api/payment/charge-saved")
+async def api_payment_charge_saved(
+    request: Request,
+    authorization: str | None = Header(None),
+    idempotency_key: str | None = Header(None, alias=IDEMPOTENCY_HEADER),
+):
+    """Оплатить корзину привязанной картой без перехода на страницу ЮKassa и сразу создать заказ."""
+    # payment_token из ключа: повтор после сбоя спишет тем же Idempotence-Key, а не второй раз
+    payment_token = (
+        uuid.UUID(await guid_for_request("payment_charge_saved", idempotency_key, request)).hex
+        if idempotency_key else None
+    )
+    return await run_idempotent(
+        "payment_charge_saved",
+        idempotency_key,
+        request,
+        lambda: _payment_charge_saved(request, authorization, payment_token),
+    )
+
+
+def _charge_pending_response(payment_token: str, error: str) -> JSONResponse:
+    """Деньги могли быть списаны, а заказа ещё нет: довести оплату через страницу возврата."""
+    webapp_url = (os.getenv("WEBAPP_URL") or "").rstrip("/")
+    return JSONResponse(
+        {
+            "success": False,
+            "pending": True,
+            "payment_token": payment_token,
+            "return_url": f"{webapp_url}/api/payment/return?payment_token={payment_token}",
+            "error": error,
+        },
+        status_code=202,
+    )
+
+
+async def _payment_charge_saved(request: Request, authorization: str | None, payment_token: str | None) -> JSONResponse:
+    auth_user = await _get_auth_user(authorization)
+    if not auth_user:
+        return JSONResponse({"success": False, "error": "Войдите в аккаунт"}, status_code=401)
+    payment_method_id = (auth_user.get("saved_payment_method_id") or "").strip()
+    if not payment_method_id:
+        return JSONResponse({"success": False, "error": "Нет привязанной карты"}, status_code=400)
+    yookassa = get_yookassa_client()
+    if yookassa is None:
+        return JSONResponse({"success": False, "error": "Оплата не настроена"}, status_code=503)
+    if not ytimes_client:
+        # Без кассы заказ не создать — не списываем деньги
+        return JSONResponse({"success": False, "error": "YTimes не настроен"}, status_code=503)
+    retry_after = getattr(ytimes_client, "circuit_retry_after", lambda _: None)(ORDER_SAVE_PATH)
+    if retry_after is not None:
+        return _ytimes_unavailable(retry_after)
+    try:
+        data = await request.json()
+        items = data.get("items", [])
+        total = sum(item.get("priceWithDiscount", 0) * item.get("quantity", 1) for item in items)
+        price_error = _cart_price_error(items)
+        client = data.get("client") or {}
+        client = {
+            "name": (client.get("name") or "").strip() or (auth_user.get("name") or auth_user.get("phone") or "Пользователь"),
+            "phone": (client.get("phone") or "").strip() or (auth_user.get("phone") or ""),
+            "email": (client.get("email") or "").strip(),
+        }
+        telegram_id = int(data.get("telegramUserId") or 0)
+        comment = (data.get("comment") or "").strip()
+    except (ValueError, TypeError, AttributeError):
+        # Не JSON, не объект или поля не того типа — до списания денег
+        return JSONResponse({"success": False, "error": "Некорректный запрос"}, status_code=400)
+    if not items:
+        return JSONResponse({"success": False, "error": "Пустая корзина"}, status_code=400)
+    if price_error is not None:
+        return price_error
+    if total <= 0:
+        return JSONResponse({"success": False, "error": "Некорректная сумма"}, status_code=400)
+    payment_token = payment_token or uuid.uuid4().hex
+    if not await get_pending_payment(payment_token):
+        await create_pending_payment(
+            payment_token=payment_token,
+            telegram_id=telegram_id,
+            items=items,
+            total=total,
+            client_json=json.dumps(client),
+            comment=comment,
+            site_user_id=auth_user["id"],
+        )
+    payment_log("charge_saved_start", payment_token=payment_token, total=total, site_user_id=auth_user["id"])
+    payment = await yookassa.charge_saved_method(
+        payment_token=payment_token,
+        payment_method_id=payment_method_id,
+        amount_rub=total,
+        description=f"Заказ на {total:.2f} ₽",
+    )
+    if not payment or not payment.get("id"):
+        payment_log("charge_saved_fail", payment_token=payment_token, reason="yookassa_error")
+        return JSONResponse({"success": False, "error": "Не удалось списать оплату. Попробуйте позже."}, status_code=502)
+    await set_pending_yookassa_id(payment_token, payment["id"])
+    payment = await yookassa.wait_for_payment(payment)
+    status = payment.get("status")
+    if status == "canceled":
+        reason = (payment.get("cancellation_details") or {}).get("reason")
+        payment_log("charge_saved_canceled", payment_token=payment_token, yookassa_id=payment["id"], reason=reason)
+        if reason == "permission_revoked":
+            await clear_site_user_saved_payment_method(auth_user["id"])
+            return JSONResponse(
+                {"success": False, "error": "Привязка карты отменена. Оплатите заказ картой заново.", "card_unlinked": True},
+                status_code=402,
+            )
+        return JSONResponse({"success": False, "error": "Оплата отклонена банком"}, status_code=402)
+    if status != "succeeded":
+        payment_log("charge_saved_pending", payment_token=payment_token, yookassa_id=payment["id"], yookassa_status=status)
+        return _charge_pending_response(payment_token, "Оплата ещё обрабатывается")
+    try:
+        result = await create_order_from_payment(ytimes_client, payment_token, log_prefix="charge_saved_order")
+    except Exception as e:
+        # Деньги списаны, платёж остаётся в pending_payments — заказ создаст страница возврата.
+        # Не 5xx: иначе ключ идемпотентности освободится и повтор спишет деньги снова
+        payment_log("charge_saved_fail", payment_token=payment_token, reason=getattr(e, "reason", "") or str(e))
+        return _charge_pending_response(payment_token, "Оплата прошла, заказ создаётся")
+    payment_log("charge_saved_ok", payment_token=payment_token, order_id=result["order_id"], total=result["total"])
+    return JSONResponse({
+        "success": True,
+        "order_id": result["order_id"],
+        "status": result["status"],
+        "total": result["total"],
+        "payment_token": payment_token,
+    })
+
+
 @app.get("/api/payment/pending/{payment_token}")
 async def api_payment_pending(
     payment_token: str,
@@ -676,11 +1176,11 @@ async def api_payment_pending(
     except ValueError as e:
         return JSONResponse({"success": False, "error": str(e)}, status_code=403)
     pending = await get_pending_payment(payment_token)
-    if not pending:
+    if not pending or pending.get("state") == "fulfilled":
         return JSONResponse({"success": False, "error": "Платёж не найден или уже использован"}, status_code=404)
     return JSONResponse({
         "success": True,
-        "items": json.loads(pending["items_json"]),
+        "items": pending["items"],
         "total": pending["total"],
         "client": json.loads(pending["client_json"] or "{}"),
         "comment": pending["comment"] or "",
@@ -705,52 +1205,17 @@ async def api_order_from_payment(
         if not payment_token:
             payment_log("order_from_payment_reject", reason="no_token")
             return JSONResponse({"success": False, "error": "Требуется payment_token"}, status_code=400)
-        payment_log("order_from_payment_start", payment_token=payment_token)
-        pending = await get_pending_payment(payment_token)
-        if not pending:
-            payment_log("order_from_payment_fail", payment_token=payment_token, reason="pending_not_found")
-            return JSONResponse({"success": False, "error": "Платёж не найден или уже использован"}, status_code=404)
-        items = json.loads(pending["items_json"])
-        total = float(pending["total"])
-        client = json.loads(pending["client_json"] or "{}")
-        comment = (pending["comment"] or "").strip()
-        telegram_id = int(data.get("telegram_id") or pending["telegram_id"] or 0)
-        if not ytimes_client:
-            payment_log("order_from_payment_fail", payment_token=payment_token, reason="no_ytimes")
-            return JSONResponse({"success": False, "error": "YTimes не настроен"}, status_code=500)
-        order_guid = str(uuid.uuid4())
-        shop_guid = ytimes_client.default_shop_guid
-        ytimes_items = _build_ytimes_items(items)
-        loop = asyncio.get_event_loop()
-        created = await loop.run_in_executor(
-            None,
-            lambda: ytimes_client.create_order(
-                order_guid=order_guid,
-                shop_guid=shop_guid,
-                order_type="TOGO",
-                items=ytimes_items,
-                client=client,
-                comment=comment or None,
-                paid_value=total,
-            ),
-        )
-        order_id_return = created.get("guid") or order_guid
-        status = created.get("status") or "CREATED"
-        await db_create_order(
-            user_telegram_id=telegram_id,
-            ytimes_order_guid=order_id_return,
-            total_price=total,
-            status=status,
-            items_json=json.dumps(items),
+        result = await create_order_from_payment(
+            ytimes_client,
+            payment_token,
+            telegram_id=int(data.get("telegram_id") or 0) or None,
         )
-        await delete_pending_payment(payment_token)
-        payment_log("order_from_payment_ok", payment_token=payment_token, order_id=order_id_return, total=total)
-        return JSONResponse({
-            "success": True,
-            "order_id": order_id_return,
-            "status": status,
-            "total": total,
-        })
+        return JSONResponse(result)
+    except OrderFromPaymentError as e:
+        return JSONResponse({"success": False, "error": str(e)}, status_code=e.status_code)
+    except CircuitOpenError as e:
+        payment_log("order_from_payment_ytimes_unavailable", retry_after=round(e.retry_after))
+        return _ytimes_unavailable(e.retry_after)
     except YTimesAPIError as e:
         payment_log("order_from_payment_ytimes_error", error=str(e))
         return JSONResponse({"success": False, "error": str(e)}, status_code=502)
@@ -775,6 +1240,7 @@ async def webhook_order_status(request: Request):
         await update_order_status(guid, status)
 
         if order:
+            order_statuses.put(guid, status, float(order["total_price"]))
             telegram_id = order.get("user_telegram_id") or 0
             if telegram_id and status == "ACCEPTED":
                 await _send_telegram_message(telegram_id, "✅ Ваш заказ принят. Ожидайте приготовления.")
@@ -786,12 +1252,38 @@ async def webhook_order_status(request: Request):
     return PlainTextResponse("OK", status_code=200)
 
 
-# SPA (React): раздаём frontend/dist после API, чтобы /api имел приоритет
+# SPA (React): раздаём frontend/dist после API, чтобы /api имел приоритет.
+# Файлы загружаются в память и сжимаются один раз при старте (см. static_assets).
 if FRONTEND_DIST.exists():
-    app.mount("/", StaticFiles(directory=str(FRONTEND_DIST), html=True), name="spa")
+    _spa_files = PrecompressedStaticFiles(FRONTEND_DIST)
+    print(f"Фронтенд загружен в память: {_spa_files.raw_bytes // 1024} КБ, со сжатыми копиями {_spa_files.stored_bytes // 1024} КБ.")
+    app.mount("/", _spa_files, name="spa")
 else:
+    # Старый шаблон рендерится один раз на версию снимка меню, меню и добавки встроены в HTML
+    _INDEX_PRERENDER = os.getenv("INDEX_PRERENDER", "1").strip() != "0"
+    _INDEX_FIELDS = parse_fields("guid,name,typeList,supplementCategoryToFreeCount")
+    _index_cache: tuple[str, bytes, str] | None = None  # (версия снимка, HTML, ETag)
+
+    def _prerendered_index() -> tuple[bytes, str]:
+        """HTML главной для текущего снимка и его ETag (рендер только при смене версии)."""
+        global _index_cache
+        payloads = _menu_payloads
+        version = payloads.version if payloads else ""
+        if _index_cache is None or _index_cache[0] != version:
+            initial_data = payloads.embedded(_INDEX_FIELDS) if payloads else None
+            html = templates.get_template("index.html").render(initial_data=initial_data).encode("utf-8")
+            etag = '"' + hashlib.sha1(html).hexdigest()[:16] + '"'
+            _index_cache = (version, html, etag)
+        return _index_cache[1], _index_cache[2]
+
     @app.get("/", response_class=HTMLResponse)
     async def index(request: Request):
         """Главная страница (fallback: старый шаблон, если React не собран)."""
-        return templates.TemplateResponse("index.html", {"request": request})
+        if not _INDEX_PRERENDER:
+            return templates.TemplateResponse("index.html", {"request": request})
+        html, etag = _prerendered_index()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        return HTMLResponse(html, headers=headers)
 
@@ -0,0 +1,134 @@
+"""Заголовок Idempotency-Key для эндпоинтов, создающих заказ или платёж.
+
+Клиент присылает один ключ на одно действие пользователя (оформление корзины) и повторяет
+его при двойном нажатии или ретрае webview. Первый запрос с ключом выполняется, ответ
+сохраняется в таблице idempotency_keys; повтор с тем же ключом и тем же телом получает
+сохранённый ответ (заголовок Idempotent-Replayed: true), не обращаясь к YTimes и ЮKassa.
+Повтор, пришедший во время выполнения первого, ждёт его результата — в этом процессе через
+Future, из другого воркера через опрос записи в БД.
+
+Ответы 5xx не сохраняются: ключ освобождается, и повтор выполнится заново.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import uuid
+from typing import Awaitable, Callable
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+from database import release_idempotency_key, reserve_idempotency_key, save_idempotent_response
+
+from .payment_log import log as payment_log
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+# Сколько хранить ответ: повтор позже этого срока выполнится как новый запрос
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+# Аренда ключа на время выполнения: если воркер упал, ключ освободится сам
+_LEASE_SECONDS = 120.0
+# Сколько повтор ждёт первый запрос, прежде чем ответить 409
+_WAIT_SECONDS = 30.0
+_POLL_INTERVAL = 0.2
+_MAX_KEY_LENGTH = 128
+
+# Пространство имён для guid, выводимых из ключа (guid заказа YTimes)
+_KEY_GUID_NAMESPACE = uuid.UUID("b3f1e6a2-47c9-4d0e-8a35-91c2d7e04f6b")
+
+# Запросы с ключом, выполняемые в этом процессе: (scope, key) -> Future
+_inflight: dict[tuple[str, str], asyncio.Future] = {}
+
+
+async def guid_for_request(scope: str, key: str, request: Request) -> str:
+    """Детерминированный guid по ключу и отпечатку запроса: повтор после сбоя отправит в YTimes тот же guid.
+
+    Отпечаток (Authorization + тело) в имени guid: одинаковый ключ у разных пользователей
+    (например, счётчик в клиентской библиотеке) не даёт им общий заказ или payment_token.
+    """
+    fingerprint = _fingerprint(request.headers.get("authorization"), await request.body())
+    return str(uuid.uuid5(_KEY_GUID_NAMESPACE, f"{scope}:{key.strip()}:{fingerprint}"))
+
+
+def _fingerprint(authorization: str | None, body: bytes) -> str:
+    digest = hashlib.sha256()
+    digest.update((authorization or "").encode())
+    digest.update(b"\n")
+    digest.update(body)
+    return digest.hexdigest()[:32]
+
+
+def _error(message: str, status_code: int) -> JSONResponse:
+    return JSONResponse({"success": False, "error": message}, status_code=status_code)
+
+
+def _replay(row: dict) -> Response:
+    return Response(
+        content=row["response_body"] or b"",
+        status_code=row["status_code"],
+        media_type="application/json",
+        headers={REPLAYED_HEADER: "true"},
+    )
+
+
+async def run_idempotent(
+    scope: str,
+    key: str | None,
+    request: Request,
+    handler: Callable[[], Awaitable[Response]],
+) -> Response:
+    """Выполнить handler не больше одного раза на (scope, key). Без ключа — просто выполнить."""
+    if key is None:
+        return await handler()
+    key = key.strip()
+    if not key or len(key) > _MAX_KEY_LENGTH:
+        return _error(f"Некорректный {IDEMPOTENCY_HEADER}", 400)
+    fingerprint = _fingerprint(request.headers.get("authorization"), await request.body())
+    slot = (scope, key)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + _WAIT_SECONDS
+    while True:
+        pending = _inflight.get(slot)
+        if pending is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(pending), max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                payment_log("idempotency_busy", scope=scope, key=key)
+                return _error("Запрос с этим ключом ещё выполняется", 409)
+            continue
+        row = await reserve_idempotency_key(scope, key, fingerprint, _LEASE_SECONDS)
+        if row is None:
+            break
+        if row["request_hash"] != fingerprint:
+            payment_log("idempotency_mismatch", scope=scope, key=key)
+            return _error(f"{IDEMPOTENCY_HEADER} уже использован для другого запроса", 422)
+        if row["status_code"] is not None:
+            payment_log("idempotency_replay", scope=scope, key=key, status_code=row["status_code"])
+            return _replay(row)
+        # Первый запрос выполняется в другом воркере
+        if loop.time() >= deadline:
+            payment_log("idempotency_busy", scope=scope, key=key)
+            return _error("Запрос с этим ключом ещё выполняется", 409)
+        await asyncio.sleep(_POLL_INTERVAL)
+
+    done = loop.create_future()
+    _inflight[slot] = done
+    saved = False
+    try:
+        response = await handler()
+        if response.status_code < 500:
+            await save_idempotent_response(scope, key, response.status_code, bytes(response.body), IDEMPOTENCY_TTL_SECONDS)
+            saved = True
+        return response
+    finally:
+        if not saved:
+            try:
+                await release_idempotency_key(scope, key)
+            except Exception as e:
+                # Ключ освободится сам по истечении аренды
+                print(f"Idempotency-Key {scope}:{key}: не удалось освободить: {e}")
+        _inflight.pop(slot, None)
+        done.set_result(None)
@@ -0,0 +1,151 @@
+"""Монитор задержки event loop и поиск блокирующего кода (включается LOOP_MONITOR=1).
+
+Задача в loop каждые LOOP_MONITOR_INTERVAL_MS засыпает и замеряет, насколько позже
+положенного проснулась: это задержка (lag), которую в тот момент получил бы любой запрос.
+Отдельный поток-сторож следит за отметкой этой задачи: если loop не отвечает дольше
+LOOP_LAG_THRESHOLD_MS, сторож снимает стек потока loop — тот код, который сейчас его
+блокирует (bcrypt, синхронная запись в файл, большой json.dumps и т. п.). Когда loop
+оживает, в лог пишется длительность остановки и стек, а место (файл:строка функция)
+попадает в счётчики /health.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Optional
+
+ENABLED = os.getenv("LOOP_MONITOR", "0").strip() == "1"
+INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "50")) / 1000
+THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "100")) / 1000
+# Границы гистограммы задержек, мс (последняя корзина — всё, что больше)
+_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+_STACK_DEPTH = 12
+_MAX_REPORTS = 50
+
+_SRC_MARKER = os.sep + "src" + os.sep
+
+
+def _blocking_site(stack: list[traceback.FrameSummary]) -> str:
+    """Самый глубокий кадр кода приложения (src/), иначе самый глубокий вообще."""
+    for frame in reversed(stack):
+        if _SRC_MARKER in frame.filename and "loop_monitor" not in frame.filename:
+            return f"{frame.filename.split(_SRC_MARKER, 1)[1]}:{frame.lineno} {frame.name}"
+    last = stack[-1] if stack else None
+    return f"{os.path.basename(last.filename)}:{last.lineno} {last.name}" if last else "?"
+
+
+class LoopMonitor:
+    """Замер задержки loop и снимки стека при остановках дольше threshold."""
+
+    def __init__(self, *, interval: float = INTERVAL, threshold: float = THRESHOLD) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+        # Стек, снятый сторожем во время текущей остановки: (отметка, стек)
+        self._captured: Optional[tuple[float, list[traceback.FrameSummary]]] = None
+        self._lags: deque[float] = deque(maxlen=2000)
+        self._histogram = [0] * (len(_BUCKETS_MS) + 1)
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.sites: Counter[str] = Counter()
+        self.reports: deque[dict] = deque(maxlen=_MAX_REPORTS)
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._tick())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        self._watchdog.start()
+        print(f"Монитор event loop: интервал {self.interval * 1000:.0f} мс, порог {self.threshold * 1000:.0f} мс.")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _tick(self) -> None:
+        while True:
+            heartbeat = self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._record(max(0.0, time.monotonic() - heartbeat - self.interval), heartbeat)
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or (self._captured and self._captured[0] == heartbeat):
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._captured = (heartbeat, traceback.extract_stack(frame)[-_STACK_DEPTH:])
+
+    def _record(self, lag: float, heartbeat: float) -> None:
+        self._lags.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+        lag_ms = lag * 1000
+        index = next((i for i, bound in enumerate(_BUCKETS_MS) if lag_ms <= bound), len(_BUCKETS_MS))
+        self._histogram[index] += 1
+        if lag < self.threshold:
+            return
+        self.stalls += 1
+        captured, self._captured = self._captured, None
+        stack = captured[1] if captured and captured[0] == heartbeat else []
+        site = _blocking_site(stack) if stack else "не успели снять стек"
+        self.sites[site] += 1
+        self.reports.append({
+            "at": round(time.time(), 3),
+            "lag_ms": round(lag_ms, 1),
+            "site": site,
+            "stack": traceback.format_list(stack),
+        })
+        print(f"Event loop заблокирован на {lag_ms:.0f} мс: {site}\n" + "".join(traceback.format_list(stack)).rstrip())
+
+    def stats(self) -> dict:
+        ordered = sorted(self._lags)
+
+        def pct(p: float) -> float | None:
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 1)
+
+        labels = [f"<={b}ms" for b in _BUCKETS_MS] + [f">{_BUCKETS_MS[-1]}ms"]
+        return {
+            "samples": len(ordered),
+            "p50_ms": pct(0.5),
+            "p99_ms": pct(0.99),
+            "max_ms": round(self.max_lag * 1000, 1),
+            "stalls": self.stalls,
+            "threshold_ms": round(self.threshold * 1000),
+            "histogram": dict(zip(labels, self._histogram)),
+            "top_sites": dict(self.sites.most_common(5)),
+        }
+
+
+loop_monitor: Optional[LoopMonitor] = None
+
+
+def start_loop_monitor() -> Optional[LoopMonitor]:
+    """Запустить монитор в текущем loop, если LOOP_MONITOR=1."""
+    global loop_monitor
+    if ENABLED and loop_monitor is None:
+        loop_monitor = LoopMonitor()
+        loop_monitor.start()
+    return loop_monitor
+
+
+def stop_loop_monitor() -> None:
+    global loop_monitor
+    if loop_monitor is not None:
+        loop_monitor.stop()
+        loop_monitor = None
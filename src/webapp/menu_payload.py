@@ -0,0 +1,112 @@
+"""Готовые тела ответов /api/menu, /api/supplements и /api/bootstrap для снимка меню.
+
+Проекция строится один раз при обновлении снимка: в ответ попадают только поля,
+которые читает клиент, пустые значения опускаются, целые цены пишутся без «.0».
+Параметр fields= позволяет запросить подмножество полей позиции (например, для
+старого templates/index.html или скриптов из scripts/).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import Any
+
+from ytimes import MenuItem, MenuSnapshot
+
+# Поля позиции в клиентской схеме (frontend/src/types.ts: MenuItem)
+MENU_ITEM_FIELDS = MenuItem.FIELDS
+DEFAULT_MENU_FIELDS = MENU_ITEM_FIELDS
+
+
+class MenuFieldsError(ValueError):
+    """Неизвестное поле в параметре fields=."""
+
+
+def parse_fields(raw: str | None) -> tuple[str, ...]:
+    """'name,guid' -> ('guid', 'name') в порядке MENU_ITEM_FIELDS. Пусто — все поля."""
+    if not raw or not raw.strip():
+        return DEFAULT_MENU_FIELDS
+    requested = {f.strip() for f in raw.split(",") if f.strip()}
+    unknown = requested.difference(MENU_ITEM_FIELDS)
+    if unknown:
+        raise MenuFieldsError(
+            f"Неизвестные поля: {', '.join(sorted(unknown))}. Доступны: {', '.join(MENU_ITEM_FIELDS)}"
+        )
+    return tuple(f for f in MENU_ITEM_FIELDS if f in requested)
+
+
+def project_menu(snapshot: MenuSnapshot, fields: tuple[str, ...] = DEFAULT_MENU_FIELDS) -> dict:
+    """Группа меню в клиентской схеме с выбранными полями позиций (проекция — MenuItem.to_dict)."""
+    return snapshot.menu_dict(fields)
+
+
+def project_supplements(snapshot: MenuSnapshot) -> list:
+    """Категории добавок в клиентской схеме (guid, name, itemList[guid, name, defaultPrice])."""
+    return snapshot.supplements_list()
+
+
+def dumps(obj: Any) -> bytes:
+    """Компактный JSON в UTF-8 (как JSONResponse)."""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _envelope(data: bytes) -> bytes:
+    return b'{"success":true,"data":' + data + b"}"
+
+
+def _version(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()[:12]
+
+
+class MenuPayloads:
+    """Сериализованные ответы для одного снимка. Набор полей по умолчанию готовится сразу.
+
+    menu_version / supplements_version — хеши содержимого частей: по ним /api/bootstrap
+    не отдаёт клиенту то, что у него уже есть.
+    """
+
+    def __init__(self, snapshot: MenuSnapshot) -> None:
+        self.snapshot = snapshot
+        self.version = snapshot.version
+        self._menu_data: dict[tuple[str, ...], bytes] = {}
+        self.menu_data_default = self.menu_data(DEFAULT_MENU_FIELDS)
+        self.menu_version = _version(self.menu_data_default)
+        self.supplements_data = dumps(project_supplements(snapshot))
+        self.supplements_version = _version(self.supplements_data)
+        self.supplements = _envelope(self.supplements_data)
+        self._menu_default = _envelope(self.menu_data_default)
+
+    def menu_data(self, fields: tuple[str, ...] = DEFAULT_MENU_FIELDS) -> bytes:
+        """JSON группы меню; другие наборы полей строятся при первом запросе и кешируются."""
+        data = self._menu_data.get(fields)
+        if data is None:
+            data = dumps(project_menu(self.snapshot, fields))
+            self._menu_data[fields] = data
+        return data
+
+    def menu(self, fields: tuple[str, ...] = DEFAULT_MENU_FIELDS) -> bytes:
+        """Тело ответа /api/menu."""
+        if fields == DEFAULT_MENU_FIELDS:
+            return self._menu_default
+        return _envelope(self.menu_data(fields))
+
+    def embedded(self, fields: tuple[str, ...] = DEFAULT_MENU_FIELDS) -> str:
+        """Меню и добавки для вставки в HTML (<script type="application/json">)."""
+        data = b'{"menu":' + self.menu_data(fields) + b',"supplements":' + self.supplements_data + b"}"
+        # "</script>" внутри названия не должен закрыть тег
+        return data.decode("utf-8").replace("</", "<\\/")
+
+    def bootstrap(self, user: dict | None, *, menu_version: str = "", supplements_version: str = "") -> bytes:
+        """Тело ответа /api/bootstrap: готовые части снимка + пользователь.
+
+        Если версия части совпадает с переданной клиентом, часть не включается.
+        """
+        versions = dumps({"menu": self.menu_version, "supplements": self.supplements_version})
+        parts = [b'{"success":true,"versions":', versions]
+        if menu_version != self.menu_version:
+            parts += [b',"menu":', self.menu_data_default]
+        if supplements_version != self.supplements_version:
+            parts += [b',"supplements":', self.supplements_data]
+        parts += [b',"user":', dumps(user), b"}"]
+        return b"".join(parts)
@@ -0,0 +1,101 @@
+"""Расписание обновления меню из YTimes в пределах квоты API.
+
+У YTimes лимит 10 запросов в час, одно обновление меню — 2 запроса (меню и добавки).
+RefreshQuota не даёт обновлять чаще MENU_REFRESHES_PER_HOUR раз за скользящий час — ни
+фоновой задаче, ни ручному запуску из админки. Окно хранится в общей БД (menu_refreshes),
+поэтому квота одна на все воркеры и реплики: каждая реплика держит меню в памяти и
+обновляет его сама, так что при N репликах каждая обновляется примерно в N раз реже. Интервал фоновой задачи зависит от времени:
+в часы работы кофейни (SHOP_HOURS, часовой пояс SHOP_TIMEZONE) меню обновляется чаще,
+ночью — раз в час, а перед открытием — так, чтобы к открытию меню было свежим.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+from database import count_menu_refreshes, release_menu_refresh, reserve_menu_refresh
+
+# 4 обновления = 8 запросов в час: 2 остаются на заказы и ручные проверки
+MENU_REFRESHES_PER_HOUR = max(1, int(os.getenv("MENU_REFRESHES_PER_HOUR", "4")))
+OPEN_INTERVAL = max(15 * 60, 3600 // MENU_REFRESHES_PER_HOUR)
+CLOSED_INTERVAL = 60 * 60
+# После неудачи пробуем раньше обычного (квота всё равно ограничивает)
+RETRY_INTERVAL = 5 * 60
+# Обновить меню за столько секунд до открытия
+_BEFORE_OPEN = 5 * 60
+
+
+def _parse_hours(raw: str) -> tuple[int, int]:
+    """'08:00-22:00' -> (480, 1320) — минуты от полуночи."""
+    start, _, end = raw.partition("-")
+
+    def minutes(value: str) -> int:
+        h, _, m = value.strip().partition(":")
+        return int(h) * 60 + int(m or 0)
+
+    return minutes(start), minutes(end)
+
+
+def _shop_timezone():
+    try:
+        return ZoneInfo(os.getenv("SHOP_TIMEZONE", "Europe/Moscow"))
+    except Exception:
+        return timezone(timedelta(hours=3))
+
+
+SHOP_OPEN_MINUTE, SHOP_CLOSE_MINUTE = _parse_hours(os.getenv("SHOP_HOURS", "08:00-22:00"))
+SHOP_TZ = _shop_timezone()
+
+
+def _minute_of_day(now: float) -> float:
+    local = datetime.fromtimestamp(now, SHOP_TZ)
+    return local.hour * 60 + local.minute + local.second / 60
+
+
+def is_open(now: float | None = None) -> bool:
+    minute = _minute_of_day(time.time() if now is None else now)
+    if SHOP_OPEN_MINUTE <= SHOP_CLOSE_MINUTE:
+        return SHOP_OPEN_MINUTE <= minute < SHOP_CLOSE_MINUTE
+    # Работа через полночь (например 10:00-02:00)
+    return minute >= SHOP_OPEN_MINUTE or minute < SHOP_CLOSE_MINUTE
+
+
+def next_interval(now: float | None = None, *, failed: bool = False) -> float:
+    """Через сколько секунд запускать следующее обновление."""
+    now = time.time() if now is None else now
+    if is_open(now):
+        return RETRY_INTERVAL if failed else OPEN_INTERVAL
+    to_open = ((SHOP_OPEN_MINUTE - _minute_of_day(now)) % (24 * 60)) * 60
+    interval = CLOSED_INTERVAL if not failed else RETRY_INTERVAL * 2
+    if to_open > _BEFORE_OPEN:
+        interval = min(interval, to_open - _BEFORE_OPEN)
+    else:
+        # Обновление перед открытием уже было: следующее — как в часы работы, от открытия
+        interval = min(interval, to_open + OPEN_INTERVAL)
+    return max(interval, 60.0)
+
+
+class RefreshQuota:
+    """Скользящее окно в общей БД: не больше limit обновлений за window секунд во всех процессах."""
+
+    def __init__(self, limit: int = MENU_REFRESHES_PER_HOUR, window: float = 3600.0) -> None:
+        self.limit = limit
+        self.window = window
+        self._reserved: int | None = None
+
+    async def acquire(self) -> float:
+        """0 — обновление учтено, можно обращаться к YTimes; иначе сколько секунд ждать квоты."""
+        self._reserved, wait = await reserve_menu_refresh(self.limit, self.window)
+        return wait
+
+    async def release(self) -> None:
+        """Вернуть последнее списание (обновление не дошло до YTimes)."""
+        if self._reserved is not None:
+            refresh_id, self._reserved = self._reserved, None
+            await release_menu_refresh(refresh_id)
+
+    async def used(self) -> int:
+        return await count_menu_refreshes(self.window)
@@ -0,0 +1,129 @@
+"""Поиск по меню: префиксный индекс, строится один раз при обновлении снимка.
+
+Индексируются названия позиций, их размеров (typeList) и добавок. Запрос и текст
+нормализуются одинаково: регистр, ё/э/й -> е/е/и, латиница транслитерируется
+(«latte» -> «латте»), двойные буквы схлопываются («латте» и «лате» совпадают).
+Каждое слово запроса должно быть префиксом какого-нибудь слова в названии.
+"""
+
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from typing import Iterable
+
+from ytimes import MenuSnapshot
+
+# Длинные префиксы почти не сужают выдачу, а индекс растёт
+_MAX_PREFIX = 16
+
+_CYR_REPLACE = str.maketrans({"ё": "е", "э": "е", "й": "и", "ъ": "", "ь": ""})
+
+# Транслитерация латиницы: сначала сочетания, потом отдельные буквы
+_LAT_MULTI = [
+    ("shch", "щ"), ("sch", "щ"), ("cci", "чи"), ("cce", "че"), ("ch", "ч"), ("sh", "ш"),
+    ("zh", "ж"), ("kh", "х"), ("ts", "ц"), ("yu", "ю"), ("ya", "я"), ("yo", "е"), ("ye", "е"),
+    ("ph", "ф"), ("ck", "к"),
+]
+_LAT_SINGLE = str.maketrans({
+    "a": "а", "b": "б", "c": "к", "d": "д", "e": "е", "f": "ф", "g": "г", "h": "х", "i": "и",
+    "j": "дж", "k": "к", "l": "л", "m": "м", "n": "н", "o": "о", "p": "п", "q": "к", "r": "р",
+    "s": "с", "t": "т", "u": "у", "v": "в", "w": "в", "x": "кс", "y": "и", "z": "з",
+})
+_LATIN_RE = re.compile(r"[a-z]")
+_WORD_RE = re.compile(r"\w+")
+_DOUBLE_RE = re.compile(r"(\D)\1+")
+
+
+def _transliterate(word: str) -> str:
+    for src, dst in _LAT_MULTI:
+        word = word.replace(src, dst)
+    return word.translate(_LAT_SINGLE)
+
+
+def tokenize(text: str) -> list[str]:
+    """Текст -> нормализованные слова для индекса и запроса."""
+    words = _WORD_RE.findall((text or "").casefold())
+    out = []
+    for word in words:
+        if _LATIN_RE.search(word):
+            word = _transliterate(word)
+        word = word.translate(_CYR_REPLACE)
+        word = _DOUBLE_RE.sub(r"\1", word)
+        if word:
+            out.append(word)
+    return out
+
+
+@dataclass(frozen=True, slots=True)
+class _Doc:
+    kind: str  # item | supplement
+    guid: str
+    name: str
+    order: int  # позиция в меню — для стабильного порядка выдачи
+    words: tuple[str, ...]  # слова названия и (для позиций) названий размеров
+    name_words: tuple[str, ...]
+    category_guid: str = ""
+
+
+class MenuSearchIndex:
+    """Префиксный индекс по снимку меню."""
+
+    def __init__(self, snapshot: MenuSnapshot) -> None:
+        self.version = snapshot.version
+        self._docs: list[_Doc] = []
+        prefixes: dict[str, set[int]] = {}
+        for item in snapshot.items:
+            name_words = tuple(tokenize(item.name))
+            type_words = tuple(w for t in item.types for w in tokenize(t.name) if w not in name_words)
+            self._add(_Doc("item", item.guid, item.name, len(self._docs), name_words + type_words, name_words), prefixes)
+        for category in snapshot.supplement_categories:
+            for s in category.items:
+                words = tuple(tokenize(s.name))
+                self._add(_Doc("supplement", s.guid, s.name, len(self._docs), words, words, category.guid), prefixes)
+        # frozenset: меньше памяти, пересечение не копирует исходное множество
+        self._prefixes: dict[str, frozenset[int]] = {p: frozenset(ids) for p, ids in prefixes.items()}
+
+    def _add(self, doc: _Doc, prefixes: dict[str, set[int]]) -> None:
+        doc_id = len(self._docs)
+        self._docs.append(doc)
+        for word in set(doc.words):
+            for n in range(1, min(len(word), _MAX_PREFIX) + 1):
+                prefixes.setdefault(word[:n], set()).add(doc_id)
+
+    def _candidates(self, words: Iterable[str]) -> frozenset[int]:
+        result: frozenset[int] | None = None
+        for word in words:
+            ids = self._prefixes.get(word[:_MAX_PREFIX], frozenset())
+            if len(word) > _MAX_PREFIX:
+                ids = frozenset(i for i in ids if any(w.startswith(word) for w in self._docs[i].words))
+            result = ids if result is None else result & ids
+            if not result:
+                return frozenset()
+        return result or frozenset()
+
+    def search(self, query: str, limit: int = 20) -> dict:
+        """Найденные позиции и добавки: точные совпадения слов и совпадения по названию — выше."""
+        words = tokenize(query)
+        if not words:
+            return {"items": [], "supplements": []}
+        ids = self._candidates(words)
+
+        def in_name(doc: _Doc) -> bool:
+            return all(any(w.startswith(q) for w in doc.name_words) for q in words)
+
+        def rank(doc_id: int) -> tuple:
+            doc = self._docs[doc_id]
+            exact = sum(1 for w in words if w in doc.words)
+            return (-exact, not in_name(doc), doc.order)
+
+        items: list[dict] = []
+        supplements: list[dict] = []
+        for doc_id in sorted(ids, key=rank):
+            doc = self._docs[doc_id]
+            if doc.kind == "item":
+                if len(items) < limit:
+                    items.append({"guid": doc.guid, "name": doc.name, "matched": "name" if in_name(doc) else "type"})
+            elif len(supplements) < limit:
+                supplements.append({"guid": doc.guid, "name": doc.name, "categoryGuid": doc.category_guid})
+        return {"items": items, "supplements": supplements}
@@ -0,0 +1,242 @@
+"""Создание заказа в YTimes по оплаченному ожидающему платежу.
+
+Общая логика для web (POST /api/order-from-payment, GET /api/payment/return) и бота:
+бот может вызвать её напрямую, если работает рядом с web и видит ту же БД
+(BOT_ORDER_MODE=inprocess).
+
+Платёж сначала захватывается в БД (pending -> claimed с арендой), заказ сохраняется
+вместе с переходом в fulfilled. Поэтому параллельные обработчики — в том числе в разных
+воркерах — создают ровно один заказ на платёж.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+
+from database import (
+    claim_pending_payment,
+    complete_pending_payment,
+    fail_pending_payment,
+    get_order_by_ytimes_guid,
+    get_pending_payment,
+)
+from ytimes import YTimesAPIClient
+
+from .admission import run_ytimes
+from .order_status import order_statuses
+from .payment_log import log as payment_log
+
+# Пространство имён для guid заказа: один payment_token -> всегда один и тот же guid.
+# guid заказа в YTimes — ключ идемпотентности, поэтому повтор не создаст второй заказ на кассе.
+ORDER_GUID_NAMESPACE = uuid.UUID("5f0c3b8e-6d2a-4c1e-9a57-2b9e0d4f7c11")
+
+# Аренда захвата: за это время обработчик должен создать заказ, иначе платёж может взять другой
+CLAIM_LEASE_SECONDS = float(os.getenv("PAYMENT_CLAIM_LEASE_SECONDS", "120"))
+# Сколько ждать, пока платёж обрабатывает другой воркер, прежде чем ответить «в обработке»
+_BUSY_WAIT_SECONDS = 15.0
+_BUSY_POLL_INTERVAL = 0.2
+
+# Последние успешные результаты по payment_token (повторная доставка апдейта Telegram)
+_COMPLETED_MAX = 1000
+_completed: OrderedDict[str, dict] = OrderedDict()
+# Запросы, которые сейчас в работе: повторный вызов ждёт первый, а не создаёт заказ заново
+_inflight: dict[str, asyncio.Future] = {}
+
+
+class OrderFromPaymentError(Exception):
+    """Заказ по платежу не создан. status_code — HTTP-код для ответа API, reason — для payment_log."""
+
+    def __init__(self, message: str, *, status_code: int = 500, reason: str = "") -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.reason = reason
+
+
+def build_ytimes_items(items: list) -> list:
+    """Собрать itemList для YTimes: menuTypeGuid только если есть."""
+    out = []
+    for item in items:
+        row = {
+            "menuItemGuid": item.get("menuItemGuid"),
+            "supplementList": item.get("supplementList") or {},
+            "priceWithDiscount": float(item.get("priceWithDiscount", 0)),
+            "quantity": int(item.get("quantity", 1)),
+        }
+        if item.get("menuTypeGuid"):
+            row["menuTypeGuid"] = item["menuTypeGuid"]
+        out.append(row)
+    return out
+
+
+def order_guid_for_payment(payment_token: str) -> str:
+    """Детерминированный guid заказа YTimes для платежа."""
+    return str(uuid.uuid5(ORDER_GUID_NAMESPACE, payment_token))
+
+
+def _remember(payment_token: str, result: dict) -> None:
+    _completed[payment_token] = result
+    _completed.move_to_end(payment_token)
+    while len(_completed) > _COMPLETED_MAX:
+        _completed.popitem(last=False)
+
+
+def _claim_owner() -> str:
+    """Уникальный идентификатор обработчика: хост, процесс, попытка."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+async def create_order_from_payment(
+    ytimes_client: YTimesAPIClient | None,
+    payment_token: str,
+    *,
+    telegram_id: int | None = None,
+    log_prefix: str = "order_from_payment",
+) -> dict:
+    """Создать заказ в YTimes и в БД по ожидающему платежу (paidValue = total).
+
+    Идемпотентно по payment_token: повторный вызов возвращает тот же заказ
+    (replayed=True), параллельный вызов ждёт завершения первого.
+    Для платежа «только привязка карты» заказ не создаётся (order_id=None).
+    """
+    payment_token = (payment_token or "").strip()
+    if not payment_token:
+        raise OrderFromPaymentError("Требуется payment_token", status_code=400, reason="no_token")
+    if payment_token in _completed:
+        payment_log(f"{log_prefix}_replay", payment_token=payment_token, source="memory")
+        return {**_completed[payment_token], "replayed": True}
+    inflight = _inflight.get(payment_token)
+    if inflight is not None:
+        result = await asyncio.shield(inflight)
+        return {**result, "replayed": True}
+
+    future: asyncio.Future = asyncio.get_running_loop().create_future()
+    _inflight[payment_token] = future
+    try:
+        result = await _create_order_from_payment(
+            ytimes_client, payment_token, telegram_id=telegram_id, log_prefix=log_prefix
+        )
+    except BaseException as e:
+        future.set_exception(e)
+        # Исключение уже передано вызывающему; ожидающих может не быть
+        future.exception()
+        raise
+    else:
+        future.set_result(result)
+        _remember(payment_token, result)
+        return result
+    finally:
+        _inflight.pop(payment_token, None)
+
+
+async def _fulfilled_result(pending: dict, log_prefix: str) -> dict:
+    """Ответ для уже исполненного платежа (повтор).
+
+    В pending_payments.order_guid лежит id сохранённого заказа — guid, который вернул YTimes,
+    а не вычисленный order_guid_for_payment: по нему заказ и ищется.
+    """
+    payment_token = pending["payment_token"]
+    order_id = pending.get("order_guid")
+    order = await get_order_by_ytimes_guid(order_id) if order_id else None
+    payment_log(f"{log_prefix}_replay", payment_token=payment_token, source="db", order_id=order_id)
+    return {
+        "success": True,
+        "order_id": order["ytimes_order_id"] if order else order_id,
+        "status": order["status"] if order else None,
+        "total": float(order["total_price"]) if order else float(pending["total"]),
+        "replayed": True,
+    }
+
+
+async def _wait_for_other_worker(payment_token: str, log_prefix: str) -> dict:
+    """Платёж захвачен другим обработчиком: ждём его результата или истечения аренды."""
+    deadline = time.monotonic() + _BUSY_WAIT_SECONDS
+    while time.monotonic() < deadline:
+        await asyncio.sleep(_BUSY_POLL_INTERVAL)
+        pending = await get_pending_payment(payment_token)
+        if pending and pending.get("state") == "fulfilled":
+            return await _fulfilled_result(pending, log_prefix)
+        if not pending or pending.get("state") != "claimed":
+            break
+    payment_log(f"{log_prefix}_busy", payment_token=payment_token)
+    raise OrderFromPaymentError("Платёж уже обрабатывается, повторите позже", status_code=409, reason="busy")
+
+
+async def _create_order_from_payment(
+    ytimes_client: YTimesAPIClient | None,
+    payment_token: str,
+    *,
+    telegram_id: int | None,
+    log_prefix: str,
+) -> dict:
+    payment_log(f"{log_prefix}_start", payment_token=payment_token)
+    owner = _claim_owner()
+    pending = await claim_pending_payment(payment_token, owner, CLAIM_LEASE_SECONDS)
+    if not pending:
+        pending = await get_pending_payment(payment_token)
+        if not pending:
+            payment_log(f"{log_prefix}_fail", payment_token=payment_token, reason="pending_not_found")
+            raise OrderFromPaymentError("Платёж не найден или уже использован", status_code=404, reason="pending_not_found")
+        if pending.get("state") == "fulfilled":
+            return await _fulfilled_result(pending, log_prefix)
+        return await _wait_for_other_worker(payment_token, log_prefix)
+
+    total = float(pending["total"])
+    if pending.get("link_card_only"):
+        await complete_pending_payment(payment_token, owner)
+        return {"success": True, "order_id": None, "status": None, "total": total, "replayed": False}
+    if not ytimes_client:
+        await fail_pending_payment(payment_token, owner, "no_ytimes")
+        payment_log(f"{log_prefix}_fail", payment_token=payment_token, reason="no_ytimes")
+        raise OrderFromPaymentError("YTimes не настроен", status_code=500, reason="no_ytimes")
+    items = pending["items"]
+    client = json.loads(pending["client_json"] or "{}")
+    comment = (pending["comment"] or "").strip()
+    telegram_id = int(telegram_id or pending["telegram_id"] or 0)
+    order_guid = order_guid_for_payment(payment_token)
+    shop_guid = ytimes_client.default_shop_guid
+    ytimes_items = build_ytimes_items(items)
+    try:
+        created = await run_ytimes(
+            ytimes_client.create_order,
+            order_guid=order_guid,
+            shop_guid=shop_guid,
+            order_type="TOGO",
+            items=ytimes_items,
+            client=client,
+            comment=comment or None,
+            paid_value=total,
+        )
+    except Exception as e:
+        await fail_pending_payment(payment_token, owner, str(e))
+        payment_log(f"{log_prefix}_order_error", payment_token=payment_token, error=str(e))
+        raise
+    # YTimes может вернуть свой guid: сохраняется, кэшируется и отдаётся при повторе именно он
+    order_id_return = created.get("guid") or order_guid
+    status = created.get("status") or "CREATED"
+    completed = await complete_pending_payment(
+        payment_token,
+        owner,
+        ytimes_order_guid=order_id_return,
+        user_telegram_id=telegram_id,
+        total_price=total,
+        status=status,
+    )
+    if not completed:
+        # Аренда истекла и платёж взял другой обработчик; guid заказа тот же, YTimes не создаст дубль
+        payment_log(f"{log_prefix}_lease_lost", payment_token=payment_token, order_id=order_id_return)
+        return await _wait_for_other_worker(payment_token, log_prefix)
+    order_statuses.put(order_id_return, status, total)
+    payment_log(f"{log_prefix}_ok", payment_token=payment_token, order_id=order_id_return, total=total)
+    return {
+        "success": True,
+        "order_id": order_id_return,
+        "status": status,
+        "total": total,
+        "replayed": False,
+    }
@@ -0,0 +1,105 @@
+"""Кэш статусов заказов для GET /api/order/{guid}/status.
+
+Статус заказа меняется только в двух местах: при создании заказа и в вебхуке YTimes —
+оба пишут сюда сразу после записи в БД. Промах (перезапуск, заказ из другого воркера)
+читает БД по индексу на orders.ytimes_order_id и кладёт результат в кэш.
+
+Незавершённые заказы лежат в LRU ограниченного размера и перечитываются из БД не чаще
+раза в ACTIVE_REVALIDATE секунд: вебхук мог прийти в другой воркер. Завершённые
+(FINAL_STATUSES) больше не меняются — они хранятся FINAL_TTL секунд с момента
+завершения и вытесняются по возрасту: опрашивать их уже некому.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from database import get_order_by_ytimes_guid
+
+# Вебхук YTimes присылает только эти итоговые статусы (принят / отклонён кассиром)
+FINAL_STATUSES = frozenset({"ACCEPTED", "CANCELLED"})
+ACTIVE_MAX_ENTRIES = 5000
+FINAL_MAX_ENTRIES = 20000
+FINAL_TTL = float(os.getenv("ORDER_STATUS_FINAL_TTL", "3600"))
+ACTIVE_REVALIDATE = 5.0
+
+
+class OrderStatusCache:
+    """guid заказа -> {"order_id", "status", "total", "final"}."""
+
+    def __init__(
+        self,
+        *,
+        active_max: int = ACTIVE_MAX_ENTRIES,
+        final_max: int = FINAL_MAX_ENTRIES,
+        final_ttl: float = FINAL_TTL,
+        revalidate: float = ACTIVE_REVALIDATE,
+    ) -> None:
+        self.active_max = active_max
+        self.final_max = final_max
+        self.final_ttl = final_ttl
+        self.revalidate = revalidate
+        # guid -> (данные, момент записи по monotonic); _active — от давно не запрошенных
+        # к недавним (LRU), _final — по времени записи
+        self._active: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self._final: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, order_id: str, status: str, total: float | None = None) -> dict:
+        """Записать статус (после записи в БД)."""
+        now = time.monotonic()
+        self._active.pop(order_id, None)
+        self._final.pop(order_id, None)
+        entry = {"order_id": order_id, "status": status, "total": total, "final": status in FINAL_STATUSES}
+        if entry["final"]:
+            self._final[order_id] = (entry, now)
+        else:
+            self._active[order_id] = (entry, now)
+        self._evict(now)
+        return entry
+
+    def get(self, order_id: str) -> Optional[dict]:
+        """Статус из кэша; None — нужно прочитать БД."""
+        now = time.monotonic()
+        self._evict(now)
+        cached = self._final.get(order_id)
+        if cached is None:
+            cached = self._active.get(order_id)
+            if cached is not None:
+                self._active.move_to_end(order_id)
+                if now - cached[1] >= self.revalidate:
+                    cached = None
+        if cached is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cached[0]
+
+    def _evict(self, now: float) -> None:
+        while len(self._active) > self.active_max:
+            self._active.popitem(last=False)
+        while self._final and (
+            len(self._final) > self.final_max or now - next(iter(self._final.values()))[1] >= self.final_ttl
+        ):
+            self._final.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"active": len(self._active), "final": len(self._final), "hits": self.hits, "misses": self.misses}
+
+
+order_statuses = OrderStatusCache()
+
+
+async def lookup_order_status(order_id: str) -> Optional[dict]:
+    """Статус заказа из кэша, при промахе — из БД."""
+    cached = order_statuses.get(order_id)
+    if cached is not None:
+        return cached
+    order = await get_order_by_ytimes_guid(order_id)
+    if not order:
+        return None
+    return order_statuses.put(order_id, order["status"], float(order["total_price"]))
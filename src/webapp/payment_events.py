@@ -0,0 +1,255 @@
+"""Хранилище событий оплаты: таблица SQLite с индексами вместо чтения payment.log целиком.
+
+payment_log.log кладёт событие в очередь, поток-писатель вставляет очередь пачками
+(одна транзакция на пачку) в data/payment_events.db — отдельный файл, чтобы журнал не
+делил блокировку записи с заказами и работал при любом DATABASE_URL. Ключевые поля
+(время, событие, payment_token, trace_id) — отдельные колонки под индексы, остальное —
+JSON в data. Индексы: (ts, event) — воронка за период и удаление старого, (event, ts) —
+число одного события за период, (payment_token, ts) — история одного платежа. События
+старше PAYMENT_EVENTS_RETENTION_DAYS удаляются писателем раз в час порциями.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional, TypeVar
+
+T = TypeVar("T")
+
+EVENTS_DB = Path(__file__).resolve().parents[2] / "data" / "payment_events.db"
+ENABLED = os.getenv("PAYMENT_EVENTS_STORE", "1").strip() != "0"
+RETENTION_DAYS = float(os.getenv("PAYMENT_EVENTS_RETENTION_DAYS", "180"))
+_BATCH_SIZE = 500
+_FLUSH_SECONDS = 0.5
+_MAX_QUEUE = 50000
+_PRUNE_SECONDS = 3600.0
+_PRUNE_CHUNK = 5000
+_DAY_MS = 86_400_000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payment_events (
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    payment_token TEXT,
+    trace_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_payment_events_ts_event ON payment_events(ts, event);
+CREATE INDEX IF NOT EXISTS idx_payment_events_event_ts ON payment_events(event, ts);
+CREATE INDEX IF NOT EXISTS idx_payment_events_token_ts ON payment_events(payment_token, ts)
+    WHERE payment_token IS NOT NULL;
+"""
+
+
+def connect(path: Path = EVENTS_DB) -> sqlite3.Connection:
+    """Соединение с хранилищем событий (схема создаётся при первом обращении)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _row(payload: dict[str, Any]) -> tuple:
+    data = {k: v for k, v in payload.items() if k not in ("event", "ts", "payment_token", "trace_id")}
+    return (
+        int(payload.get("ts") or time.time() * 1000),
+        str(payload["event"]),
+        payload.get("payment_token") or None,
+        payload.get("trace_id"),
+        json.dumps(data, ensure_ascii=False, default=str),
+    )
+
+
+def insert_many(conn: sqlite3.Connection, payloads: Iterable[dict[str, Any]]) -> int:
+    """Вставить события одной транзакцией. Возвращает число вставленных строк."""
+    rows = [_row(p) for p in payloads if p.get("event")]
+    with conn:
+        conn.executemany(
+            "INSERT INTO payment_events (ts, event, payment_token, trace_id, data) VALUES (?, ?, ?, ?, ?)", rows
+        )
+    return len(rows)
+
+
+def prune(conn: sqlite3.Connection, retention_days: float = RETENTION_DAYS) -> int:
+    """Удалить события старше retention_days порциями (не держим долгую блокировку)."""
+    cutoff = int(time.time() * 1000 - retention_days * _DAY_MS)
+    removed = 0
+    while True:
+        with conn:
+            cursor = conn.execute(
+                "DELETE FROM payment_events WHERE id IN "
+                "(SELECT id FROM payment_events WHERE ts < ? ORDER BY ts LIMIT ?)",
+                (cutoff, _PRUNE_CHUNK),
+            )
+        removed += cursor.rowcount
+        if cursor.rowcount < _PRUNE_CHUNK:
+            return removed
+
+
+# --- запросы ---
+
+
+def funnel(conn: sqlite3.Connection, since_ms: int, until_ms: Optional[int] = None, *, by_day: bool = False) -> dict:
+    """Число событий каждого типа за период: {event: n} или {день: {event: n}} при by_day."""
+    until_ms = until_ms or int(time.time() * 1000) + 1
+    if not by_day:
+        rows = conn.execute(
+            "SELECT event, COUNT(*) FROM payment_events WHERE ts >= ? AND ts < ? GROUP BY event ORDER BY event",
+            (since_ms, until_ms),
+        )
+        return dict(rows.fetchall())
+    rows = conn.execute(
+        """SELECT date(ts / 1000, 'unixepoch') AS day, event, COUNT(*) FROM payment_events
+           WHERE ts >= ? AND ts < ? GROUP BY day, event ORDER BY day, event""",
+        (since_ms, until_ms),
+    )
+    out: dict[str, dict[str, int]] = {}
+    for day, event, n in rows:
+        out.setdefault(day, {})[event] = n
+    return out
+
+
+def count(conn: sqlite3.Connection, event: str, since_ms: int, until_ms: Optional[int] = None) -> int:
+    """Число событий event за период."""
+    until_ms = until_ms or int(time.time() * 1000) + 1
+    row = conn.execute(
+        "SELECT COUNT(*) FROM payment_events WHERE event = ? AND ts >= ? AND ts < ?", (event, since_ms, until_ms)
+    ).fetchone()
+    return row[0]
+
+
+def timeline(conn: sqlite3.Connection, payment_token: str, limit: int = 500) -> list[dict]:
+    """Все события одного платежа по времени, в том виде, в каком их писал payment_log."""
+    rows = conn.execute(
+        "SELECT ts, event, payment_token, trace_id, data FROM payment_events "
+        "WHERE payment_token = ? ORDER BY ts, id LIMIT ?",
+        (payment_token, limit),
+    )
+    out = []
+    for ts, event, token, trace_id, data in rows:
+        item = {"event": event, "ts": ts, "payment_token": token}
+        if trace_id:
+            item["trace_id"] = trace_id
+        item.update(json.loads(data))
+        out.append(item)
+    return out
+
+
+async def run_query(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполнить запрос fn(conn, ...) на отдельном соединении в потоке, не в loop."""
+
+    def run() -> T:
+        with closing(connect()) as conn:
+            return fn(conn, *args, **kwargs)
+
+    return await asyncio.to_thread(run)
+
+
+# --- поток-писатель ---
+
+
+class PaymentEventWriter:
+    """Очередь событий и поток, который вставляет их пачками и удаляет старые."""
+
+    def __init__(self, path: Path = EVENTS_DB, *, retention_days: float = RETENTION_DAYS) -> None:
+        self.path = path
+        self.retention_days = retention_days
+        self._queue: queue.Queue[Optional[dict]] = queue.Queue(maxsize=_MAX_QUEUE)
+        self.written = 0
+        self.dropped = 0
+        self.pruned = 0
+        self.last_error: Optional[str] = None
+        self._thread = threading.Thread(target=self._run, name="payment-events", daemon=True)
+        self._thread.start()
+
+    def submit(self, payload: dict[str, Any]) -> None:
+        try:
+            self._queue.put_nowait(payload)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        try:
+            conn = connect(self.path)
+        except sqlite3.Error as e:
+            self.last_error = f"{type(e).__name__}: {e}"
+            print(f"Журнал оплаты: не удалось открыть {self.path}: {e}")
+            return
+        next_prune = time.monotonic()
+        stopping = False
+        while not stopping:
+            batch: list[dict] = []
+            deadline = time.monotonic() + _FLUSH_SECONDS
+            while len(batch) < _BATCH_SIZE:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                if batch:
+                    self.written += insert_many(conn, batch)
+                if time.monotonic() >= next_prune:
+                    self.pruned += prune(conn, self.retention_days)
+                    next_prune = time.monotonic() + _PRUNE_SECONDS
+            except sqlite3.Error as e:
+                self.dropped += len(batch)
+                self.last_error = f"{type(e).__name__}: {e}"
+                print(f"Журнал оплаты: ошибка записи: {e}")
+        conn.close()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "pruned": self.pruned,
+            "retention_days": self.retention_days,
+            "last_error": self.last_error,
+        }
+
+
+_writer: Optional[PaymentEventWriter] = None
+_writer_lock = threading.Lock()
+
+
+def submit(payload: dict[str, Any]) -> None:
+    """Поставить событие в очередь записи (писатель запускается при первом событии)."""
+    global _writer
+    if not ENABLED:
+        return
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = PaymentEventWriter()
+    _writer.submit(payload)
+
+
+def close_payment_events() -> None:
+    """Дописать очередь (при остановке приложения)."""
+    global _writer
+    if _writer is not None:
+        writer, _writer = _writer, None
+        writer.close()
+
+
+def payment_events_stats() -> Optional[dict]:
+    return _writer.stats() if _writer is not None else None
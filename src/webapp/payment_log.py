@@ -1,4 +1,8 @@
-"""Логирование всей логики оплаты: create-inapp, return, order-from-payment, YooKassa."""
+"""Логирование всей логики оплаты: create-inapp, return, order-from-payment, YooKassa.
+
+События пишутся в stdout и в хранилище payment_events (data/payment_events.db), где их
+можно выбирать по событию, платежу и времени. Плоский data/payment.log — при PAYMENT_LOG_FILE=1.
+"""
 
 from __future__ import annotations
 
@@ -8,8 +12,12 @@ import time
 from pathlib import Path
 from typing import Any
 
+from . import payment_events
+from .tracing import log_fields
+
 _LOG_DIR = Path(__file__).resolve().parents[2] / "data"
 _LOG_FILE = _LOG_DIR / "payment.log"
+_WRITE_FILE = os.getenv("PAYMENT_LOG_FILE", "0").strip() == "1"
 
 
 def _safe_data(data: dict[str, Any]) -> dict[str, Any]:
@@ -22,17 +30,20 @@ def _safe_data(data: dict[str, Any]) -> dict[str, Any]:
 
 
 def log(event: str, **kwargs: Any) -> None:
-    """Пишет одну строку JSON в payment.log и в stdout (без паролей)."""
+    """Пишет событие в stdout и payment_events (без паролей); с trace_id запроса."""
     payload = _safe_data({
         "event": event,
         "ts": round(time.time() * 1000),
+        **log_fields(),
         **kwargs,
     })
     line = json.dumps(payload, ensure_ascii=False) + "\n"
-    try:
-        _LOG_DIR.mkdir(parents=True, exist_ok=True)
-        with open(_LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(line)
-    except Exception:
-        pass
+    payment_events.submit(payload)
+    if _WRITE_FILE:
+        try:
+            _LOG_DIR.mkdir(parents=True, exist_ok=True)
+            with open(_LOG_FILE, "a", encoding="utf-8") as f:
+                f.write(line)
+        except Exception:
+            pass
     print(f"[payment] {line.strip()}")
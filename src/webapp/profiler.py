@@ -0,0 +1,281 @@
+"""Выборочный профилировщик запросов (включается PROFILE_SAMPLE_RATE или PROFILE_SLOW_MS).
+
+Профиль снимается по времени на часах, а не по процессору: отдельный поток каждые
+PROFILE_INTERVAL_MS смотрит, где сейчас находится каждый отслеживаемый запрос. Для
+запроса, который выполняется в loop, берётся настоящий стек потока (JWT, json.dumps,
+bcrypt); для ожидающего — цепочка await его корутин (SQLite, run_ytimes, httpx к ЮKassa,
+очередь допуска). Поэтому видно, куда ушло время запроса целиком.
+
+Отслеживается доля PROFILE_SAMPLE_RATE запросов; при PROFILE_SLOW_MS отслеживаются все,
+но сохраняются только те, что оказались медленнее порога. Профили суммируются по маршруту
+в «свёрнутые» стеки (формат flamegraph.pl / speedscope, вес — мс) и раз в минуту пишутся
+в data/profiles/. Накладные расходы ограничены: при превышении доли PROFILE_MAX_OVERHEAD
+времени поток реже снимает стеки, одновременно отслеживается не больше MAX_TRACKED запросов.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+ENABLED = SAMPLE_RATE > 0 or SLOW_MS > 0
+INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "10")) / 1000
+MAX_OVERHEAD = float(os.getenv("PROFILE_MAX_OVERHEAD", "0.02"))
+_MAX_INTERVAL = 0.2
+MAX_TRACKED = 64
+# Разных стеков на маршрут не больше этого: остальное идёт в «[другие стеки]»
+_MAX_STACKS_PER_ROUTE = 5000
+_FLUSH_SECONDS = 60.0
+
+PROFILE_DIR = Path(__file__).resolve().parents[2] / "data" / "profiles"
+_SRC_MARKER = os.sep + "src" + os.sep
+
+
+class _Tracked:
+    __slots__ = ("task", "keep", "started", "samples")
+
+    def __init__(self, task: asyncio.Task, keep: bool) -> None:
+        self.task = task
+        self.keep = keep
+        self.started = time.perf_counter()
+        self.samples: Counter[tuple[str, ...]] = Counter()
+
+
+class RequestProfiler:
+    """Поток-сэмплер и сводные профили по маршрутам."""
+
+    def __init__(
+        self,
+        *,
+        sample_rate: float = SAMPLE_RATE,
+        slow_ms: float = SLOW_MS,
+        interval: float = INTERVAL,
+        max_overhead: float = MAX_OVERHEAD,
+        directory: Path = PROFILE_DIR,
+    ) -> None:
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.base_interval = interval
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.directory = directory
+        self._tracked: dict[int, _Tracked] = {}
+        self._lock = threading.Lock()
+        self._labels: dict[object, str] = {}
+        self._routes: dict[str, dict] = {}
+        self._dirty = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.overhead = 0.0
+        self.skipped = 0
+
+    # --- поток-сэмплер ---
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread = threading.get_ident()
+            self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.flush()
+
+    def _run(self) -> None:
+        next_flush = time.monotonic() + _FLUSH_SECONDS
+        while not self._stop.wait(self.interval):
+            started = time.perf_counter()
+            self._sample()
+            cost = time.perf_counter() - started
+            self.overhead = 0.9 * self.overhead + 0.1 * cost / (self.interval + cost)
+            if self.overhead > self.max_overhead:
+                self.interval = min(self.interval * 1.5, _MAX_INTERVAL)
+            elif self.overhead < self.max_overhead / 4 and self.interval > self.base_interval:
+                self.interval = max(self.interval / 1.5, self.base_interval)
+            if time.monotonic() >= next_flush:
+                self.flush()
+                next_flush = time.monotonic() + _FLUSH_SECONDS
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            if _SRC_MARKER in filename:
+                filename = filename.split(_SRC_MARKER, 1)[1]
+            else:
+                filename = os.path.basename(filename)
+            label = self._labels[code] = f"{filename}:{code.co_name}"
+        return label
+
+    def _await_stack(self, coro) -> list[str]:
+        """Цепочка await приостановленной корутины, от внешней к внутренней."""
+        stack = []
+        while coro is not None:
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+            if frame is None:
+                if not hasattr(coro, "cr_frame") and not hasattr(coro, "gi_frame"):
+                    # Лист — Future (executor, сокет, таймер); итератор Future в C называется FutureIter
+                    stack.append("await " + type(coro).__name__.replace("FutureIter", "Future"))
+                break
+            stack.append(self._label(frame.f_code))
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        return stack
+
+    def _running_stack(self, coro) -> Optional[list[str]]:
+        """Стек потока loop от корутины задачи вглубь (задача сейчас выполняется)."""
+        frame = sys._current_frames().get(self._loop_thread)
+        root = getattr(coro, "cr_code", None)
+        frames = []
+        while frame is not None:
+            frames.append(frame.f_code)
+            if frame.f_code is root:
+                return [self._label(code) for code in reversed(frames)]
+            frame = frame.f_back
+        return None
+
+    def _sample(self) -> None:
+        weight = max(1, round(self.interval * 1000))
+        with self._lock:
+            tracked = list(self._tracked.values())
+            if not tracked:
+                return
+            current = asyncio.current_task(self._loop)
+            for item in tracked:
+                coro = item.task.get_coro()
+                stack = self._running_stack(coro) if item.task is current else None
+                if stack is None:
+                    stack = self._await_stack(coro)
+                if stack:
+                    item.samples[tuple(stack)] += weight
+
+    # --- запросы ---
+
+    def begin(self) -> Optional[_Tracked]:
+        """Начать отслеживание текущего запроса; None — не отслеживается."""
+        keep = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not keep and self.slow_ms <= 0:
+            return None
+        if len(self._tracked) >= MAX_TRACKED:
+            self.skipped += 1
+            return None
+        self._ensure_started()
+        task = asyncio.current_task()
+        if task is None:
+            return None
+        item = _Tracked(task, keep)
+        with self._lock:
+            self._tracked[id(item)] = item
+        return item
+
+    def end(self, item: _Tracked, route: str) -> None:
+        duration_ms = (time.perf_counter() - item.started) * 1000
+        with self._lock:
+            self._tracked.pop(id(item), None)
+            if not (item.keep or duration_ms >= self.slow_ms):
+                return
+            profile = self._routes.setdefault(
+                route, {"requests": 0, "total_ms": 0.0, "max_ms": 0.0, "stacks": Counter()}
+            )
+            profile["requests"] += 1
+            profile["total_ms"] += duration_ms
+            profile["max_ms"] = max(profile["max_ms"], duration_ms)
+            stacks: Counter = profile["stacks"]
+            for stack, weight in item.samples.items():
+                if stack in stacks or len(stacks) < _MAX_STACKS_PER_ROUTE:
+                    stacks[stack] += weight
+                else:
+                    stacks[("[другие стеки]",)] += weight
+            self._dirty = True
+
+    # --- выгрузка ---
+
+    @staticmethod
+    def route_name(route: str) -> str:
+        """Имя файла профиля: 'POST /api/order' -> 'POST_api_order'."""
+        return re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_")
+
+    def summary(self) -> dict:
+        with self._lock:
+            routes = {
+                self.route_name(route): {
+                    "route": route,
+                    "requests": p["requests"],
+                    "avg_ms": round(p["total_ms"] / p["requests"], 1),
+                    "max_ms": round(p["max_ms"], 1),
+                    "sampled_ms": sum(p["stacks"].values()),
+                }
+                for route, p in self._routes.items()
+            }
+        return {
+            "routes": routes,
+            "interval_ms": round(self.interval * 1000, 1),
+            "overhead": round(self.overhead, 4),
+            "tracked": len(self._tracked),
+            "skipped": self.skipped,
+        }
+
+    def folded(self, name: str) -> Optional[str]:
+        """Свёрнутые стеки маршрута: строка 'кадр;кадр;кадр вес_мс' на стек."""
+        with self._lock:
+            for route, profile in self._routes.items():
+                if self.route_name(route) == name:
+                    stacks = profile["stacks"].most_common()
+                    break
+            else:
+                return None
+        return "".join(f"{';'.join(stack)} {weight}\n" for stack, weight in stacks)
+
+    def flush(self) -> None:
+        """Записать профили в data/profiles/ (из потока-сэмплера, не из loop)."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        summary = self.summary()
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for name in summary["routes"]:
+                (self.directory / f"{name}.folded").write_text(self.folded(name) or "", encoding="utf-8")
+            (self.directory / "summary.json").write_text(
+                json.dumps(summary, ensure_ascii=False, indent=2), encoding="utf-8"
+            )
+        except OSError as e:
+            print(f"Профилировщик: не удалось записать профили: {e}")
+
+
+profiler: Optional[RequestProfiler] = RequestProfiler() if ENABLED else None
+
+
+class ProfilingMiddleware:
+    """ASGI-middleware: отслеживает запрос профилировщиком и относит профиль к маршруту."""
+
+    def __init__(self, app: ASGIApp, profiler: RequestProfiler) -> None:
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        item = self.profiler.begin() if scope["type"] == "http" else None
+        if item is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "[без маршрута]"
+            self.profiler.end(item, f"{scope.get('method', '')} {path}")
@@ -0,0 +1,161 @@
+"""Раздача собранного фронтенда (frontend/dist) из памяти со сжатием и кешированием.
+
+При старте все файлы читаются один раз, текстовые сжимаются в gzip и (если установлен
+пакет brotli) в br. На запрос выбирается вариант по Accept-Encoding, без работы с диском
+и без сжатия на лету. Файлы с хешем в имени из assets/ (Vite: assets/index-3f9a1c2b.js)
+отдаются с Cache-Control immutable на год, index.html — с коротким кешем, остальное
+(иконки, логотипы из public/) — на час. ETag у каждой кодировки свой.
+Поведение путей как у StaticFiles(html=True): "/" и каталоги -> index.html, иначе 404.html.
+"""
+
+from __future__ import annotations
+
+import gzip
+import hashlib
+import mimetypes
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, PlainTextResponse, Response
+from starlette.types import Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен: без него только gzip
+    brotli = None
+
+# Файлы крупнее — не держим в памяти, отдаём с диска (FileResponse)
+_MAX_IN_MEMORY = 2 * 1024 * 1024
+# Меньше этого сжимать нет смысла
+_MIN_COMPRESS = 512
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/xml")
+# Бандл Vite с хешем содержимого: assets/name-<8 символов base64url>.ext
+_HASHED_RE = re.compile(r"^assets/.+-[A-Za-z0-9_-]{8}\.[a-z0-9]+$")
+
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_HTML = "public, max-age=60, must-revalidate"
+CACHE_DEFAULT = "public, max-age=3600"
+
+
+@dataclass(frozen=True, slots=True)
+class _Asset:
+    path: Path
+    media_type: str
+    etag: str
+    cache_control: str
+    raw: bytes | None  # None — файл большой, отдаётся с диска
+    gzip: bytes | None = None
+    br: bytes | None = None
+
+
+def _accepted_encodings(header: str) -> set[str]:
+    """Кодировки из Accept-Encoding с q > 0."""
+    out = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name and q > 0:
+            out.add(name.strip().lower())
+    return out
+
+
+class PrecompressedStaticFiles:
+    """ASGI-приложение для app.mount("/", ...) вместо StaticFiles(html=True)."""
+
+    def __init__(self, directory: Path | str) -> None:
+        self.directory = Path(directory)
+        self._assets: dict[str, _Asset] = {}
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        for path in sorted(self.directory.rglob("*")):
+            if path.is_file():
+                rel = path.relative_to(self.directory).as_posix()
+                self._assets[rel] = self._load(path, rel)
+
+    def _load(self, path: Path, rel: str) -> _Asset:
+        media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if media_type.startswith("text/") or media_type == "application/javascript":
+            media_type += "; charset=utf-8"
+        if path.name == "index.html" or path.suffix == ".html":
+            cache_control = CACHE_HTML
+        elif _HASHED_RE.match(rel):
+            cache_control = CACHE_IMMUTABLE
+        else:
+            cache_control = CACHE_DEFAULT
+        stat = path.stat()
+        size = stat.st_size
+        if size > _MAX_IN_MEMORY:
+            etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+            return _Asset(path, media_type, etag, cache_control, None)
+        raw = path.read_bytes()
+        etag = '"' + hashlib.sha1(raw).hexdigest()[:16] + '"'
+        gz = br = None
+        if size >= _MIN_COMPRESS and media_type.startswith(_COMPRESSIBLE):
+            gz = gzip.compress(raw, compresslevel=9, mtime=0)
+            if len(gz) >= size:
+                gz = None
+            if brotli is not None:
+                br = brotli.compress(raw, quality=11)
+                if len(br) >= size:
+                    br = None
+        self.raw_bytes += size
+        self.stored_bytes += size + len(gz or b"") + len(br or b"")
+        return _Asset(path, media_type, etag, cache_control, raw, gz, br)
+
+    def _lookup(self, path: str) -> tuple[_Asset | None, int]:
+        rel = path.lstrip("/")
+        if rel in self._assets:
+            return self._assets[rel], 200
+        index = (rel.rstrip("/") + "/index.html").lstrip("/")
+        if index in self._assets:
+            return self._assets[index], 200
+        return self._assets.get("404.html"), 404
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        assert scope["type"] == "http"
+        if scope["method"] not in ("GET", "HEAD"):
+            response: Response = PlainTextResponse("Method Not Allowed", status_code=405)
+            await response(scope, receive, send)
+            return
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        asset, status_code = self._lookup(path)
+        if asset is None:
+            await PlainTextResponse("Not Found", status_code=404)(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        body = asset.raw
+        encoding = None
+        accepted = _accepted_encodings(request_headers.get("accept-encoding", ""))
+        if asset.br is not None and "br" in accepted:
+            body, encoding = asset.br, "br"
+        elif asset.gzip is not None and "gzip" in accepted:
+            body, encoding = asset.gzip, "gzip"
+        # Сжатое тело — другой набор байт, поэтому и другой сильный ETag
+        etag = asset.etag if encoding is None else f'{asset.etag[:-1]}-{encoding}"'
+        headers = {"ETag": etag, "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        if status_code == 200 and etag in request_headers.get("if-none-match", ""):
+            headers.pop("Content-Encoding", None)
+            await Response(status_code=304, headers=headers)(scope, receive, send)
+            return
+        if body is None:
+            response = FileResponse(asset.path, status_code=status_code, media_type=asset.media_type, headers=headers)
+            await response(scope, receive, send)
+            return
+        if scope["method"] == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        response = Response(body, status_code=status_code, media_type=asset.media_type, headers=headers)
+        await response(scope, receive, send)
@@ -0,0 +1,308 @@
+"""Трассировка запросов: trace id на каждый HTTP-запрос и дочерние спаны внешних вызовов.
+
+TracingMiddleware открывает корневой спан запроса (trace id берётся из входящего
+traceparent или создаётся) и возвращает его в заголовке X-Trace-Id. Внутри запроса
+span("yookassa.create_payment") и т. п. открывает дочерний спан; текущий спан живёт в
+contextvars, поэтому его видят и задачи, созданные из запроса. payment_log добавляет
+trace_id/span_id в каждое событие — по ним строки лога связываются со спанами.
+
+Экспорт включается TRACE_EXPORT: file — строки JSON в data/traces.jsonl, otlp — OTLP/HTTP
+JSON на TRACE_OTLP_ENDPOINT (Jaeger, Tempo, OpenTelemetry Collector). Экспортируется доля
+TRACE_SAMPLE_RATE трасс; запись и отправка идут пачками в отдельном потоке, не в loop.
+Без TRACE_EXPORT id всё равно назначаются и попадают в payment_log.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import httpx
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+EXPORT = os.getenv("TRACE_EXPORT", "").strip().lower()
+OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces").strip()
+SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "tgzakaz-webapp").strip()
+TRACE_HEADER = "X-Trace-Id"
+
+TRACE_FILE = Path(__file__).resolve().parents[2] / "data" / "traces.jsonl"
+_BATCH_SIZE = 256
+_FLUSH_SECONDS = 1.0
+_MAX_QUEUE = 10000
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# Виды спанов OTLP
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = 1, 2, 3
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "sampled", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], sampled: bool, kind: int = KIND_INTERNAL) -> None:
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.sampled = sampled
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes: dict[str, Any] = {}
+        self.error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def finish(self) -> None:
+        self.end_ns = time.time_ns()
+        if self.sampled and _exporter is not None:
+            _exporter.submit(self)
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("trace_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def log_fields() -> dict:
+    """trace_id/span_id текущего спана для строки payment_log (пусто вне запроса)."""
+    span = _current.get()
+    if span is None:
+        return {}
+    return {"trace_id": span.trace_id, "span_id": span.span_id}
+
+
+def _start(name: str, kind: int, parent: Optional[Span] = None) -> Span:
+    parent = parent or _current.get()
+    if parent is None:
+        return Span(name, secrets.token_hex(16), None, _sample(), kind)
+    return Span(name, parent.trace_id, parent.span_id, parent.sampled, kind)
+
+
+def _sample() -> bool:
+    return _exporter is not None and (SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE)
+
+
+@contextlib.contextmanager
+def span(name: str, kind: int = KIND_INTERNAL, **attributes: Any) -> Iterator[Span]:
+    """Дочерний спан текущего (или новая трасса, если спана нет)."""
+    current = _start(name, kind)
+    current.attributes.update(attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = current.error or f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        current.finish()
+
+
+def record_span(name: str, seconds: float, **attributes: Any) -> None:
+    """Завершившийся только что спан длительностью seconds (фазы запросов к БД)."""
+    parent = _current.get()
+    if parent is None or not parent.sampled or _exporter is None:
+        return
+    child = Span(name, parent.trace_id, parent.span_id, True)
+    child.end_ns = time.time_ns()
+    child.start_ns = child.end_ns - int(seconds * 1e9)
+    child.attributes.update(attributes)
+    _exporter.submit(child)
+
+
+# --- экспорт ---
+
+
+def _to_json(span: Span) -> dict:
+    return {
+        "trace_id": span.trace_id,
+        "span_id": span.span_id,
+        "parent_id": span.parent_id,
+        "name": span.name,
+        "start_ms": span.start_ns // 1_000_000,
+        "duration_ms": round((span.end_ns - span.start_ns) / 1e6, 3),
+        "attributes": span.attributes,
+        **({"error": span.error} if span.error else {}),
+    }
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _to_otlp(span: Span) -> dict:
+    body = {
+        "traceId": span.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": span.kind,
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.end_ns),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+    }
+    if span.parent_id:
+        body["parentSpanId"] = span.parent_id
+    if span.error:
+        body["status"] = {"code": 2, "message": span.error}
+    return body
+
+
+class SpanExporter:
+    """Очередь завершённых спанов и поток, который пишет их пачками."""
+
+    def __init__(self, mode: str, *, path: Path = TRACE_FILE, endpoint: str = OTLP_ENDPOINT) -> None:
+        self.mode = mode
+        self.path = path
+        self.endpoint = endpoint
+        self._queue: queue.Queue[Optional[Span]] = queue.Queue(maxsize=_MAX_QUEUE)
+        self.exported = 0
+        self.dropped = 0
+        self.last_error: Optional[str] = None
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def submit(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch: list[Span] = []
+            deadline = time.monotonic() + _FLUSH_SECONDS
+            while len(batch) < _BATCH_SIZE:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            if batch:
+                self._export(batch)
+
+    def _export(self, batch: list[Span]) -> None:
+        try:
+            if self.mode == "otlp":
+                body = {
+                    "resourceSpans": [{
+                        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+                        "scopeSpans": [{"scope": {"name": "tgzakaz"}, "spans": [_to_otlp(s) for s in batch]}],
+                    }]
+                }
+                httpx.post(self.endpoint, json=body, timeout=5.0).raise_for_status()
+            else:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(_to_json(s), ensure_ascii=False) + "\n" for s in batch))
+            self.exported += len(batch)
+        except Exception as e:
+            self.dropped += len(batch)
+            if self.last_error is None:
+                print(f"Трассировка: не удалось выгрузить спаны: {e}")
+            self.last_error = f"{type(e).__name__}: {e}"
+
+    def stats(self) -> dict:
+        return {
+            "export": self.mode,
+            "sample_rate": SAMPLE_RATE,
+            "queued": self._queue.qsize(),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "last_error": self.last_error,
+        }
+
+
+_exporter: Optional[SpanExporter] = None
+
+
+def start_tracing() -> Optional[SpanExporter]:
+    """Запустить экспорт спанов, если TRACE_EXPORT=file или otlp."""
+    global _exporter
+    if EXPORT in ("file", "otlp") and _exporter is None:
+        _exporter = SpanExporter(EXPORT)
+        target = OTLP_ENDPOINT if EXPORT == "otlp" else TRACE_FILE
+        print(f"Трассировка: экспорт {EXPORT} -> {target}, доля трасс {SAMPLE_RATE}.")
+    return _exporter
+
+
+def stop_tracing() -> None:
+    global _exporter
+    if _exporter is not None:
+        exporter, _exporter = _exporter, None
+        exporter.stop()
+
+
+def tracing_stats() -> Optional[dict]:
+    return _exporter.stats() if _exporter is not None else None
+
+
+class TracingMiddleware:
+    """ASGI-middleware: корневой спан запроса и заголовок X-Trace-Id в ответе."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        parent = None
+        traceparent = dict(scope.get("headers") or ()).get(b"traceparent", b"").decode("latin-1").strip()
+        match = _TRACEPARENT.match(traceparent)
+        if match:
+            # Вызывающий уже ведёт трассу: продолжаем её, решение о выборке — его
+            parent = Span("remote", match.group(1), None, _exporter is not None and match.group(3) == "01")
+            parent.span_id = match.group(2)
+        root = _start(scope.get("method", "") + " " + scope.get("path", ""), KIND_SERVER, parent)
+        root.set(**{"http.method": scope.get("method", ""), "http.target": scope.get("path", "")})
+        token = _current.set(root)
+
+        async def send_with_trace(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                root.set(**{"http.status_code": message["status"]})
+                if message["status"] >= 500:
+                    root.error = f"HTTP {message['status']}"
+                MutableHeaders(scope=message)[TRACE_HEADER] = root.trace_id
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException as e:
+            root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            route = getattr(scope.get("route"), "path", None)
+            if route:
+                root.name = f"{scope.get('method', '')} {route}"
+                root.set(**{"http.route": route})
+            _current.reset(token)
+            root.finish()
@@ -0,0 +1,262 @@
+"""Клиент API ЮKassa: общий пул соединений, безопасные повторы, метрики задержек.
+
+Заголовок Authorization считается один раз при создании клиента. Idempotence-Key для
+создания платежа выводится из payment_token, поэтому повтор после таймаута или 5xx
+(в том числе из другого воркера или после перезапуска) вернёт тот же платёж ЮKassa,
+а не создаст второй. Повторяются только сетевые ошибки, 5xx, 429 и 202 «в обработке»;
+4xx возвращаются сразу.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import os
+import time
+import uuid
+from collections import deque
+from typing import Optional
+
+import httpx
+
+from .tracing import KIND_CLIENT, span
+
+YOOKASSA_API_URL = "https://api.yookassa.ru/v3"
+# Пространство имён для Idempotence-Key: (операция, payment_token) -> всегда один ключ
+_IDEMPOTENCE_NAMESPACE = uuid.UUID("0d7a6e52-93b4-4f1c-b8e2-6c5a1f3d9e70")
+_RETRY_STATUSES = {202, 429, 500, 502, 503, 504}
+# Задержка перед повтором не больше этого, даже если ЮKassa просит retry_after больше
+_MAX_BACKOFF = 5.0
+# Сколько последних замеров держать для перцентилей
+_LATENCY_WINDOW = 500
+
+
+def idempotence_key(operation: str, payment_token: str) -> str:
+    """Idempotence-Key для операции над платежом (ЮKassa принимает до 64 символов)."""
+    return str(uuid.uuid5(_IDEMPOTENCE_NAMESPACE, f"{operation}:{payment_token}"))
+
+
+class _OperationStats:
+    """Счётчики и последние задержки одной операции."""
+
+    __slots__ = ("calls", "errors", "retries", "latencies")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.latencies: deque[float] = deque(maxlen=_LATENCY_WINDOW)
+
+    def summary(self) -> dict:
+        ordered = sorted(self.latencies)
+
+        def pct(p: float) -> float | None:
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 1)
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "p50_ms": pct(0.5),
+            "p95_ms": pct(0.95),
+            "max_ms": round(ordered[-1] * 1000, 1) if ordered else None,
+        }
+
+
+class YooKassaClient:
+    """Асинхронный клиент ЮKassa с общим httpx.AsyncClient на процесс."""
+
+    def __init__(
+        self,
+        shop_id: str,
+        secret_key: str,
+        *,
+        base_url: str = YOOKASSA_API_URL,
+        timeout: float = 15.0,
+        max_attempts: int = 3,
+        backoff: float = 0.5,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self._auth_header = "Basic " + base64.b64encode(f"{shop_id}:{secret_key}".encode()).decode()
+        self._timeout = httpx.Timeout(timeout, connect=5.0)
+        self._max_attempts = max(1, max_attempts)
+        self._backoff = backoff
+        self._http: httpx.AsyncClient | None = None
+        self._stats: dict[str, _OperationStats] = {}
+        # Текст ошибки с телом ответа ЮKassa — только для служебных запросов, не для /health
+        self.last_error: str | None = None
+        self.last_error_status: int | None = None  # HTTP-статус последней ошибки (None — сетевая)
+
+    @classmethod
+    def from_env(cls) -> Optional["YooKassaClient"]:
+        """Клиент по YOOKASSA_SHOP_ID / YOOKASSA_SECRET_KEY; None, если они не заданы."""
+        shop_id = os.getenv("YOOKASSA_SHOP_ID", "").strip()
+        secret = os.getenv("YOOKASSA_SECRET_KEY", "").strip()
+        if not shop_id or not secret:
+            return None
+        return cls(
+            shop_id,
+            secret,
+            base_url=os.getenv("YOOKASSA_API_URL", "").strip() or YOOKASSA_API_URL,
+            max_attempts=int(os.getenv("YOOKASSA_MAX_ATTEMPTS", "3")),
+        )
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self._timeout,
+                headers={"Authorization": self._auth_header},
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0),
+            )
+        return self._http
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def stats(self) -> dict:
+        """Метрики по операциям: вызовы, ошибки, повторы, p50/p95/max задержки в мс."""
+        return {name: s.summary() for name, s in self._stats.items()}
+
+    def _delay(self, attempt: int, response: httpx.Response | None) -> float:
+        delay = self._backoff * (2 ** attempt)
+        if response is not None and response.status_code == 202:
+            # Запрос с этим ключом ещё обрабатывается: ЮKassa сообщает retry_after в мс
+            try:
+                delay = float(response.json().get("retry_after", 0)) / 1000 or delay
+            except (ValueError, AttributeError):
+                pass
+        return min(delay, _MAX_BACKOFF)
+
+    async def _request(self, operation: str, method: str, path: str, **kwargs) -> dict | None:
+        """Запрос с повторами. Тело ответа 200 или None (ошибка записана в last_error)."""
+        stats = self._stats.setdefault(operation, _OperationStats())
+        stats.calls += 1
+        response: httpx.Response | None = None
+        error = ""
+        status: int | None = None
+        with span(f"yookassa.{operation}", KIND_CLIENT, **{"http.method": method}) as trace:
+            for attempt in range(self._max_attempts):
+                if attempt:
+                    stats.retries += 1
+                    await asyncio.sleep(self._delay(attempt - 1, response))
+                trace.set(attempts=attempt + 1)
+                started = time.perf_counter()
+                try:
+                    response = await self._client().request(method, path, **kwargs)
+                except httpx.TransportError as e:
+                    response = None
+                    status = None
+                    error = f"{type(e).__name__}: {e}"
+                    continue
+                finally:
+                    stats.latencies.append(time.perf_counter() - started)
+                trace.set(**{"http.status_code": response.status_code})
+                if response.status_code == 200:
+                    return response.json()
+                status = response.status_code
+                error = f"HTTP {status}: {response.text[:300]}"
+                if response.status_code not in _RETRY_STATUSES:
+                    break
+            trace.error = error
+        stats.errors += 1
+        self.last_error = f"{operation}: {error}"
+        self.last_error_status = status
+        print(f"ЮKassa {operation}: {error}")
+        return None
+
+    async def create_payment(
+        self,
+        *,
+        payment_token: str,
+        amount_rub: float,
+        description: str,
+        return_url: str,
+        metadata: dict | None = None,
+        save_payment_method: bool = False,
+    ) -> dict | None:
+        """Создать платёж с подтверждением через redirect. Повтор с тем же payment_token безопасен."""
+        payload = {
+            "amount": {"value": f"{amount_rub:.2f}", "currency": "RUB"},
+            "confirmation": {"type": "redirect", "return_url": return_url},
+            "description": description[:255],
+            "capture": True,
+            "metadata": {"payment_token": payment_token, **(metadata or {})},
+        }
+        if save_payment_method:
+            payload["save_payment_method"] = True
+        return await self._request(
+            "create_payment",
+            "POST",
+            "/payments",
+            json=payload,
+            headers={"Idempotence-Key": idempotence_key("create", payment_token)},
+        )
+
+    async def charge_saved_method(
+        self,
+        *,
+        payment_token: str,
+        payment_method_id: str,
+        amount_rub: float,
+        description: str,
+        metadata: dict | None = None,
+    ) -> dict | None:
+        """Списать с сохранённого способа оплаты без подтверждения пользователем (без redirect)."""
+        payload = {
+            "amount": {"value": f"{amount_rub:.2f}", "currency": "RUB"},
+            "payment_method_id": payment_method_id,
+            "description": description[:255],
+            "capture": True,
+            "metadata": {"payment_token": payment_token, **(metadata or {})},
+        }
+        return await self._request(
+            "charge_saved",
+            "POST",
+            "/payments",
+            json=payload,
+            headers={"Idempotence-Key": idempotence_key("charge", payment_token)},
+        )
+
+    async def get_payment(self, payment_id: str) -> dict | None:
+        """Получить платёж по id."""
+        return await self._request("get_payment", "GET", f"/payments/{payment_id}")
+
+    async def wait_for_payment(self, payment: dict, *, timeout: float = 10.0, interval: float = 0.5) -> dict:
+        """Дождаться финального статуса (succeeded / canceled), опрашивая платёж.
+
+        Возвращает последнее известное состояние: по истечении timeout статус может остаться pending.
+        """
+        deadline = time.monotonic() + timeout
+        while payment.get("status") in ("pending", "waiting_for_capture") and time.monotonic() < deadline:
+            await asyncio.sleep(interval)
+            fresh = await self.get_payment(payment["id"])
+            if fresh:
+                payment = fresh
+        return payment
+
+
+_client: YooKassaClient | None = None
+_client_loaded = False
+
+
+def get_yookassa_client() -> YooKassaClient | None:
+    """Общий клиент процесса; None, если ЮKassa не настроена."""
+    global _client, _client_loaded
+    if not _client_loaded:
+        _client = YooKassaClient.from_env()
+        _client_loaded = True
+    return _client
+
+
+async def close_yookassa_client() -> None:
+    """Закрыть пул соединений (при остановке приложения)."""
+    global _client, _client_loaded
+    if _client is not None:
+        await _client.aclose()
+    _client = None
+    _client_loaded = False
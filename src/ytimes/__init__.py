@@ -1,10 +1,18 @@
 """Пакет интеграции с внешним API YTimes."""
 
-from .api_client import Shop, YTimesAPIClient, YTimesAPIError
+from .api_client import CircuitOpenError, Shop, YTimesAPIClient, YTimesAPIError
+from .menu import MenuItem, MenuSnapshot, MenuType, SupplementCategory, SupplementItem, deep_sizeof
 
 __all__ = [
+    "CircuitOpenError",
+    "MenuItem",
+    "MenuSnapshot",
+    "MenuType",
     "Shop",
+    "SupplementCategory",
+    "SupplementItem",
     "YTimesAPIClient",
     "YTimesAPIError",
+    "deep_sizeof",
 ]
 
@@ -2,17 +2,25 @@
 
 from __future__ import annotations
 
+import math
 import os
+import threading
+import time
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 import httpx
 from dotenv import load_dotenv
 
+from .resilience import OperationGuard
+
 
 API_BASE_URL = "https://api.ytimes.ru/ex"
 ENV_VAR_API_KEY = "YT_API_KEY"
 ENV_VAR_SHOP_GUID = "YT_SHOP_GUID"
+ORDER_SAVE_PATH = "/order/save"
+# Неидемпотентные записи: таймаут фиксированный (timeout клиента), без подстройки под p99
+_FIXED_TIMEOUT_PATHS = frozenset({ORDER_SAVE_PATH})
 
 load_dotenv()
 
@@ -25,6 +33,15 @@ class YTimesAPIError(Exception):
         self.status_code = status_code
 
 
+class CircuitOpenError(YTimesAPIError):
+    """Операция YTimes временно не вызывается после серии сбоев. retry_after — секунд до пробы."""
+
+    def __init__(self, operation: str, retry_after: float) -> None:
+        super().__init__(f"YTimes недоступен ({operation}), повторите через {math.ceil(retry_after)} с")
+        self.operation = operation
+        self.retry_after = retry_after
+
+
 @dataclass(frozen=True)
 class Shop:
     """Модель торговой точки."""
@@ -49,11 +66,44 @@ class YTimesAPIClient:
 
     def __init__(self, api_key: str, *, timeout: float = 10.0, shop_guid: Optional[str] = None) -> None:
         self._api_key = api_key
+        # Верхняя граница таймаута; фактический подстраивается под задержки операции
+        # (кроме _FIXED_TIMEOUT_PATHS — у них всегда этот)
         self._timeout = timeout
         self._shop_guid = shop_guid
+        self._guards: Dict[str, OperationGuard] = {}
+        self._guards_lock = threading.Lock()
+
+    def _guard(self, path: str) -> OperationGuard:
+        guard = self._guards.get(path)
+        if guard is None:
+            with self._guards_lock:
+                guard = self._guards.setdefault(path, OperationGuard(
+                    path,
+                    max_timeout=self._timeout,
+                    adaptive_timeout=path not in _FIXED_TIMEOUT_PATHS,
+                ))
+        return guard
+
+    def circuit_retry_after(self, path: str) -> Optional[float]:
+        """Через сколько секунд операция снова доступна; None — доступна сейчас."""
+        guard = self._guards.get(path)
+        return guard.open_for() if guard else None
+
+    def resilience_stats(self) -> Dict[str, dict]:
+        """Состояние автоматов защиты и таймауты по операциям (для /health)."""
+        return {path: guard.stats() for path, guard in list(self._guards.items())}
 
     def _request(self, method: str, path: str, **kwargs) -> dict:
-        """Базовый метод выполнения HTTP-запроса к API."""
+        """Базовый метод выполнения HTTP-запроса к API.
+
+        Сбои сети, таймауты, 5xx и 429 учитываются автоматом защиты операции; пока он
+        разомкнут, сразу бросается CircuitOpenError.
+        """
+
+        guard = self._guard(path)
+        retry_after = guard.before_call()
+        if retry_after is not None:
+            raise CircuitOpenError(path, retry_after)
 
         url = f"{API_BASE_URL}{path}"
         headers = {
@@ -62,23 +112,37 @@ class YTimesAPIClient:
             "Content-Type": "application/json;charset=UTF-8",
         }
 
+        timeout = guard.timeout()
+        started = time.monotonic()
         try:
             response = httpx.request(
                 method,
                 url,
                 headers=headers,
-                timeout=self._timeout,
+                timeout=timeout,
                 **kwargs,
             )
         except httpx.HTTPError as exc:
+            guard.record_failure(f"{type(exc).__name__}: {exc}", time.monotonic() - started)
             raise YTimesAPIError(f"Ошибка сети при запросе {url}: {exc}") from exc
+        except Exception:
+            # Не сбой сервиса (например, InvalidURL), но пробный вызов должен завершиться,
+            # иначе полуоткрытый автомат так и останется занятым
+            guard.record_neutral()
+            raise
+        latency = time.monotonic() - started
 
         if response.status_code != httpx.codes.OK:
+            if response.status_code >= 500 or response.status_code == 429:
+                guard.record_failure(f"HTTP {response.status_code}", latency)
+            else:
+                guard.record_neutral()
             raise YTimesAPIError(
                 f"Ошибка ответа API {response.status_code}: {response.text}",
                 status_code=response.status_code,
             )
 
+        guard.record_success(latency)
         payload = response.json()
         if not payload.get("success", False):
             raise YTimesAPIError(payload.get("error") or "Неизвестная ошибка API")
@@ -237,7 +301,7 @@ class YTimesAPIClient:
         if client:
             order_data["client"] = self._normalize_client_for_order(client)
 
-        payload = self._request("POST", "/order/save", json=order_data)
+        payload = self._request("POST", ORDER_SAVE_PATH, json=order_data)
         rows = payload.get("rows") or []
         if not rows:
             raise YTimesAPIError("Ответ API order/save не содержит заказа")
@@ -0,0 +1,252 @@
+"""Компактная модель меню YTimes для хранения в памяти.
+
+Из ответа YTimes (группа меню и список добавок) берутся только поля, которые нужны
+сайту: guid, названия, цены, размеры и категории добавок. Описания, рецепты и прочие
+вложенные списки отбрасываются; строки интернируются (guid категорий добавок
+повторяются в каждой позиции).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterator, Optional, Tuple
+
+
+def _s(value: Any) -> str:
+    """Строковое поле YTimes -> интернированная строка."""
+    return sys.intern(str(value)) if value is not None else ""
+
+
+def _num(value: float) -> int | float:
+    """Цена для JSON: целые без «.0»."""
+    return int(value) if float(value).is_integer() else value
+
+
+def _price(value: Any) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True, slots=True)
+class MenuType:
+    """Размер/тип позиции (объём и т.д.)."""
+
+    guid: str
+    name: str
+    price: float
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MenuType":
+        return cls(guid=_s(data.get("guid")), name=_s(data.get("name")), price=_price(data.get("price")) or 0.0)
+
+    def to_dict(self) -> dict:
+        return {"guid": self.guid, "name": self.name, "price": _num(self.price)}
+
+
+@dataclass(frozen=True, slots=True)
+class MenuItem:
+    """Позиция меню. types — typeList (или recipeTypeList, если typeList пуст)."""
+
+    FIELDS = ("guid", "name", "price", "typeList", "supplementCategoryToFreeCount")
+
+    guid: str
+    name: str
+    price: Optional[float]
+    types: Tuple[MenuType, ...] = ()
+    # (guid категории добавок, число бесплатных) — как supplementCategoryToFreeCount
+    supplement_categories: Tuple[Tuple[str, int], ...] = ()
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MenuItem":
+        raw_types = data.get("typeList") or data.get("recipeTypeList") or []
+        free_counts = data.get("supplementCategoryToFreeCount") or {}
+        return cls(
+            guid=_s(data.get("guid")),
+            name=_s(data.get("name")),
+            price=_price(data.get("price")),
+            types=tuple(MenuType.from_dict(t) for t in raw_types),
+            supplement_categories=tuple((_s(k), int(v or 0)) for k, v in free_counts.items()),
+        )
+
+    def to_dict(self, fields: Tuple[str, ...] = FIELDS) -> dict:
+        """Позиция в клиентской схеме (frontend/src/types.ts: MenuItem). Пустые поля опускаются."""
+        out: dict = {}
+        for f in fields:
+            if f == "guid":
+                out["guid"] = self.guid
+            elif f == "name":
+                out["name"] = self.name
+            elif f == "price":
+                if self.price is not None:
+                    out["price"] = _num(self.price)
+            elif f == "typeList":
+                if self.types:
+                    out["typeList"] = [t.to_dict() for t in self.types]
+            elif f == "supplementCategoryToFreeCount":
+                if self.supplement_categories:
+                    out["supplementCategoryToFreeCount"] = dict(self.supplement_categories)
+        return out
+
+    def base_price(self, type_guid: str | None) -> Optional[float]:
+        """Цена позиции в размере type_guid; None — такого размера у позиции нет.
+
+        Без размеров клиент присылает guid самой позиции (или пусто) — тогда цена позиции.
+        """
+        for menu_type in self.types:
+            if menu_type.guid == type_guid:
+                return menu_type.price
+        if not type_guid or type_guid == self.guid:
+            return self.price if self.price is not None else (self.types[0].price if self.types else None)
+        return None
+
+
+@dataclass(frozen=True, slots=True)
+class SupplementItem:
+    """Добавка."""
+
+    guid: str
+    name: str
+    default_price: float
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SupplementItem":
+        return cls(
+            guid=_s(data.get("guid")),
+            name=_s(data.get("name")),
+            default_price=_price(data.get("defaultPrice")) or 0.0,
+        )
+
+    def to_dict(self) -> dict:
+        return {"guid": self.guid, "name": self.name, "defaultPrice": _num(self.default_price)}
+
+
+@dataclass(frozen=True, slots=True)
+class SupplementCategory:
+    """Категория добавок."""
+
+    guid: str
+    name: str
+    items: Tuple[SupplementItem, ...] = ()
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SupplementCategory":
+        return cls(
+            guid=_s(data.get("guid")),
+            name=_s(data.get("name")),
+            items=tuple(SupplementItem.from_dict(s) for s in data.get("itemList") or []),
+        )
+
+    def to_dict(self) -> dict:
+        return {"guid": self.guid, "name": self.name, "itemList": [s.to_dict() for s in self.items]}
+
+
+@dataclass(frozen=True, slots=True)
+class MenuSnapshot:
+    """Снимок меню (одна группа) и добавок на момент загрузки из YTimes."""
+
+    guid: str
+    name: str
+    items: Tuple[MenuItem, ...]
+    supplement_categories: Tuple[SupplementCategory, ...]
+    version: str
+    fetched_at: float
+    _items_by_guid: dict = field(repr=False, compare=False)
+    _supplements_by_guid: dict = field(repr=False, compare=False)
+
+    @classmethod
+    def from_ytimes(cls, group: dict, supplements: list, *, fetched_at: float | None = None) -> "MenuSnapshot":
+        """Разобрать группу меню и список добавок из ответа YTimes."""
+        items = tuple(MenuItem.from_dict(i) for i in group.get("itemList") or [])
+        categories = tuple(SupplementCategory.from_dict(c) for c in supplements or [])
+        snapshot = cls(
+            guid=_s(group.get("guid")),
+            name=_s(group.get("name")),
+            items=items,
+            supplement_categories=categories,
+            version="",
+            fetched_at=fetched_at if fetched_at is not None else time.time(),
+            _items_by_guid={i.guid: i for i in items},
+            _supplements_by_guid={s.guid: s for c in categories for s in c.items},
+        )
+        # Версия — хеш содержимого: не меняется, если YTimes вернул то же меню
+        digest = hashlib.sha1(
+            json.dumps([snapshot.menu_dict(), snapshot.supplements_list()], ensure_ascii=False, sort_keys=True).encode()
+        ).hexdigest()[:12]
+        object.__setattr__(snapshot, "version", digest)
+        return snapshot
+
+    def item(self, guid: str) -> Optional[MenuItem]:
+        return self._items_by_guid.get(guid)
+
+    def supplement(self, guid: str) -> Optional[SupplementItem]:
+        return self._supplements_by_guid.get(guid)
+
+    def line_price(self, item_guid: str, type_guid: str | None, supplements: dict) -> Optional[float]:
+        """Цена одной строки корзины по снимку: размер + добавки. None — guid нет в меню."""
+        item = self.item(item_guid)
+        price = item.base_price(type_guid) if item else None
+        if price is None:
+            return None
+        for supplement_guid, count in (supplements or {}).items():
+            supplement = self.supplement(supplement_guid)
+            if supplement is None:
+                return None
+            price += supplement.default_price * int(count or 0)
+        return price
+
+    def menu_dict(self, fields: Tuple[str, ...] = MenuItem.FIELDS) -> dict:
+        """Группа меню в формате ответа /api/menu (см. frontend/src/types.ts)."""
+        return {"guid": self.guid, "name": self.name, "itemList": [i.to_dict(fields) for i in self.items]}
+
+    def supplements_list(self) -> list:
+        """Категории добавок в формате ответа /api/supplements."""
+        return [c.to_dict() for c in self.supplement_categories]
+
+    def guids(self) -> Iterator[str]:
+        """Все guid, которые могут попасть в корзину: позиции, размеры, добавки."""
+        for item in self.items:
+            yield item.guid
+            for menu_type in item.types:
+                yield menu_type.guid
+        yield from self._supplements_by_guid
+
+    def footprint(self) -> int:
+        """Примерный размер снимка в памяти, байт."""
+        return deep_sizeof(self)
+
+
+def _iter_children(obj: Any) -> Iterator[Any]:
+    if isinstance(obj, dict):
+        yield from obj.keys()
+        yield from obj.values()
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        yield from obj
+    elif hasattr(type(obj), "__slots__"):
+        for name in type(obj).__slots__:
+            if hasattr(obj, name):
+                yield getattr(obj, name)
+    elif hasattr(obj, "__dict__"):
+        yield obj.__dict__
+
+
+def deep_sizeof(obj: Any) -> int:
+    """Суммарный sys.getsizeof объекта и всего, на что он ссылается (каждый объект один раз)."""
+    seen: set[int] = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+        stack.extend(_iter_children(current))
+    return total
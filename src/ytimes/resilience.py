@@ -0,0 +1,154 @@
+"""Автомат защиты (circuit breaker) и адаптивный таймаут для операций YTimes API.
+
+Для каждой операции (путь API: /order/save, /menu/item/list, ...) отдельно:
+- таймаут подстраивается под наблюдаемые задержки: p99 последних ответов × запас,
+  в границах [min_timeout, max_timeout]; пока замеров мало — max_timeout. У неидемпотентной
+  записи (adaptive_timeout=False, /order/save) таймаут всегда max_timeout: заказ, созданный
+  медленно, не должен превращаться в таймаут и повтор с дублем;
+- после failure_threshold сбоев подряд (сеть, таймаут, 5xx, 429) операция «размыкается»:
+  вызовы сразу получают CircuitOpenError (api_client) без обращения к YTimes;
+- по истечении паузы пропускается один пробный вызов (half-open): успех замыкает цепь,
+  сбой размыкает снова с удвоенной паузой (до max_open_seconds).
+
+Клиент синхронный и вызывается из пула потоков, поэтому состояние защищено блокировкой.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class OperationGuard:
+    """Состояние одной операции: автомат защиты + окно задержек для таймаута."""
+
+    def __init__(
+        self,
+        operation: str,
+        *,
+        min_timeout: float = 2.0,
+        max_timeout: float = 10.0,
+        timeout_factor: float = 3.0,
+        min_samples: int = 20,
+        window: int = 200,
+        failure_threshold: int = 5,
+        open_seconds: float = 15.0,
+        max_open_seconds: float = 300.0,
+        adaptive_timeout: bool = True,
+    ) -> None:
+        self.operation = operation
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_factor = timeout_factor
+        self.min_samples = min_samples
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.adaptive_timeout = adaptive_timeout
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._open_seconds = open_seconds
+        self._opened_until = 0.0
+        self._probe_in_flight = False
+        self.total_failures = 0
+        self.rejected = 0
+        self.last_error: Optional[str] = None
+
+    def _percentile(self, p: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def timeout(self) -> float:
+        """Таймаут для следующего вызова, секунд."""
+        if not self.adaptive_timeout:
+            return self.max_timeout
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.max_timeout
+            p99 = self._percentile(0.99) or self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_factor))
+
+    def open_for(self) -> Optional[float]:
+        """Сколько ещё секунд цепь разомкнута; None — вызовы проходят (без захвата пробы)."""
+        with self._lock:
+            if self.state != OPEN:
+                return None
+            remaining = self._opened_until - time.monotonic()
+        return remaining if remaining > 0 else None
+
+    def before_call(self) -> Optional[float]:
+        """None — вызов разрешён; иначе через сколько секунд повторить (цепь разомкнута)."""
+        with self._lock:
+            if self.state == CLOSED:
+                return None
+            now = time.monotonic()
+            if self.state == OPEN and now >= self._opened_until:
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return None
+            self.rejected += 1
+            return max(self._opened_until - now, 1.0)
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self.state = CLOSED
+                self._open_seconds = self.base_open_seconds
+                self._probe_in_flight = False
+
+    def record_failure(self, error: str, latency: Optional[float] = None) -> None:
+        """Сбой YTimes. latency — сколько ждали (при таймауте это сам таймаут: окно подрастает)."""
+        with self._lock:
+            if latency is not None:
+                self._latencies.append(latency)
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            self.last_error = error[:300]
+            if self.state == HALF_OPEN:
+                self._open_seconds = min(self._open_seconds * 2, self.max_open_seconds)
+                self._trip()
+            elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+                self._trip()
+
+    def record_neutral(self) -> None:
+        """Ответ YTimes, не говорящий о его здоровье (4xx, ошибка в данных): освободить пробу."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probe_in_flight = False
+
+    def _trip(self) -> None:
+        self.state = OPEN
+        self._opened_until = time.monotonic() + self._open_seconds
+        self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            p50 = self._percentile(0.5)
+            p99 = self._percentile(0.99)
+            open_for = max(self._opened_until - time.monotonic(), 0.0) if self.state == OPEN else 0.0
+            data = {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "total_failures": self.total_failures,
+                "rejected": self.rejected,
+                "open_for_s": round(open_for, 1),
+                "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "p99_ms": round(p99 * 1000, 1) if p99 is not None else None,
+                "last_error": self.last_error,
+            }
+        data["timeout_s"] = round(self.timeout(), 2)
+        return data